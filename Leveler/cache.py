@@ -0,0 +1,119 @@
+import os
+import hashlib
+import asyncio
+import collections
+from io import BytesIO
+
+from PIL import Image
+
+# most bytes of images kept on disk, the least recently used ones are deleted past this
+MAX_DISK_BYTES = 256 * 1024 * 1024
+
+
+class LRUCache:
+    """Dict that keeps only the most recently used max_items"""
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.items = collections.OrderedDict()
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+
+class AssetCache:
+    """
+    Downloaded images saved on disk by a hash of their key, recently used ones also kept in memory.
+
+    Keys should change whenever the image does, like a url or an avatar hash,
+    so nothing is ever downloaded twice. Only valid images are saved, and files are touched
+    when read so the disk can be pruned least recently used first.
+    """
+
+    def __init__(self, path, max_items=128, max_bytes=MAX_DISK_BYTES):
+        self.path = path
+        self.memory = LRUCache(max_items)
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def file_path(self, key):
+        return os.path.join(self.path, hashlib.sha256(key.encode()).hexdigest())
+
+    def read(self, key):
+        path = self.file_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    @staticmethod
+    def is_image(data):
+        try:
+            Image.open(BytesIO(data)).verify()
+            return True
+        except Exception:
+            return False
+
+    def write(self, key, data):
+        """save data for key if it's an image, returns whether it was saved"""
+        if not self.is_image(data):
+            return False
+
+        path = self.file_path(key)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        self.prune()
+        return True
+
+    def prune(self):
+        """delete the least recently used files until the cache fits in max_bytes"""
+        files = []
+        for entry in os.scandir(self.path):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    async def get(self, key, fetch):
+        """
+        bytes for key, from memory, disk, or else awaiting fetch() and saving what it returns
+
+        what fetch returns is only saved if it's an image, anything else is returned as is and fetched again next time.
+        """
+        data = self.memory.get(key)
+        if data is not None:
+            return data
+
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, self.read, key)
+        if data is None:
+            data = await fetch()
+            if not await loop.run_in_executor(None, self.write, key, data):
+                return data
+
+        self.memory.put(key, data)
+        return data
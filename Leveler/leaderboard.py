@@ -0,0 +1,46 @@
+import bisect
+
+
+class Leaderboard:
+    """
+    Members of a guild ordered by exp, kept sorted as exp changes.
+
+    Entries are (-exp, member id) so the list sorts highest exp first, ties by id.
+    Ranks are a binary search instead of sorting every member on each lookup.
+    """
+
+    def __init__(self, ledger: dict):
+        self.exp = {member_id: entry["exp"] for member_id, entry in ledger.items()}
+        self.entries = sorted((-exp, member_id) for member_id, exp in self.exp.items())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, member_id, exp):
+        old = self.exp.get(member_id)
+        if old == exp:
+            return
+        if old is not None:
+            self.remove(member_id)
+
+        self.exp[member_id] = exp
+        bisect.insort(self.entries, (-exp, member_id))
+
+    def remove(self, member_id):
+        exp = self.exp.pop(member_id, None)
+        if exp is None:
+            return
+
+        i = bisect.bisect_left(self.entries, (-exp, member_id))
+        del self.entries[i]
+
+    def rank(self, member_id):
+        """1 based position of a member, None if they aren't on the leaderboard"""
+        exp = self.exp.get(member_id)
+        if exp is None:
+            return None
+        return bisect.bisect_left(self.entries, (-exp, member_id)) + 1
+
+    def page(self, start, count):
+        """ids of count members from position start, 0 based"""
+        return [member_id for _, member_id in self.entries[start : start + count]]
@@ -3,11 +3,13 @@ import re
 from redbot.core import checks, Config
 import discord
 from redbot.core import commands
-from redbot.core.data_manager import bundled_data_path
+from redbot.core.data_manager import bundled_data_path, cog_data_path
 from redbot.core.utils.menus import menu, DEFAULT_CONTROLS
 import asyncio
 import datetime
+import logging
 from .userprofile import UserProfile
+from .cache import AssetCache, LRUCache
 from PIL import Image, ImageDraw, ImageFont
 from math import floor, ceil
 import os
@@ -19,6 +21,14 @@ import textwrap
 from typing import Literal
 
 _ = Translator("Leveler", __file__)
+log = logging.getLogger("red.leveler")
+
+# how often changed member levels/exp are written to config, in seconds
+FLUSH_INTERVAL = 30
+# members shown per toplevel page
+LEADERBOARD_PAGE = 10
+# rendered profile cards kept in memory
+CARD_CACHE_SIZE = 256
 
 
 @cog_i18n(_)
@@ -29,9 +39,18 @@ class Leveler(commands.Cog):
         self.bot = bot
         self.profiles = UserProfile()
         self.loop = asyncio.create_task(self.start())
-        self.restart = True
+        # the flush currently writing, if any
+        self.flushing = None
+        self.flush_task = asyncio.create_task(self.flush_profiles())
         self.defaultrole = _("New")
         self._session = aiohttp.ClientSession()
+        # avatars and backgrounds by avatar hash/url, rendered cards by everything shown on them
+        self.assets = AssetCache(str(cog_data_path(self) / "cache"))
+        self.cards = LRUCache(CARD_CACHE_SIZE)
+        # (size, radius) -> alpha mask with round corners
+        self.corner_masks = {}
+        # font size -> loaded font
+        self.fonts = {}
 
     __version__ = "1.0.0"
     __author__ = "Malarne#1418"
@@ -58,59 +77,96 @@ class Leveler(commands.Cog):
         self.bot.remove_listener(self.listener)
         asyncio.create_task(self._session.close())
         self.loop.cancel()
+        self.flush_task.cancel()
+        # write out whatever changed since the last flush
+        asyncio.create_task(self.final_flush())
+
+    async def flush_profiles(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            self.flushing = asyncio.ensure_future(self.profiles.flush())
+            try:
+                # shielded, unloading waits for this write to finish instead of cutting it off
+                await asyncio.shield(self.flushing)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Error saving member levels, will retry next flush")
+
+    async def final_flush(self):
+        if self.flushing is not None:
+            try:
+                await self.flushing
+            except Exception:
+                # anything it didn't write is still marked changed, and written below
+                pass
+        try:
+            await self.profiles.flush()
+        except Exception:
+            log.exception("Error saving member levels on unload")
 
     async def start(self):
         await self.bot.wait_until_ready()
         while True:
-            if not self.restart:
-                guilds = self.bot.guilds
-                for i in guilds:
-                    profils = await self.profiles.data.all_members(i)
-                    for j in profils.keys():
-                        member = i.get_member(j)
-                        if member is None:
-                            await self._reset_member(i, j)
-                        else:
-                            await self.profiles.data.member(member).today.set(0)
-                self.restart = True
-            if datetime.datetime.now().strftime("%H:%M") in [
-                "05:00",
-                "05:01",
-                "05:02",
-                "05:03",
-                "05:04",
-                "05:05",
-            ]:
-                self.restart = False
-            await asyncio.sleep(30)
+            # a second late so the new day has started
+            await asyncio.sleep(self.profiles.seconds_until_reset() + 1)
+            await self.daily_reset()
+
+    async def daily_reset(self, force=False):
+        """
+        Remove members who left each guild, in one write per guild
+
+        Message counts for today reset themselves when the day changes, force resets them now.
+        Guilds that haven't been used since the bot started are read from config, not loaded.
+        """
+        for guild in self.bot.guilds:
+            member_ids = await self.profiles._member_ids(guild)
+            gone = [j for j in member_ids if guild.get_member(j) is None]
+            if gone:
+                await self.profiles._remove_members(guild.id, gone)
+            if force:
+                await self.profiles._reset_today(guild)
 
     async def _reset_member(self, guild, memberid):
         try:
-            base = self.profiles.data._get_base_group(self.profiles.data.MEMBER)
-            await base.clear_raw(str(guild.id), memberid)
+            self.profiles._forget_member(guild.id, memberid)
+            group = self.profiles._member_group(guild.id)
+            async with group.get_lock():
+                await group.clear_raw(str(memberid))
         except:
             pass
 
     @commands.command(hidden=True)
     @checks.is_owner()
     async def testreset(self, ctx):
-        self.restart = False
-        await ctx.send(_("Resets in 30 seconds max"), delete_after=30)
+        await self.daily_reset(force=True)
+        await ctx.tick()
+
+    @staticmethod
+    def avatar_key(user):
+        # the avatar hash changes with the avatar, default avatars depend on the discriminator
+        return f"avatar:{user.id}:{user.avatar}:{user.discriminator}"
 
     async def get_avatar(self, user):
-        try:
-            res = BytesIO()
-            await user.avatar_url_as(format="png", size=1024).save(res, seek_begin=True)
-            return res
-        except:
-            async with self._session.get(user.avatar_url_as(format="png", size=1024)) as r:
-                img = await r.content.read()
-                return BytesIO(img)
+        async def fetch():
+            try:
+                res = BytesIO()
+                await user.avatar_url_as(format="png", size=1024).save(res, seek_begin=True)
+                return res.getvalue()
+            except:
+                async with self._session.get(str(user.avatar_url_as(format="png", size=1024))) as r:
+                    r.raise_for_status()
+                    return await r.content.read()
+
+        return BytesIO(await self.assets.get(self.avatar_key(user), fetch))
 
     async def get_background(self, url):
-        async with self._session.get(url) as f:
-            data = await f.read()
-            return Image.open(BytesIO(data))
+        async def fetch():
+            async with self._session.get(url) as f:
+                f.raise_for_status()
+                return await f.read()
+
+        return Image.open(BytesIO(await self.assets.get(f"background:{url}", fetch)))
 
     def round_corner(self, radius):
         """Draw a round corner"""
@@ -121,20 +177,29 @@ class Leveler(commands.Cog):
 
     def add_corners(self, im, rad):
         # https://stackoverflow.com/questions/7787375/python-imaging-library-pil-drawing-rounded-rectangle-with-gradient
-        width, height = im.size
-        alpha = Image.new("L", im.size, 255)
-        origCorner = self.round_corner(rad)
-        corner = origCorner
-        alpha.paste(corner, (0, 0))
-        corner = origCorner.rotate(90)
-        alpha.paste(corner, (0, height - rad))
-        corner = origCorner.rotate(180)
-        alpha.paste(corner, (width - rad, height - rad))
-        corner = origCorner.rotate(270)
-        alpha.paste(corner, (width - rad, 0))
+        alpha = self.corner_masks.get((im.size, rad))
+        if alpha is None:
+            width, height = im.size
+            alpha = Image.new("L", im.size, 255)
+            origCorner = self.round_corner(rad)
+            corner = origCorner
+            alpha.paste(corner, (0, 0))
+            corner = origCorner.rotate(90)
+            alpha.paste(corner, (0, height - rad))
+            corner = origCorner.rotate(180)
+            alpha.paste(corner, (width - rad, height - rad))
+            corner = origCorner.rotate(270)
+            alpha.paste(corner, (width - rad, 0))
+            self.corner_masks[(im.size, rad)] = alpha
         im.putalpha(alpha)
         return im
 
+    def get_font(self, size):
+        font = self.fonts.get(size)
+        if font is None:
+            font = self.fonts[size] = ImageFont.truetype(str(bundled_data_path(self) / "cambria.ttc"), size)
+        return font
+
     def make_full_profile(self, avatar_data, user, xp, nxp, lvl, minone, elo, ldb, desc, bg=None):
         img = Image.new("RGBA", (340, 390), (17, 17, 17, 255))
         if bg is not None:
@@ -163,11 +228,9 @@ class Leveler(commands.Cog):
         img.paste(nameplate, (155, 10), nameplate)
         img.paste(xptot, (15, 340), xptot)
 
-        fontpath = str(bundled_data_path(self) / "cambria.ttc")
-
-        font1 = ImageFont.truetype(fontpath, 18)
-        font2 = ImageFont.truetype(fontpath, 22)
-        font3 = ImageFont.truetype(fontpath, 32)
+        font1 = self.get_font(18)
+        font2 = self.get_font(22)
+        font3 = self.get_font(32)
 
         avatar = Image.open(avatar_data)
         avatar_size = 130, 130
@@ -216,15 +279,14 @@ class Leveler(commands.Cog):
         return temp
 
     async def profile_data(self, user):
-        """Async get user profile data to pass to image creator"""
-        avatar = await self.get_avatar(user)
-        try:
-            bg = await self.get_background(await self.profiles._get_background(user))
-        except:
-            bg = None
-        default = await self.profiles.data.guild(user.guild).defaultrole()
+        """
+        Async get user profile data to pass to image creator
+
+        avatar_data and bg are left for after checking the card cache, bg_url has to be removed first.
+        """
+        default = await self.profiles._get_default_role(user.guild)
         data = {
-            "avatar_data": avatar,
+            "avatar_data": None,
             "user": user,
             "xp": 0,
             "nxp": 100,
@@ -233,7 +295,8 @@ class Leveler(commands.Cog):
             "elo": default if default else _("New"),
             "ldb": 0,
             "desc": "",
-            "bg": bg,
+            "bg": None,
+            "bg_url": await self.profiles._get_background(user),
         }
         if not await self.profiles._is_registered(user):
             return data
@@ -249,7 +312,6 @@ class Leveler(commands.Cog):
                 data["minone"] = 0
             roles = await self.profiles._get_guild_roles(user.guild)
             if len(roles) == 0:
-                default = await self.profiles.data.guild(user.guild).defaultrole()
                 data["elo"] = default if default else self.defaultrole
             else:
                 if str(lvl) in roles.keys():
@@ -275,16 +337,32 @@ class Leveler(commands.Cog):
         if user is None:
             user = ctx.author
         data = await self.profile_data(user)
+        # everything drawn on the card, it only needs rendering again when one of these changes
+        key = (self.avatar_key(user), data["bg_url"], user.display_name, str(user)) + tuple(
+            data[k] for k in ("xp", "nxp", "lvl", "minone", "elo", "ldb", "desc")
+        )
+
+        card = self.cards.get(key)
+        if card is None:
+            data["avatar_data"] = await self.get_avatar(user)
+            bg_url = data.pop("bg_url")
+            if bg_url:
+                try:
+                    data["bg"] = await self.get_background(bg_url)
+                except:
+                    pass
+
+            task = functools.partial(self.make_full_profile, **data)
+            task = self.bot.loop.run_in_executor(None, task)
+            try:
+                img = await asyncio.wait_for(task, timeout=60)
+            except asyncio.TimeoutError:
+                return
 
-        task = functools.partial(self.make_full_profile, **data)
-        task = self.bot.loop.run_in_executor(None, task)
-        try:
-            img = await asyncio.wait_for(task, timeout=60)
-        except asyncio.TimeoutError:
-            return
+            card = img.getvalue()
+            self.cards.put(key, card)
 
-        img.seek(0)
-        await ctx.send(file=discord.File(img))
+        await ctx.send(file=discord.File(BytesIO(card), filename="profile.png"))
 
     async def listener(self, message):
         if await self.bot.cog_disabled_in_guild(self, message.guild):
@@ -296,10 +374,10 @@ class Leveler(commands.Cog):
             return
         if message.author.bot:
             return
-        if await self.profiles.data.guild(message.guild).whitelist():
+        if await self.profiles._get_whitelist(message.guild):
             if message.channel.id not in await self.profiles._get_guild_channels(message.author.guild):
                 return
-        elif await self.profiles.data.guild(message.guild).blacklist():
+        elif await self.profiles._get_blacklist(message.guild):
             if message.channel.id in await self.profiles._get_guild_blchannels(message.author.guild):
                 return
 
@@ -331,7 +409,7 @@ class Leveler(commands.Cog):
             await self.profiles._give_exp(message.author, xp)
             await self.profiles._set_user_lastmessage(message.author, timenow)
             lvl = await self.profiles._get_level(message.author)
-            if lvl == oldlvl + 1 and await self.profiles.data.guild(message.guild).lvlup_announce():
+            if lvl == oldlvl + 1 and await self.profiles._get_lvlup_announce(message.guild):
                 await message.channel.send(
                     _("{} is now level {} !".format(message.author.mention, lvl)),
                     allowed_mentions=discord.AllowedMentions.all(),
@@ -353,10 +431,13 @@ class Leveler(commands.Cog):
 
     @commands.command()
     @commands.guild_only()
-    async def toplevel(self, ctx):
+    async def toplevel(self, ctx, page: int = 1):
         """Show the server leaderboard !"""
-        ld = await self.profiles._get_leaderboard(ctx.guild)
+        pages = max(ceil(await self.profiles._get_leaderboard_size(ctx.guild) / LEADERBOARD_PAGE), 1)
+        page = min(max(page, 1), pages)
+        ld = await self.profiles._get_leaderboard(ctx.guild, (page - 1) * LEADERBOARD_PAGE, LEADERBOARD_PAGE)
         emb = discord.Embed(title=_("Ranking"))
+        emb.set_footer(text=_("Page {page}/{pages}").format(page=page, pages=pages))
         for i in range(len(ld)):
             cur = ld[i]
             user = ctx.guild.get_member(cur["id"])
@@ -634,7 +715,7 @@ class Leveler(commands.Cog):
     @commands.guild_only()
     async def default_role(self, ctx, *, name):
         """Allow you to rename default role for your guild."""
-        await self.profiles.data.guild(ctx.author.guild).defaultrole.set(name)
+        await self.profiles._set_default_role(ctx.author.guild, name)
         await ctx.send(_(f"Default role name set to {name}"))
 
     @levelerset.command()
@@ -643,7 +724,7 @@ class Leveler(commands.Cog):
     async def announce(self, ctx, status: bool):
         """Toggle whether the bot will announce levelups.
         args are True/False."""
-        await self.profiles.data.guild(ctx.guild).lvlup_announce.set(status)
+        await self.profiles._set_lvlup_announce(ctx.guild, status)
         await ctx.send(_("Levelup announce is now {}.").format(_("enabled") if status else _("disabled")))
 
     # Listeners
@@ -652,7 +733,7 @@ class Leveler(commands.Cog):
         if await self.bot.cog_disabled_in_guild(self, member.guild):
             return
         # reset level stats on leave.
-        await self.profiles.data.member(member).clear()
+        await self.profiles._clear_member(member)
 
     async def red_delete_data_for_user(
         self,
@@ -1,7 +1,17 @@
 from redbot.core import Config
 import asyncio
+import datetime
 import discord
 
+from .leaderboard import Leaderboard
+
+# member data kept in memory and written back in batches, the rest is only in config
+# today only counts for the day it was last set on, so it resets by itself when a new day starts
+LEDGER_DEFAULTS = {"exp": 0, "level": 1, "today": 0, "day": 0, "lastmessage": 0.0}
+
+# local time when message counts for today start over
+RESET_TIME = datetime.time(5, 0)
+
 
 class UserProfile:
     def __init__(self):
@@ -19,32 +29,165 @@ class UserProfile:
             "blacklist": False,
             "lvlup_announce": False,
         }
-        default_member = {"exp": 0, "level": 1, "today": 0, "lastmessage": 0.0, "background": None, "description": ""}
+        default_member = {
+            "exp": 0,
+            "level": 1,
+            "today": 0,
+            "day": 0,
+            "lastmessage": 0.0,
+            "background": None,
+            "description": "",
+        }
         self.data.register_member(**default_member)
         self.data.register_guild(**default_guild)
 
+        # guild id -> guild settings, dropped when a setting changes
+        self.guild_cache = {}
+        # guild id -> {member id -> ledger fields}, loaded for a whole guild on first use
+        self.ledgers = {}
+        # guild id -> member ids whose ledger changed since the last flush
+        self.dirty = {}
+        self.ledger_locks = {}
+        # guild id -> Leaderboard, built with the guild's ledger and updated whenever exp changes
+        self.leaderboards = {}
+
     @staticmethod
     def level_func(curr_level: int):
         return 5 * ((curr_level - 1) ** 2) + (50 * (curr_level - 1)) + 50
 
+    @staticmethod
+    def current_day():
+        """number of the current day, days start at RESET_TIME"""
+        reset = datetime.datetime.combine(datetime.date.min, RESET_TIME) - datetime.datetime.min
+        return (datetime.datetime.now() - reset).toordinal()
+
+    @staticmethod
+    def seconds_until_reset():
+        now = datetime.datetime.now()
+        reset = datetime.datetime.combine(now.date(), RESET_TIME)
+        if reset <= now:
+            reset += datetime.timedelta(days=1)
+        return (reset - now).total_seconds()
+
+    def _today_of(self, entry):
+        return entry["today"] if entry["day"] == self.current_day() else 0
+
+    async def _guild_settings(self, guild):
+        settings = self.guild_cache.get(guild.id)
+        if settings is None:
+            settings = self.guild_cache[guild.id] = await self.data.guild(guild).all()
+        return settings
+
+    async def _guild_ledger(self, guild):
+        ledger = self.ledgers.get(guild.id)
+        if ledger is not None:
+            return ledger
+
+        lock = self.ledger_locks.setdefault(guild.id, asyncio.Lock())
+        async with lock:
+            if guild.id not in self.ledgers:
+                members = await self.data.all_members(guild)
+                ledger = {member_id: {k: data[k] for k in LEDGER_DEFAULTS} for member_id, data in members.items()}
+                self.leaderboards[guild.id] = Leaderboard(ledger)
+                self.ledgers[guild.id] = ledger
+
+        return self.ledgers[guild.id]
+
+    async def _ledger(self, member):
+        ledger = await self._guild_ledger(member.guild)
+        entry = ledger.get(member.id)
+        if entry is None:
+            entry = ledger[member.id] = dict(LEDGER_DEFAULTS)
+            self.leaderboards[member.guild.id].update(member.id, entry["exp"])
+        return entry
+
+    def _mark_dirty(self, guild_id, member_id):
+        self.dirty.setdefault(guild_id, set()).add(member_id)
+
+    def _member_group(self, guild_id):
+        """
+        all member data of a guild, bulk writes go through this under its lock
+
+        single member writes take the same lock, so a bulk write never puts back what they changed.
+        """
+        return self.data._get_base_group(self.data.MEMBER, str(guild_id))
+
+    async def flush(self):
+        """
+        write every changed ledger entry to config, one write per guild
+
+        if a write fails or is cancelled, its guild's entries stay changed for the next flush.
+        """
+        for guild_id in list(self.dirty):
+            member_ids = self.dirty.pop(guild_id, None)
+            if not member_ids:
+                continue
+
+            try:
+                ledger = self.ledgers.get(guild_id, {})
+                group = self._member_group(guild_id)
+                async with group.get_lock():
+                    members = await group()
+                    for member_id in member_ids:
+                        entry = ledger.get(member_id)
+                        # cleared since it changed
+                        if entry is not None:
+                            members.setdefault(str(member_id), {}).update(entry)
+                    await group.set(members)
+            except BaseException:
+                self.dirty.setdefault(guild_id, set()).update(member_ids)
+                raise
+
+    def _forget_member(self, guild_id, memberid):
+        """drop a member's ledger entry, for when their config data is cleared"""
+        self.ledgers.get(guild_id, {}).pop(memberid, None)
+        self.dirty.get(guild_id, set()).discard(memberid)
+        if guild_id in self.leaderboards:
+            self.leaderboards[guild_id].remove(memberid)
+
+    async def _remove_members(self, guild_id, member_ids):
+        """clear the data of many members of a guild in one write"""
+        for member_id in member_ids:
+            self._forget_member(guild_id, member_id)
+
+        group = self._member_group(guild_id)
+        async with group.get_lock():
+            members = await group()
+            for member_id in member_ids:
+                members.pop(str(member_id), None)
+            await group.set(members)
+
+    async def _clear_member(self, member):
+        self._forget_member(member.guild.id, member.id)
+        async with self._member_group(member.guild.id).get_lock():
+            await self.data.member(member).clear()
+
     async def _set_guild_background(self, guild, bg):
         await self.data.guild(guild).defaultbg.set(bg)
+        self.guild_cache.pop(guild.id, None)
 
     async def _give_exp(self, member, exp):
-        current = await self.data.member(member).exp()
-        await self.data.member(member).exp.set(current + exp)
+        entry = await self._ledger(member)
+        entry["exp"] += exp
+        self._mark_dirty(member.guild.id, member.id)
+        self.leaderboards[member.guild.id].update(member.id, entry["exp"])
         await self._check_exp(member)
 
     async def _set_exp(self, member, exp):
-        await self.data.member(member).exp.set(exp)
+        entry = await self._ledger(member)
+        entry["exp"] = exp
+        self._mark_dirty(member.guild.id, member.id)
+        self.leaderboards[member.guild.id].update(member.id, entry["exp"])
         await self._check_exp(member)
 
     async def _set_level(self, member, level):
-        await self.data.member(member).level.set(level)
+        entry = await self._ledger(member)
+        entry["level"] = level
+        self._mark_dirty(member.guild.id, member.id)
 
     async def _is_registered(self, member):
-        async with self.data.guild(member.guild).database() as db:
-            return member.id in db
+        settings = await self._guild_settings(member.guild)
+        return member.id in settings["database"]
 
     async def _register_user(self, member):
         data = await self.data.guild(member.guild).database()
@@ -52,30 +195,37 @@ class UserProfile:
             await self.data.guild(member.guild).database.set([])
         async with self.data.guild(member.guild).database() as db:
             db.append(member.id)
-        await self.data.member(member).exp.set(0)
+        self.guild_cache.pop(member.guild.id, None)
+        await self._set_exp(member, 0)
 
     async def _set_user_lastmessage(self, member, lastmessage: float):
-        await self.data.member(member).lastmessage.set(lastmessage)
+        entry = await self._ledger(member)
+        entry["lastmessage"] = lastmessage
+        self._mark_dirty(member.guild.id, member.id)
 
     async def _get_user_lastmessage(self, member):
-        return await self.data.member(member).lastmessage()
+        return (await self._ledger(member))["lastmessage"]
 
     async def _downgrade_level(self, member):
-        lvl = await self.data.member(member).level()
+        entry = await self._ledger(member)
+        lvl = entry["level"]
         pastlvl = self.level_func(lvl - 1)
-        xp = await self.data.member(member).exp()
+        xp = entry["exp"]
         while xp < pastlvl and not lvl <= 1:
             lvl -= 1
             pastlvl = self.level_func(lvl)
-        await self.data.member(member).level.set(lvl)
+        entry["level"] = lvl
+        self._mark_dirty(member.guild.id, member.id)
 
     async def _check_exp(self, member):
-        lvl = await self.data.member(member).level()
+        entry = await self._ledger(member)
+        lvl = entry["level"]
         lvlup = self.level_func(lvl)
-        xp = await self.data.member(member).exp()
+        xp = entry["exp"]
         if xp >= lvlup:
             lvl += 1
-            await self.data.member(member).level.set(lvl)
+            entry["level"] = lvl
+            self._mark_dirty(member.guild.id, member.id)
             lvlup = self.level_func(lvl)
             if xp >= lvlup:
                 await self._check_exp(member)
@@ -84,8 +234,8 @@ class UserProfile:
 
     async def _check_role_member(self, member):
         # only checks and adds the highest level's role obtainable
-        roles = await self.data.guild(member.guild).roles()
-        lvl = await self.data.member(member).level()
+        roles = await self._get_guild_roles(member.guild)
+        lvl = await self._get_level(member)
         to_add = None
         levels = sorted([int(k) for k in roles.keys()], reverse=True)
         for k in levels:
@@ -111,6 +261,7 @@ class UserProfile:
             rl = {}
         rl.update({str(level): roleid})
         await self.data.guild(guild).roles.set(rl)
+        self.guild_cache.pop(guild.id, None)
 
     async def _remove_guild_role(self, guild, role):
         rolelist = await self.data.guild(guild).roles()
@@ -118,35 +269,41 @@ class UserProfile:
             if v == role.id:
                 del rolelist[k]
                 await self.data.guild(guild).roles.set(rolelist)
+                self.guild_cache.pop(guild.id, None)
                 return
 
     async def _get_guild_roles(self, guild):
-        return await self.data.guild(guild).roles()
+        return (await self._guild_settings(guild))["roles"]
 
     async def _add_guild_channel(self, guild, channel):
         async with self.data.guild(guild).wlchannels() as chanlist:
             chanlist.append(channel)
+        self.guild_cache.pop(guild.id, None)
 
     async def _remove_guild_channel(self, guild, channel):
         async with self.data.guild(guild).wlchannels() as chanlist:
             chanlist.remove(channel)
+        self.guild_cache.pop(guild.id, None)
 
     async def _get_guild_channels(self, guild):
-        return await self.data.guild(guild).wlchannels()
+        return (await self._guild_settings(guild))["wlchannels"]
 
     async def _add_guild_blacklist(self, guild, channel):
         async with self.data.guild(guild).blchannels() as chanlist:
             chanlist.append(channel)
+        self.guild_cache.pop(guild.id, None)
 
     async def _remove_guild_blacklist(self, guild, channel):
         async with self.data.guild(guild).blchannels() as chanlist:
             chanlist.remove(channel)
+        self.guild_cache.pop(guild.id, None)
 
     async def _get_guild_blchannels(self, guild):
-        return await self.data.guild(guild).blchannels()
+        return (await self._guild_settings(guild))["blchannels"]
 
     async def _toggle_whitelist(self, guild):
         wl = await self.data.guild(guild).whitelist()
+        self.guild_cache.pop(guild.id, None)
         if wl:
             await self.data.guild(guild).whitelist.set(False)
             return False
@@ -156,6 +313,7 @@ class UserProfile:
 
     async def _toggle_blacklist(self, guild):
         bl = await self.data.guild(guild).blacklist()
+        self.guild_cache.pop(guild.id, None)
         if bl:
             await self.data.guild(guild).blacklist.set(False)
             return False
@@ -163,69 +321,121 @@ class UserProfile:
             await self.data.guild(guild).blacklist.set(True)
             return True
 
+    async def _get_whitelist(self, guild):
+        return (await self._guild_settings(guild))["whitelist"]
+
+    async def _get_blacklist(self, guild):
+        return (await self._guild_settings(guild))["blacklist"]
+
+    async def _set_default_role(self, guild, name):
+        await self.data.guild(guild).defaultrole.set(name)
+        self.guild_cache.pop(guild.id, None)
+
+    async def _get_default_role(self, guild):
+        return (await self._guild_settings(guild))["defaultrole"]
+
+    async def _set_lvlup_announce(self, guild, status: bool):
+        await self.data.guild(guild).lvlup_announce.set(status)
+        self.guild_cache.pop(guild.id, None)
+
+    async def _get_lvlup_announce(self, guild):
+        return (await self._guild_settings(guild))["lvlup_announce"]
+
     async def _get_exp(self, member):
-        return await self.data.member(member).exp()
+        return (await self._ledger(member))["exp"]
 
     async def _get_level(self, member):
-        return await self.data.member(member).level()
+        return (await self._ledger(member))["level"]
 
     async def _get_level_exp(self, member):
-        lvl = await self.data.member(member).level()
+        lvl = await self._get_level(member)
         return self.level_func(lvl)
 
     async def _get_today(self, member):
-        return await self.data.member(member).today()
+        return self._today_of(await self._ledger(member))
 
     async def _today_addone(self, member):
-        await self.data.member(member).today.set(await self._get_today(member) + 1)
+        entry = await self._ledger(member)
+        entry["today"] = self._today_of(entry) + 1
+        entry["day"] = self.current_day()
+        self._mark_dirty(member.guild.id, member.id)
+
+    async def _member_ids(self, guild):
+        """ids of every member with data in a guild, without loading the guild's ledger if it isn't loaded"""
+        ledger = self.ledgers.get(guild.id)
+        if ledger is not None:
+            return list(ledger.keys())
+        return list((await self.data.all_members(guild)).keys())
+
+    async def _reset_today(self, guild):
+        """start today over for every member of a guild now, instead of at the next RESET_TIME"""
+        ledger = self.ledgers.get(guild.id)
+        if ledger is not None:
+            for member_id, entry in ledger.items():
+                if entry["today"]:
+                    entry["today"] = 0
+                    self._mark_dirty(guild.id, member_id)
+            return
+
+        # not loaded, change it in config without loading it
+        group = self._member_group(guild.id)
+        async with group.get_lock():
+            members = await group()
+            reset = [data for data in members.values() if data.get("today")]
+            for data in reset:
+                data["today"] = 0
+            if reset:
+                await group.set(members)
 
     async def _set_auto_register(self, guild, autoregister: bool):
         await self.data.guild(guild).autoregister.set(autoregister)
+        self.guild_cache.pop(guild.id, None)
 
     async def _get_auto_register(self, guild):
-        return await self.data.guild(guild).autoregister()
+        return (await self._guild_settings(guild))["autoregister"]
 
     async def _set_cooldown(self, guild, cooldown: float):
         await self.data.guild(guild).cooldown.set(cooldown)
+        self.guild_cache.pop(guild.id, None)
 
     async def _get_cooldown(self, guild):
-        return await self.data.guild(guild).cooldown()
+        return (await self._guild_settings(guild))["cooldown"]
 
     async def _set_background(self, member, background):
-        await self.data.member(member).background.set(background)
+        async with self._member_group(member.guild.id).get_lock():
+            await self.data.member(member).background.set(background)
 
     async def _get_background(self, member):
         userbg = await self.data.member(member).background()
         if userbg is None:
-            return await self.data.guild(member.guild).defaultbg()
+            return (await self._guild_settings(member.guild))["defaultbg"]
         else:
             return userbg
 
     async def _set_description(self, member, description: str):
-        await self.data.member(member).description.set(description)
+        async with self._member_group(member.guild.id).get_lock():
+            await self.data.member(member).description.set(description)
 
     async def _get_description(self, member):
         return await self.data.member(member).description()
 
     async def _get_leaderboard_pos(self, guild, member):
-        datas = await self.data.all_members(guild)
-        infos = sorted(datas, key=lambda x: datas[x]["exp"], reverse=True)
-        return infos.index(member.id) + 1
+        await self._guild_ledger(guild)
+        return self.leaderboards[guild.id].rank(member.id)
 
-    async def _get_leaderboard(self, guild):
-        datas = await self.data.all_members(guild)
-        infos = sorted(datas, key=lambda x: datas[x]["exp"], reverse=True)
+    async def _get_leaderboard_size(self, guild):
+        await self._guild_ledger(guild)
+        return len(self.leaderboards[guild.id])
+
+    async def _get_leaderboard(self, guild, start=0, count=10):
+        datas = await self._guild_ledger(guild)
         res = []
-        count = 1
-        for i in infos:
+        for i in self.leaderboards[guild.id].page(start, count):
             tmp = {}
             tmp["id"] = i
             cur = datas[i]
             tmp["xp"] = cur["exp"]
             tmp["lvl"] = cur["level"]
-            tmp["today"] = cur["today"]
+            tmp["today"] = self._today_of(cur)
             res.append(tmp)
-            count += 1
-            if count == 10:
-                break
         return res
@@ -7,6 +7,9 @@ from redbot.core.utils.predicates import MessagePredicate
 import discord
 
 from .utils import *
+from . import events as ev
+from . import graph as corr
+from .downloads import AttachmentStore
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from dateutil.tz import tzlocal
@@ -16,11 +19,14 @@ import asyncio
 import glob
 import io
 import functools
+import logging
+import itertools
+import calendar
+import collections
 
 from typing import Literal
 
 # plotting
-from bisect import bisect_left
 import matplotlib.pyplot as plt
 from matplotlib.dates import AutoDateLocator, AutoDateFormatter
 import pandas as pd
@@ -62,8 +68,20 @@ DELETE_AUDIT_TEMPLATE = "@{0.name}#{0.discriminator}(id:{0.id}) deleted message
 
 MAX_LINES = 50000
 
-CORR_MSG_DELTA = timedelta(minutes=15)
-VOICE_TIME_LIMIT = timedelta(hours=24)
+
+# how often to look for closed log files to compact, in seconds
+COMPACT_INTERVAL = 3600
+# most attachment downloads waiting or running at once, across all guilds
+MAX_PENDING_DOWNLOADS = 500
+# most attachment downloads running at once, across all guilds
+DOWNLOAD_WORKERS = 8
+# how many recently logged messages to keep for resolving replies
+RECENT_MESSAGES = 1000
+# most replied to messages fetched from the api per REPLY_FETCH_PERIOD seconds
+REPLY_FETCH_RATE = 5
+REPLY_FETCH_PERIOD = 5
+
+logger = logging.getLogger("red.activitylog")
 
 
 class ActivityLogger(commands.Cog):
@@ -84,6 +102,16 @@ class ActivityLogger(commands.Cog):
                 "everything": False,
                 "rotation": "m",
                 "check_audit": True,
+                "flush_size": 65536,
+                "flush_interval": 5,
+                "fsync": False,
+                "stats_interval": 60,
+                "workers": 2,
+                "attachment_max_size": 0,
+                "attachment_quota": 0,
+                "guild_downloads": 2,
+                "fetch_replies": True,
+                "max_handles": 256,
             }
         }
         self.default_guild = {
@@ -109,7 +137,25 @@ class ActivityLogger(commands.Cog):
         self.config.register_user(**default_user)
         self.config.register_member(**default_member)
 
-        self.handles = {}
+        self.handles = HandlePool()
+        self.write_stats = WriteStats()
+        # message counters not yet saved to config, keyed by (guild id, member id)
+        self.member_stats = {}
+        # interaction graphs per guild id, loaded on first use
+        self.graphs = {}
+        # graphs being loaded from disk per guild id
+        self.graph_loads = {}
+        # process pool for parsing log files in parallel, started on first use
+        self.pool = None
+        # background attachment downloads
+        self.downloads = set()
+        self.download_limit = asyncio.Semaphore(DOWNLOAD_WORKERS)
+        self.guild_download_limits = {}
+        self.attachment_store = AttachmentStore.load(str(PATH / "attachments.json"))
+        # recently logged messages by id, oldest first, and where replied to messages were found
+        self.recent_messages = collections.OrderedDict()
+        self.reply_fetches = collections.deque(maxlen=REPLY_FETCH_RATE)
+        self.reply_stats = collections.Counter()
         self.lock = False
         self.cache = {}
 
@@ -130,23 +176,45 @@ class ActivityLogger(commands.Cog):
         }
         self.bot.remove_command("userinfo")
         self.load_task = asyncio.create_task(self.initialize())
+        self.compact_task = asyncio.create_task(self.compact_logs())
+        self.flush_task = asyncio.create_task(self.flush_logs())
+        self.stats_task = asyncio.create_task(self.save_stats())
         self.loop = asyncio.get_event_loop()
 
     def cog_unload(self):
         self.lock = True
 
-        for h in self.handles.values():
-            h.close()
+        self.handles.close()
 
         if self.load_task:
             self.load_task.cancel()
 
+        if self.compact_task:
+            self.compact_task.cancel()
+
+        if self.flush_task:
+            self.flush_task.cancel()
+
+        if self.stats_task:
+            self.stats_task.cancel()
+
+        asyncio.create_task(self.flush_stats())
+        asyncio.create_task(self.save_graphs())
+
+        if self.pool:
+            self.pool.shutdown(wait=False)
+
+        for task in self.downloads:
+            task.cancel()
+        self.attachment_store.save()
+
     async def initialize(self):
         await self.bot.wait_until_ready()
 
         guild_data = await self.config.all_guilds()
         channel_data = await self.config.all_channels()
         self.cache = await self.config.attrs()
+        self.handles.resize(self.cache["max_handles"])
 
         # key ids for these should be ints
         for guild_id, data in guild_data.items():
@@ -321,11 +389,113 @@ class ActivityLogger(commands.Cog):
                 except Exception as e:
                     print(f"Error in userinfo: {e}")
 
+    async def get_member_stats(self, member):
+        """
+        Get a member's saved stats with counters that haven't been saved yet added in
+        """
+        stats = await self.config.member(member).stats()
+        pending = self.member_stats.get((member.guild.id, member.id))
+        if pending:
+            for key, value in pending.items():
+                stats[key] += value
+
+        return stats
+
+    def count_message(self, message):
+        """
+        Add a message to its author's unsaved stats
+        """
+        key = (message.guild.id, message.author.id)
+        stats = self.member_stats.get(key)
+        if stats is None:
+            stats = self.member_stats[key] = {"total_msg": 0, "bot_cmd": 0, "avg_len": 0}
+
+        stats["total_msg"] += 1
+        if len(message.content) > 0:
+            for prefix in self.cache[message.guild.id]["prefixes"]:
+                if prefix == message.content[: len(prefix)]:
+                    stats["bot_cmd"] += 1
+                    return
+
+            stats["avg_len"] += len(message.content.split(" "))
+
+    async def flush_stats(self):
+        """
+        Save all pending message counters to config
+        """
+        pending, self.member_stats = self.member_stats, {}
+        for (guild_id, member_id), counts in pending.items():
+            try:
+                async with self.config.member_from_ids(guild_id, member_id).stats() as stats:
+                    for key, value in counts.items():
+                        stats[key] += value
+            except Exception:
+                logger.exception(f"Failed to save stats for member {member_id} in guild {guild_id}")
+
+    async def save_stats(self):
+        """
+        Background job that saves message counters every stats interval
+        """
+        await self.bot.wait_until_ready()
+        while True:
+            await asyncio.sleep(self.cache.get("stats_interval", 60))
+            await self.flush_stats()
+            await self.save_graphs()
+            self.attachment_store.save()
+
+    async def get_graph(self, guild):
+        """
+        Get the interaction graph for a guild, loading it from disk in the executor if needed
+        """
+        graph = self.graphs.get(guild.id)
+        if graph is not None:
+            return graph
+
+        # messages that arrive while it's loading wait on the same load
+        load = self.graph_loads.get(guild.id)
+        if load is None:
+            corr_weights = self.cache.get(guild.id, self.default_guild)["corr_weights"]
+            path = str(PATH / "correlation" / f"{guild.id}.npz")
+            load = self.loop.run_in_executor(None, corr.InteractionGraph.load, path, corr_weights)
+            self.graph_loads[guild.id] = load
+
+        try:
+            graph = await asyncio.shield(load)
+        finally:
+            self.graph_loads.pop(guild.id, None)
+
+        return self.graphs.setdefault(guild.id, graph)
+
+    async def save_graph(self, graph):
+        """
+        Save an interaction graph if it changed, the edges are copied here and written in the executor
+        """
+        edges = graph.snapshot()
+        if edges is None:
+            return
+
+        try:
+            await self.loop.run_in_executor(None, corr.write_edges, graph.path, edges)
+        except Exception:
+            graph.dirty = True
+            raise
+
+    async def save_graphs(self):
+        """
+        Save interaction graphs that changed since they were last saved
+        """
+        os.makedirs(PATH / "correlation", exist_ok=True)
+        for graph in list(self.graphs.values()):
+            try:
+                await self.save_graph(graph)
+            except Exception:
+                logger.exception(f"Failed to save interaction graph {graph.path}")
+
     async def userstats(self, guild, user):
         """
         Get stats on a user about how active they are in the guild
         """
-        stats = await self.config.member(user).stats()
+        stats = await self.get_member_stats(user)
         async with self.config.user(user).past_names() as past_names:
             if not past_names:
                 guild_files = sorted(glob.glob(os.path.join(PATH, "usernames", "*.log")))
@@ -426,56 +596,35 @@ class ActivityLogger(commands.Cog):
             end_time = date
 
         async with ctx.channel.typing():
-            # get messages split by channel
-            messages = await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    self.log_handler,
-                    log_files,
-                    end_time,
-                    split_channels=True,
-                ),
-            )
+            # get log files split by channel, lines are streamed when processing
+            channel_logs = self.split_log_files(log_files)
 
             ### set up data dictionary
             voice_minutes = {}
-            to_delete = []
             # make sure to include only voice channels
-            for ch_id in messages.keys():
+            for ch_id, logs in channel_logs.items():
                 channel = guild.get_channel(ch_id)
                 # channel may be deleted, but still want to include message data
                 if not isinstance(channel, discord.VoiceChannel):
-                    to_delete.append(ch_id)
                     continue
-                voice_minutes[ch_id] = 0
-            # delete text channels
-            for ch_id in to_delete:
-                del messages[ch_id]
-
-            def process_messages():
-                # calculate number of messages for the user for every split
-                for ch_id, msgs in messages.items():
-                    join_at = None
-                    for message in msgs:
-                        if f"(id {str(user.id)})" not in message:
-                            continue
-
-                        if "Voice channel join:" in message:
-                            join_at = parse_time_naive(message[:19])
-                        elif "Voice channel leave:" in message and join_at is not None:
-                            leave = parse_time_naive(message[:19])
-                            voice_minutes[ch_id] += int((leave - join_at).total_seconds() / 60)
-                            join_at = None
-
-            await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    process_messages,
-                ),
+                voice_minutes[ch_id] = logs
+
+            events = await self.load_events(
+                [log for logs in voice_minutes.values() for log in logs], end_time, user_id=user.id
             )
+            events = events[
+                (events["author"] == user.id) & events["kind"].isin([ev.VOICE_JOIN, ev.VOICE_LEAVE])
+            ].sort_values("channel", kind="stable")
+
+            # pair every join with the leave right after it in the same channel
+            following = events.groupby("channel").shift(-1)
+            pairs = (events["kind"] == ev.VOICE_JOIN) & (following["kind"] == ev.VOICE_LEAVE)
+            minutes = ((following["ts"] - events["ts"]) // 60)[pairs]
+            minutes = minutes.groupby(events["channel"][pairs]).sum()
 
             # voice channels and minutes spent in channel per channel
-            df = pd.DataFrame(index=voice_minutes.keys(), data=voice_minutes.values(), columns=["voice_minutes"])
+            df = pd.DataFrame(index=voice_minutes.keys(), columns=["voice_minutes"])
+            df["voice_minutes"] = minutes.reindex(df.index, fill_value=0).astype(int)
 
             # change channel ids to real names, or leave as delete channel
             names = {}
@@ -585,33 +734,20 @@ class ActivityLogger(commands.Cog):
             end_time = date
 
         async with ctx.channel.typing():
-            # get messages split by channel
-            messages = await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    self.log_handler,
-                    log_files,
-                    end_time,
-                    split_channels=True,
-                ),
-            )
+            # get log files split by channel, lines are streamed when processing
+            channel_logs = self.split_log_files(log_files)
 
             ### set up data dictionary
             num_messages = {}
-            to_delete = []
             # make sure to include only text channels
-            for ch_id in messages.keys():
+            for ch_id, logs in channel_logs.items():
                 channel = guild.get_channel(ch_id)
                 # channel may be deleted, but still want to include message data
                 if isinstance(channel, discord.VoiceChannel):
-                    to_delete.append(ch_id)
                     continue
-                num_messages[ch_id] = 0
-            # delete voice channels
-            for ch_id in to_delete:
-                del messages[ch_id]
+                num_messages[ch_id] = logs
 
-            data = {"times": [], "num_messages": []}
+            data = {"times": []}
             # add all the possible times based on the split
             # first for each one zero out now time to the minute, day, etc
             # then go through and add all possible times to get data for
@@ -621,35 +757,30 @@ class ActivityLogger(commands.Cog):
                 end_time -= relativedelta(minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["num_messages"].append(num_messages.copy())
                     now = now - relativedelta(hours=1)
             elif split == "d":
                 now -= relativedelta(hour=0, minute=0, second=0, microsecond=0)
                 end_time -= relativedelta(hour=0, minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["num_messages"].append(num_messages.copy())
                     now = now - relativedelta(days=1)
             elif split == "w":
                 now -= relativedelta(days=now.weekday(), hour=0, minute=0, second=0, microsecond=0)
                 end_time -= relativedelta(days=end_time.weekday(), hour=0, minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["num_messages"].append(num_messages.copy())
                     now = now - relativedelta(weeks=1)
             elif split == "m":
                 now -= relativedelta(day=1, hour=0, minute=0, second=0, microsecond=0)
                 end_time -= relativedelta(day=1, hour=0, minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["num_messages"].append(num_messages.copy())
                     now = now - relativedelta(months=1)
             elif split == "y":
                 now -= relativedelta(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
                 end_time -= relativedelta(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["num_messages"].append(num_messages.copy())
                     now = now - relativedelta(years=1)
 
             if not data["times"]:
@@ -660,35 +791,18 @@ class ActivityLogger(commands.Cog):
 
             data["times"].reverse()
 
-            def process_messages():
-                # calculate number of messages for the user for every split
-                for ch_id, msgs in messages.items():
-                    for message in msgs:
-                        if f"(id:{str(user.id)})" not in message:
-                            continue
-                        # grab time of the message
-                        current_time = parse_time_naive(message[:19])
-                        # find what time to put it in using binary search
-                        index = bisect_left(data["times"], current_time) - 1
-                        # add message to channel
-                        data["num_messages"][index][ch_id] += 1
-
-            await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    process_messages,
-                ),
+            events = await self.load_events(
+                [log for logs in num_messages.values() for log in logs], end_time, user_id=user.id
             )
-
-            df = pd.DataFrame(data)
-            # make dict of num_messages into columns for every channel
-            df = pd.concat([df.drop("num_messages", axis=1), df["num_messages"].apply(pd.Series)], axis=1)
+            events = ev.only_messages(events)
+            # number of messages for the user for every split and channel
+            df = self.split_counts(events, data["times"], list(num_messages.keys()))
             # calculate total messages for each time.
             df["Total"] = df.drop("times", axis=1).sum(axis=1)
 
             # change channel ids to real names, or leave as delete channel
             names = {}
-            for i, ch_id in enumerate(data["num_messages"][0].keys()):
+            for i, ch_id in enumerate(num_messages.keys()):
                 channel = guild.get_channel(ch_id)
                 names[ch_id] = channel.name if channel else f"Deleted Channel {i+1}"
             df = df.rename(columns=names)
@@ -842,20 +956,7 @@ class ActivityLogger(commands.Cog):
             end_time = date
 
         async with ctx.channel.typing():
-            # get messages split by channel
-            audit_messages = await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    self.log_handler,
-                    log_files,
-                    end_time,
-                ),
-            )
-
-            # filter out unneeded messages
-            audit_messages = [m for m in audit_messages if "Member leave:" in m or "Member join:" in m]
-
-            data = {"times": [], "joins": [], "leaves": []}
+            data = {"times": []}
             # add all the possible times based on the split
             # first for each one zero out now time to the minute, day, etc
             # then go through and add all possible times to get data for
@@ -865,40 +966,30 @@ class ActivityLogger(commands.Cog):
                 end_time -= relativedelta(minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["joins"].append(0)
-                    data["leaves"].append(0)
                     now = now - relativedelta(hours=1)
             elif split == "d":
                 now -= relativedelta(hour=0, minute=0, second=0, microsecond=0)
                 end_time -= relativedelta(hour=0, minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["joins"].append(0)
-                    data["leaves"].append(0)
                     now = now - relativedelta(days=1)
             elif split == "w":
                 now -= relativedelta(days=now.weekday(), hour=0, minute=0, second=0, microsecond=0)
                 end_time -= relativedelta(days=end_time.weekday(), hour=0, minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["joins"].append(0)
-                    data["leaves"].append(0)
                     now = now - relativedelta(weeks=1)
             elif split == "m":
                 now -= relativedelta(day=1, hour=0, minute=0, second=0, microsecond=0)
                 end_time -= relativedelta(day=1, hour=0, minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["joins"].append(0)
-                    data["leaves"].append(0)
                     now = now - relativedelta(months=1)
             elif split == "y":
                 now -= relativedelta(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
                 end_time -= relativedelta(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["joins"].append(0)
-                    data["leaves"].append(0)
                     now = now - relativedelta(years=1)
 
             if not data["times"]:
@@ -909,27 +1000,10 @@ class ActivityLogger(commands.Cog):
 
             data["times"].reverse()
 
-            def process_messages():
-                # calculate number of messages for the user for every split
-                for message in audit_messages:
-                    # grab time of the message
-                    current_time = parse_time_naive(message[:19])
-                    # find what time to put it in using binary search
-                    index = bisect_left(data["times"], current_time) - 1
-
-                    if "Member leave:" in message:
-                        data["leaves"][index] += 1
-                    else:
-                        data["joins"][index] += 1
-
-            await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    process_messages,
-                ),
-            )
-
-            df = pd.DataFrame(data)
+            events = await self.load_events(log_files, end_time)
+            # number of joins and leaves for every split
+            df = self.split_counts(events, data["times"], [ev.MEMBER_JOIN, ev.MEMBER_LEAVE], column="kind")
+            df = df.rename(columns={ev.MEMBER_JOIN: "joins", ev.MEMBER_LEAVE: "leaves"})
 
             # set index
             df = df.set_index("times")
@@ -1076,24 +1150,10 @@ class ActivityLogger(commands.Cog):
             end_time = date
 
         async with ctx.channel.typing():
-            # get messages split by channel
-            messages = await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    self.log_handler,
-                    log_files,
-                    end_time,
-                    split_channels=True,
-                ),
-            )
+            # get log files split by channel, lines are streamed when processing
+            channel_logs = self.split_log_files(log_files)
 
-            ### set up data dictionary
-            num_messages = {}
-            # make sure to include only text channels
-            for ch_id in messages.keys():
-                num_messages[ch_id] = 0
-
-            data = {"times": [], "num_messages": []}
+            data = {"times": []}
             # add all the possible times based on the split
             # first for each one zero out now time to the minute, day, etc
             # then go through and add all possible times to get data for
@@ -1103,35 +1163,30 @@ class ActivityLogger(commands.Cog):
                 end_time -= relativedelta(minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["num_messages"].append(num_messages.copy())
                     now = now - relativedelta(hours=1)
             elif split == "d":
                 now -= relativedelta(hour=0, minute=0, second=0, microsecond=0)
                 end_time -= relativedelta(hour=0, minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["num_messages"].append(num_messages.copy())
                     now = now - relativedelta(days=1)
             elif split == "w":
                 now -= relativedelta(days=now.weekday(), hour=0, minute=0, second=0, microsecond=0)
                 end_time -= relativedelta(days=end_time.weekday(), hour=0, minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["num_messages"].append(num_messages.copy())
                     now = now - relativedelta(weeks=1)
             elif split == "m":
                 now -= relativedelta(day=1, hour=0, minute=0, second=0, microsecond=0)
                 end_time -= relativedelta(day=1, hour=0, minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["num_messages"].append(num_messages.copy())
                     now = now - relativedelta(months=1)
             elif split == "y":
                 now -= relativedelta(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
                 end_time -= relativedelta(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
                 while now >= end_time:
                     data["times"].append(now)
-                    data["num_messages"].append(num_messages.copy())
                     now = now - relativedelta(years=1)
 
             if not data["times"]:
@@ -1142,34 +1197,13 @@ class ActivityLogger(commands.Cog):
 
             data["times"].reverse()
 
-            def process_messages():
-                # calculate number of messages for the user for every split
-                for ch_id, msgs in messages.items():
-                    for message in msgs:
-                        # grab time of the message
-                        try:
-                            current_time = parse_time_naive(message[:19])
-                        except:
-                            continue
-                        # find what time to put it in using binary search
-                        index = bisect_left(data["times"], current_time) - 1
-                        # add message to channel
-                        data["num_messages"][index][ch_id] += 1
-
-            await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    process_messages,
-                ),
-            )
-
-            df = pd.DataFrame(data)
-            # make dict of num_messages into columns for every channel
-            df = pd.concat([df.drop("num_messages", axis=1), df["num_messages"].apply(pd.Series)], axis=1)
+            events = await self.load_events(log_files, end_time)
+            # number of messages for every split and channel
+            df = self.split_counts(events, data["times"], list(channel_logs.keys()))
 
             # change channel ids to real names, or leave as delete channel
             names = {}
-            for i, ch_id in enumerate(data["num_messages"][0].keys()):
+            for i, ch_id in enumerate(channel_logs.keys()):
                 channel = guild.get_channel(ch_id)
                 names[ch_id] = channel.name if channel else f"Deleted Channel {i+1}"
             df = df.rename(columns=names)
@@ -1271,40 +1305,15 @@ class ActivityLogger(commands.Cog):
             end_time = date
 
         async with ctx.channel.typing():
-            # get messages split by channel
-            messages = await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    self.log_handler,
-                    log_files,
-                    end_time,
-                ),
-            )
+            events = ev.only_messages(await self.load_events(log_files, end_time))
+            # number of messages per author
+            counts = events.loc[events["author"] != 0, "author"].value_counts()
 
             data = {}
-
-            def process_messages():
-                for message in messages:
-                    # get user id:
-                    try:
-                        user_id = int(message.split("(id:")[1].split(")")[0].strip())
-                    except:
-                        continue
-
-                    user = self.bot.get_user(user_id)
-                    user = user if user is not None else user_id
-
-                    if str(user) not in data:
-                        data[str(user)] = 0
-
-                    data[str(user)] += 1
-
-            await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    process_messages,
-                ),
-            )
+            for user_id, count in counts.items():
+                user = self.bot.get_user(int(user_id))
+                user = user if user is not None else int(user_id)
+                data[str(user)] = data.get(str(user), 0) + int(count)
 
             df = pd.DataFrame(index=data.keys(), data=data.values(), columns=["num_messages"])
             df.index.name = "user"
@@ -1408,39 +1417,15 @@ class ActivityLogger(commands.Cog):
             end_time = date
 
         async with ctx.channel.typing():
-            # get messages split by channel
-            messages = await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    self.log_handler,
-                    log_files,
-                    end_time,
-                ),
-            )
+            events = ev.only_messages(await self.load_events(log_files, end_time))
+            # number of messages per author
+            counts = events.loc[events["author"] != 0, "author"].value_counts()
 
             data = {}
-
-            def process_messages():
-                for message in messages:
-                    # get user id:
-                    try:
-                        user_id = int(message.split("(id:")[1].split(")")[0].strip())
-                    except:
-                        continue
-                    user = self.bot.get_user(user_id)
-                    user = user if user is not None else user_id
-
-                    if str(user) not in data:
-                        data[str(user)] = 0
-
-                    data[str(user)] += 1
-
-            await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    process_messages,
-                ),
-            )
+            for user_id, count in counts.items():
+                user = self.bot.get_user(int(user_id))
+                user = user if user is not None else int(user_id)
+                data[str(user)] = data.get(str(user), 0) + int(count)
 
             df = pd.DataFrame(index=data.keys(), data=data.values(), columns=["num_messages"])
             df.index.name = "user"
@@ -1536,34 +1521,10 @@ class ActivityLogger(commands.Cog):
             end_time = date
 
         async with ctx.channel.typing():
-            # get messages split by channel
-            messages = await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    self.log_handler,
-                    log_files,
-                    end_time,
-                ),
-            )
-
+            events = ev.only_messages(await self.load_events(log_files, end_time))
             # 24 hours, calculate # of messages for each hour of the day
-            data = {"times": [i for i in range(0, 24)], "num_messages": [0 for _ in range(0, 24)]}
-
-            def process_messages():
-                for message in messages:
-                    # get hour:
-                    try:
-                        hour = int(message[11:13])
-                    except:
-                        continue
-                    data["num_messages"][hour] += 1
-
-            await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    process_messages,
-                ),
-            )
+            hours = (events["ts"] // 3600 % 24).to_numpy(dtype=np.int64)
+            data = {"times": [i for i in range(0, 24)], "num_messages": np.bincount(hours, minlength=24)}
 
             # voice channels and minutes spent in channel per channel
             df = pd.DataFrame(data)
@@ -1667,34 +1628,10 @@ class ActivityLogger(commands.Cog):
             end_time = date
 
         async with ctx.channel.typing():
-            # get messages split by channel
-            messages = await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    self.log_handler,
-                    log_files,
-                    end_time,
-                ),
-            )
-
+            events = ev.only_messages(await self.load_events(log_files, end_time))
             # 24 hours, calculate # of messages for each hour of the day
-            data = {"times": [i for i in range(0, 24)], "num_messages": [0 for _ in range(0, 24)]}
-
-            def process_messages():
-                for message in messages:
-                    # get hour:
-                    try:
-                        hour = int(message[11:13])
-                    except:
-                        continue
-                    data["num_messages"][hour] += 1
-
-            await self.loop.run_in_executor(
-                None,
-                functools.partial(
-                    process_messages,
-                ),
-            )
+            hours = (events["ts"] // 3600 % 24).to_numpy(dtype=np.int64)
+            data = {"times": [i for i in range(0, 24)], "num_messages": np.bincount(hours, minlength=24)}
 
             df = pd.DataFrame(data)
             df = df.set_index("times")
@@ -1902,7 +1839,64 @@ class ActivityLogger(commands.Cog):
         }
 
         await self.config.guild(ctx.guild).corr_weights.set(new_corr_weights)
-        await ctx.send(info("New correlation weights saved."), delete_after=30)
+        if ctx.guild.id in self.cache:
+            self.cache[ctx.guild.id]["corr_weights"] = new_corr_weights
+        (await self.get_graph(ctx.guild)).corr_weights = new_corr_weights
+        await ctx.send(
+            info(
+                f"New correlation weights saved. They apply to new activity, use `{ctx.prefix}graphstats correlation rebuild` to recalculate past activity with them."
+            ),
+            delete_after=30,
+        )
+
+    @graphstats_corr.command(name="rebuild")
+    @checks.admin()
+    async def graphstats_correlation_rebuild(self, ctx):
+        """
+        Rebuild the correlation graph from this server's logs
+
+        The graph is kept up to date as members talk, this is only needed for activity from before it existed or after changing weights.
+        """
+        guild = ctx.guild
+        corr_weights = await self.config.guild(guild).corr_weights()
+        graph = corr.InteractionGraph(str(PATH / "correlation" / f"{guild.id}.npz"), corr_weights)
+
+        # remove audit log entries
+        log_files = glob.glob(os.path.join(PATH, str(guild.id), "*.log"))
+        log_files = [log for log in log_files if "guild" not in log]
+
+        # get log files split by channel, lines are streamed when processing
+        self.flush_handles()
+        channel_logs = self.split_log_files(log_files)
+
+        progress_msg_str = "Processed {}/{} channels."
+        progress_msg = await ctx.send(progress_msg_str.format(0, len(channel_logs)))
+        for progress_index, (ch_id, logs) in enumerate(channel_logs.items(), start=1):
+            channel = guild.get_channel(ch_id)
+            stream = self.log_stream(logs, guild.created_at)
+            # channel may be deleted, but still want to include message data
+            if isinstance(channel, discord.VoiceChannel):
+                process = functools.partial(corr.correlate_voice, stream, graph, ch_id)
+            else:
+                process = functools.partial(corr.correlate_text, stream, graph, ch_id)
+
+            await self.loop.run_in_executor(None, process)
+
+            try:
+                await progress_msg.edit(content=progress_msg_str.format(progress_index, len(channel_logs)))
+            except:
+                progress_msg = await ctx.send(progress_msg_str.format(progress_index, len(channel_logs)))
+
+        # keep tracking anyone currently in vc or mid conversation
+        old_graph = await self.get_graph(guild)
+        graph.windows = old_graph.windows
+        graph.joined_at = old_graph.joined_at
+        graph.dirty = True
+
+        self.graphs[guild.id] = graph
+        os.makedirs(PATH / "correlation", exist_ok=True)
+        await self.save_graph(graph)
+        await ctx.send(info("Correlation graph rebuilt."))
 
     @graphstats_corr.command(name="guild")
     async def graphstats_correlation_guild(self, ctx):
@@ -1917,172 +1911,14 @@ class ActivityLogger(commands.Cog):
         # edge weight is how many times someone replied with or has been in vc with someone else
         # each node is a person
         guild = ctx.guild
-        members = {m: i for i, m in enumerate(guild.members)}
-        adj_matrix = np.zeros((len(members), len(members)))
-        adj_matrix_voice = np.zeros((len(members), len(members)))
-
-        corr_weights = await self.config.guild(guild).corr_weights()
-
-        # remove audit log entries
-        log_files = glob.glob(os.path.join(PATH, str(guild.id), "*.log"))
-        log_files = [log for log in log_files if "guild" not in log]
-
-        # get messages split by channel
-        messages = await self.loop.run_in_executor(
-            None,
-            functools.partial(
-                self.log_handler,
-                log_files,
-                guild.created_at,
-                split_channels=True,
-            ),
-        )
-
-        async def process_messages():
-            progress_msg_str = "Processed {}/{} channels."
-            progress_msg = await ctx.send(progress_msg_str.format(0, len(messages)))
-            progress_index = 0
-            for ch_id, data in messages.items():
-                channel = guild.get_channel(ch_id)
-                # channel may be deleted, but still want to include message data
-                if isinstance(channel, discord.VoiceChannel):
-                    joined_at = {}
-                    # ignore for now, need to figure out how to filter out when the bot fails to log a user leaving
-                    for message in data:
-                        try:
-                            user_id = int(message.split("(id")[-1].split(")")[0].strip().strip(":"))
-                            user = guild.get_member(user_id)
-                            if not user:
-                                continue
-
-                            if "Voice channel join:" in message:
-                                join_time = parse_time_naive(message[:19])
-                                if join_time is None:
-                                    continue
-                                joined_at[user] = join_time
-                                # check others in VC to make sure a leave wasnt missed, 24 hours should be a fine time
-                                to_delete = []
-                                for other_user, join_time in joined_at.items():
-                                    time_in_vc = datetime.utcnow() - joined_at[user]
-                                    if time_in_vc > VOICE_TIME_LIMIT:
-                                        to_delete.append(other_user)
-                                for u in to_delete:
-                                    del joined_at[u]
-                            elif "Voice channel leave:" in message and user in joined_at:
-                                leave_time = parse_time_naive(message[:19])
-                                if leave_time is None:
-                                    continue
-                                time_in_vc = leave_time - joined_at[user]
-                                minutes = np.floor(time_in_vc.total_seconds() / 60)
-                                if len(joined_at) > 2:
-                                    corr_weight = (
-                                        corr_weights["vc_per_minute"]
-                                        * corr_weights["vc_people_multiplier"]
-                                        / (len(joined_at) - 2)
-                                    ) * minutes
-                                else:
-                                    corr_weight = corr_weights["vc_per_minute"] * minutes
-
-                                # add correlation data to everyone in the vc when someone leaves
-                                for other_user, join_time in joined_at.items():
-                                    if user == other_user:
-                                        continue
-                                    adj_matrix_voice[members[user], members[other_user]] += corr_weight
-                                    adj_matrix_voice[members[other_user], members[user]] += corr_weight
-
-                                del joined_at[user]
-                        except IndexError:
-                            pass
-                        except KeyError:  # happens if user rejoins after running this command
-                            pass
-                        except ValueError:
-                            pass
-                        await asyncio.sleep(0)
-                else:
-                    to_delete = []
-                    for message in data:
-                        # delete things like message edits
-                        if "edited message from" in message and "to read:" in message:
-                            to_delete.append(message)
-                        elif " deleted message from " in message:
-                            to_delete.append(message)
-                        await asyncio.sleep(0)
-
-                    for msg in to_delete:
-                        data.remove(msg)
-                        await asyncio.sleep(0)
-
-                    for i, message in enumerate(data):
-                        try:
-                            user1_id = int(message.split("(id:")[1].split(")")[0])
-                            user1 = guild.get_member(user1_id)
-                        except IndexError:
-                            pass
-                        except KeyError:
-                            pass
-                        if user1 is None:
-                            continue
-
-                        curr_msg_time = parse_time_naive(message[:19])
-                        if curr_msg_time is None:
-                            continue
-
-                        try:
-                            if "replied to" in message.split("(id:")[1].split("):")[0]:
-                                # add correlation to matrix
-                                user2_id = int(message.split("(id:")[2].split("):")[0])
-                                user2 = guild.get_member(user2_id)
-
-                                # don't care about people who arent in the server
-                                if not (user2 is None or user1 == user2):
-                                    adj_matrix[members[user1], members[user2]] += corr_weights["reply"]
-                                    adj_matrix[members[user2], members[user1]] += corr_weights["reply"]
-                                    continue
-                        except IndexError:
-                            pass
-                        except KeyError:  # happens if user rejoins after running this command
-                            pass
-                        except ValueError:
-                            pass
-
-                        # get messages around current message and add weights
-                        for j in range(max(i - 5, 0), i):
-                            try:
-                                prev_message = data[j]
-                                user2 = int(prev_message.split("(id:")[1].split(")")[0])
-                                user2 = guild.get_member(user2)
-                                if user2 is None:
-                                    continue
-
-                                if user1 == user2:
-                                    continue
-
-                                # filter out messages being too far away time wise
-                                prev_msg_time = parse_time_naive(prev_message[:19])
-                                if prev_msg_time is None or curr_msg_time - prev_msg_time > CORR_MSG_DELTA:
-                                    continue
-
-                                adj_matrix[members[user1], members[user2]] += corr_weights["messages"][j - i]
-                            except IndexError:
-                                pass
-                            except KeyError:  # happens if user rejoins after running this command
-                                pass
-                        await asyncio.sleep(0)
-
-                progress_index += 1
-                try:
-                    await progress_msg.edit(content=progress_msg_str.format(progress_index, len(messages)))
-                except:
-                    progress_msg = await ctx.send(progress_msg_str.format(0, len(messages)))
-
-        await process_messages()
+        graph = await self.get_graph(guild)
+        members = guild.members
 
         # define table save paths
         table_save_path = str(PATH / f"plot_data_{ctx.message.id}")
 
-        member_names = [m.name for m in members.keys()]
-        adj_matrix = pd.DataFrame(data=adj_matrix, index=member_names, columns=member_names)
-        adj_matrix_voice = pd.DataFrame(data=adj_matrix_voice, index=member_names, columns=member_names)
+        adj_matrix = graph.frame("text", members)
+        adj_matrix_voice = graph.frame("voice", members)
         adj_matrix_all = adj_matrix + adj_matrix_voice
 
         adj_matrix.to_csv(table_save_path + "_text.txt", index=True)
@@ -2119,174 +1955,13 @@ class ActivityLogger(commands.Cog):
         # edge weight is how many times someone replied with or has been in vc with someone else
         # each node is a person
         guild = ctx.guild
-        members = {m: i for i, m in enumerate(guild.members)}
-        adj_matrix = np.zeros((len(members), len(members)))
-        adj_matrix_voice = np.zeros((len(members), len(members)))
-
-        corr_weights = await self.config.guild(guild).corr_weights()
-
-        # remove audit log entries
-        log_files = glob.glob(os.path.join(PATH, str(guild.id), "*.log"))
-        log_files = [log for log in log_files if "guild" not in log]
-
-        # get messages split by channel
-        messages = await self.loop.run_in_executor(
-            None,
-            functools.partial(
-                self.log_handler,
-                log_files,
-                guild.created_at,
-                split_channels=True,
-            ),
-        )
-
-        async def process_messages():
-            progress_msg_str = "Processed {}/{} channels."
-            progress_msg = await ctx.send(progress_msg_str.format(0, len(messages)))
-            progress_index = 0
-            for ch_id, data in messages.items():
-                channel = guild.get_channel(ch_id)
-                # channel may be deleted, but still want to include message data
-                if isinstance(channel, discord.VoiceChannel):
-                    joined_at = {}
-                    # ignore for now, need to figure out how to filter out when the bot fails to log a user leaving
-                    for message in data:
-                        try:
-                            user_id = int(message.split("(id")[-1].split(")")[0].strip().strip(":"))
-                            user = guild.get_member(user_id)
-                            if not user:
-                                continue
-
-                            if "Voice channel join:" in message:
-                                join_time = parse_time_naive(message[:19])
-                                if join_time is None:
-                                    continue
-                                joined_at[user] = join_time
-                                # check others in VC to make sure a leave wasnt missed, 24 hours should be a fine time
-                                to_delete = []
-                                for other_user, join_time in joined_at.items():
-                                    time_in_vc = datetime.utcnow() - joined_at[user]
-                                    if time_in_vc > VOICE_TIME_LIMIT:
-                                        to_delete.append(other_user)
-                                for u in to_delete:
-                                    del joined_at[u]
-                            elif "Voice channel leave:" in message and user in joined_at:
-                                leave_time = parse_time_naive(message[:19])
-                                if leave_time is None:
-                                    continue
-                                time_in_vc = leave_time - joined_at[user]
-                                minutes = np.floor(time_in_vc.total_seconds() / 60)
-                                if len(joined_at) > 2:
-                                    corr_weight = (
-                                        corr_weights["vc_per_minute"]
-                                        * corr_weights["vc_people_multiplier"]
-                                        / (len(joined_at) - 2)
-                                    ) * minutes
-                                else:
-                                    corr_weight = corr_weights["vc_per_minute"] * minutes
-
-                                # add correlation data to everyone in the vc when someone leaves
-                                if user == member:
-                                    for other_user, join_time in joined_at.items():
-                                        if user == other_user:
-                                            continue
-                                        adj_matrix_voice[members[user], members[other_user]] += corr_weight
-                                        adj_matrix_voice[members[other_user], members[user]] += corr_weight
-                                else:
-                                    for other_user, join_time in joined_at.items():
-                                        if user == other_user or other_user != member:
-                                            continue
-                                        adj_matrix_voice[members[user], members[other_user]] += corr_weight
-                                        adj_matrix_voice[members[other_user], members[user]] += corr_weight
-
-                                del joined_at[user]
-                        except IndexError:
-                            pass
-                        except KeyError:  # happens if user rejoins after running this command
-                            pass
-                        except ValueError:
-                            pass
-                        await asyncio.sleep(0)
-                else:
-                    to_delete = []
-                    for message in data:
-                        # delete things like message edits
-                        if "edited message from" in message and "to read:" in message:
-                            to_delete.append(message)
-                        elif " deleted message from " in message:
-                            to_delete.append(message)
-                        await asyncio.sleep(0)
-
-                    for msg in to_delete:
-                        data.remove(msg)
-                        await asyncio.sleep(0)
-
-                    for i, message in enumerate(data):
-                        user1_id = int(message.split("(id:")[1].split(")")[0])
-                        user1 = guild.get_member(user1_id)
-                        if user1 is None:
-                            continue
-
-                        curr_msg_time = parse_time_naive(message[:19])
-                        if curr_msg_time is None:
-                            continue
-
-                        try:
-                            if "replied to" in message.split("(id:")[1].split("):")[0]:
-                                # add correlation to matrix
-                                user2_id = int(message.split("(id:")[2].split("):")[0])
-                                user2 = guild.get_member(user2_id)
-
-                                # don't care about people who arent in the server
-                                if not (user2 is None or user1 == user2) and (user1 == member or user2 == member):
-                                    adj_matrix[members[user1], members[user2]] += corr_weights["reply"]
-                                    adj_matrix[members[user2], members[user1]] += corr_weights["reply"]
-                                    continue
-                        except IndexError:
-                            pass
-                        except KeyError:  # happens if user rejoins after running this command
-                            pass
-                        except ValueError:
-                            pass
-                        await asyncio.sleep(0)
-                        # get messages around current message and add weights
-                        for j in range(max(i - 5, 0), i):
-                            try:
-                                prev_message = data[j]
-                                user2 = int(prev_message.split("(id:")[1].split(")")[0])
-                                user2 = guild.get_member(user2)
-                                if user2 is None:
-                                    continue
-
-                                if user1 == user2:
-                                    continue
-
-                                if user1 != member and user2 != member:
-                                    continue
-
-                                # filter out messages being too far away time wise
-                                prev_msg_time = parse_time_naive(prev_message[:19])
-                                if prev_msg_time is None or curr_msg_time - prev_msg_time > CORR_MSG_DELTA:
-                                    continue
-
-                                adj_matrix[members[user1], members[user2]] += corr_weights["messages"][j - i]
-                            except IndexError:
-                                pass
-                            except KeyError:  # happens if user rejoins after running this command
-                                pass
-                        await asyncio.sleep(0)
-
-                progress_index += 1
-                try:
-                    await progress_msg.edit(content=progress_msg_str.format(progress_index, len(messages)))
-                except:
-                    progress_msg = await ctx.send(progress_msg_str.format(0, len(messages)))
-
-        await process_messages()
+        graph = await self.get_graph(guild)
+        # only people who have interacted with the member can correlate with them
+        neighbours = graph.neighbours(member.id)
+        members = [member] + [m for m in guild.members if m.id in neighbours and m != member]
 
-        member_names = [m.name for m in members.keys()]
-        adj_matrix = pd.DataFrame(data=adj_matrix, index=member_names, columns=member_names)
-        adj_matrix_voice = pd.DataFrame(data=adj_matrix_voice, index=member_names, columns=member_names)
+        adj_matrix = graph.frame("text", members, focus=member.id)
+        adj_matrix_voice = graph.frame("voice", members, focus=member.id)
         adj_matrix_all = adj_matrix + adj_matrix_voice  # have to add first otherwise tables dont line up for addition
 
         # drop users who do not correlate to anyone else
@@ -2369,85 +2044,239 @@ class ActivityLogger(commands.Cog):
             )
         )
 
+    async def flush_logs(self):
+        """
+        Background job that writes out queued log lines every flush interval.
+        """
+        await self.bot.wait_until_ready()
+        while True:
+            await asyncio.sleep(self.cache.get("flush_interval", 5))
+            self.flush_handles()
+
+    def flush_handles(self):
+        """
+        write out queued lines for every open log file, so reads see everything logged so far
+        """
+        for handle in self.handles.values():
+            try:
+                handle.flush()
+            except Exception:
+                logger.exception(f"Failed to flush {handle.path}")
+
+    async def compact_logs(self):
+        """
+        Background job that parses log files from finished rotation periods once
+        into compact event arrays, so graphs never have to parse them again.
+        """
+        await self.bot.wait_until_ready()
+        while True:
+            for log in glob.glob(os.path.join(PATH, "*", "*.log")):
+                if not ev.is_closed(log) or ev.has_events_cache(log):
+                    continue
+
+                try:
+                    await self.loop.run_in_executor(None, functools.partial(ev.compact_log, log))
+                except Exception:
+                    logger.exception(f"Failed to compact {log}")
+
+            await asyncio.sleep(COMPACT_INTERVAL)
+
+    def get_pool(self):
+        """
+        Get the process pool for parsing log files, or None if it is turned off
+        """
+        workers = self.cache.get("workers", 2)
+        if workers <= 0:
+            return None
+
+        if self.pool is None:
+            self.pool = process_pool(workers)
+
+        return self.pool
+
+    async def load_events(self, log_files: list, end_time: datetime, start: datetime = None, user_id: int = None):
+        """
+        get events for log files as a dataframe, using compacted files where possible
+
+        with more than one file, they are parsed in parallel in the process pool.
+        """
+        self.flush_handles()
+        pool = self.get_pool()
+        if pool is None or len(log_files) < 2:
+            return await self.loop.run_in_executor(
+                None, functools.partial(ev.read_events, log_files, end_time, start=start, user_id=user_id)
+            )
+
+        results = await asyncio.gather(
+            *(
+                self.loop.run_in_executor(
+                    pool, functools.partial(ev.pool_read_event_array, log, end_time, start, user_id)
+                )
+                for log in sorted(log_files)
+            )
+        )
+        for log, (_, tail) in zip(sorted(log_files), results):
+            if tail is not None:
+                await self.loop.run_in_executor(None, functools.partial(save_index_tail, log, *tail))
+
+        return ev.events_frame([events for events, _ in results])
+
     @staticmethod
-    def log_handler(log_files: list, end_time: datetime, start: datetime = None, split_channels: bool = False):
+    def split_counts(events, times: list, keys: list, column: str = "channel"):
+        """
+        count events for every split time and key (channels by default)
+
+        returns a dataframe with a times column and a column per key.
         """
-        gets messages up to a specified end time, with optional start time.
+        events = events[events[column].isin(keys)]
+        buckets = ev.bucket_index(times, events)
+        in_range = buckets >= 0
+        counts = pd.crosstab(buckets[in_range], events[column].to_numpy(dtype=np.int64)[in_range])
+        counts = counts.reindex(index=range(len(times)), columns=keys, fill_value=0)
+        counts.columns.name = None
+        counts.insert(0, "times", times)
 
-        returns a list of messages.
+        return counts.reset_index(drop=True)
 
-        if the split_channels is true, returns a dictionary of
-        channel ids -> messages
+    @staticmethod
+    def log_stream(log_files: list, end_time: datetime, start: datetime = None, user_id: int = None):
         """
-        if split_channels:
-            messages = {}
-        else:
-            messages = []
+        lazily yields messages up to a specified end time, with optional start time.
 
-        parsed_logs = []
-        log_files.sort(reverse=True)
+        files are read oldest first, one line at a time, so lines come out in order
+        without ever holding more than one of them.
 
+        if user_id is given, only lines mentioning that user are yielded.
+        """
+        cutoff = calendar.timegm(end_time.timetuple()) if end_time else None
+        for log in sorted(log_files):
+            # nothing in a file last written before the cutoff can be in range, don't even open it
+            if cutoff is not None and os.path.getmtime(log) < cutoff:
+                continue
+
+            yield from iter_log_range(log, end_time, start=start, user_id=user_id)
+
+    @staticmethod
+    def split_log_files(log_files: list) -> dict:
+        """
+        groups channel log files by channel id
+        """
+        channel_logs = {}
         for log in log_files:
-            if split_channels:
-                channel_id = int(log.split("_")[-1].strip(".log"))
-                if channel_id not in messages:
-                    messages[channel_id] = []
-            with open(log, "r") as f:
-                lines = f.readlines()
-
-            # binary search to find where the cutoff for messages is
-            index = bisect_left(lines, end_time.strftime(TIMESTAMP_FORMAT))
-
-            lines = lines[index:]
-            lines.reverse()
-            if split_channels:
-                messages[channel_id].extend(lines)
-            else:
-                messages.extend(lines)
+            channel_logs.setdefault(int(log_file_key(log)), []).append(log)
 
-        # reverse messages to get correct order
-        if split_channels:
-            for ch_id in messages.keys():
-                messages[ch_id].reverse()
-        else:
-            messages.reverse()
+        return channel_logs
 
-        return messages
+    @staticmethod
+    def write_log_chunk(stream, path: str) -> int:
+        """
+        writes the next MAX_LINES lines of a log stream to a file, returns how many were written
+        """
+        count = 0
+        with open(path, encoding="utf-8", mode="w") as f:
+            for line in itertools.islice(stream, MAX_LINES):
+                f.write(line)
+                count += 1
 
-    async def log_sender(self, ctx, log_files, end_time, user=None, start=None):
-        log_path = os.path.join(PATH, str(ctx.guild.id))
+        return count
 
-        await ctx.send(warning("**__Generating logs, please wait...__**"))
-        # runs in descending order, with most recent log file first
-        messages = await self.loop.run_in_executor(
-            None,
-            functools.partial(
-                self.log_handler,
-                log_files,
-                end_time,
-                start=start,
-            ),
-        )
+    async def stream_chunks(self, stream, size: int = MAX_LINES):
+        """
+        pulls lines off a log stream in chunks, reading them in the executor so the loop isn't blocked
+        """
+        while True:
+            chunk = await self.loop.run_in_executor(None, functools.partial(list, itertools.islice(stream, size)))
+            if not chunk:
+                return
 
-        if user:
-            messages = [message for message in messages if str(user.id) in message]
+            yield chunk
 
-        message_chunks = [
-            messages[i * MAX_LINES : (i + 1) * MAX_LINES] for i in range((len(messages) + MAX_LINES - 1) // MAX_LINES)
-        ]
+    async def pool_chunks(
+        self,
+        pool,
+        log_files: list,
+        end_time: datetime,
+        start: datetime = None,
+        user_id: int = None,
+        size: int = MAX_LINES,
+    ):
+        """
+        finds the lines to send from log files in the process pool and yields them in chunks, oldest file first
 
-        if not message_chunks:
+        workers only send back line offsets, the lines themselves are read here one chunk at a time,
+        and only as many files as there are workers are looked up ahead.
+        """
+        cutoff = calendar.timegm(end_time.timetuple()) if end_time else None
+        # nothing in a file last written before the cutoff can be in range, don't even open it
+        log_files = iter([log for log in sorted(log_files) if cutoff is None or os.path.getmtime(log) >= cutoff])
+
+        pending = collections.deque()
+
+        def submit():
+            log = next(log_files, None)
+            if log is not None:
+                pending.append(
+                    (
+                        log,
+                        self.loop.run_in_executor(pool, functools.partial(log_offsets, log, end_time, start, user_id)),
+                    )
+                )
+
+        for _ in range(self.cache.get("workers", 2)):
+            submit()
+
+        chunk = []
+        while pending:
+            log, future = pending.popleft()
+            offsets, *tail = await future
+            # keep the workers busy while this file is read
+            submit()
+            await self.loop.run_in_executor(None, functools.partial(save_index_tail, log, *tail))
+
+            stream = iter_log_offsets(log, offsets)
+            while True:
+                lines = await self.loop.run_in_executor(
+                    None, functools.partial(list, itertools.islice(stream, size - len(chunk)))
+                )
+                if not lines:
+                    break
+
+                chunk.extend(lines)
+                if len(chunk) >= size:
+                    yield chunk
+                    chunk = []
+
+        if chunk:
+            yield chunk
+
+    async def log_sender(self, ctx, log_files, end_time, user=None, start=None):
+        log_path = os.path.join(PATH, str(ctx.guild.id))
+
+        if not log_files:
             await ctx.send(error("No logs found for the specified location and time period!"))
             return
 
-        for msgs in message_chunks:
-            temp_file = os.path.join(log_path, datetime.utcnow().strftime("%Y%m%d%X").replace(":", "") + ".txt")
-            with open(temp_file, encoding="utf-8", mode="w") as f:
-                f.writelines(msgs)
+        await ctx.send(warning("**__Generating logs, please wait...__**"))
+        self.flush_handles()
+        user_id = user.id if user else None
+        pool = self.get_pool()
+        # runs in ascending order, oldest log file first
+        if pool is None or len(log_files) < 2:
+            chunks = self.stream_chunks(self.log_stream(log_files, end_time, start=start, user_id=user_id))
+        else:
+            chunks = self.pool_chunks(pool, log_files, end_time, start=start, user_id=user_id)
 
+        sent = False
+        async for chunk in chunks:
+            temp_file = os.path.join(log_path, datetime.utcnow().strftime("%Y%m%d%X").replace(":", "") + ".txt")
+            await self.loop.run_in_executor(None, functools.partial(self.write_log_chunk, iter(chunk), temp_file))
             await ctx.channel.send(file=discord.File(temp_file))
+            sent = True
             os.remove(temp_file)
 
+        if not sent:
+            await ctx.send(error("No logs found for the specified location and time period!"))
+
     @commands.group(aliases=["log"])
     @commands.guild_only()
     @checks.admin_or_permissions(administrator=True)
@@ -2931,6 +2760,59 @@ class ActivityLogger(commands.Cog):
         else:
             await ctx.send("Downloading of attachments is disabled.")
 
+    @logset.command(name="attachmentlimits")
+    async def set_attachment_limits(self, ctx, max_size_mb: int = None, quota_mb: int = None):
+        """
+        Show or set limits on downloaded attachments
+
+        `max_size_mb` is the largest attachment that will be saved, `quota_mb` is how much each server can store in total.
+        0 means no limit. Repeated files are linked to the first copy and don't count towards the quota.
+        """
+        if max_size_mb is not None:
+            if max_size_mb < 0 or (quota_mb is not None and quota_mb < 0):
+                await ctx.send(error("Limits must be 0 or more."))
+                return
+
+            async with self.config.attrs() as attrs:
+                attrs["attachment_max_size"] = max_size_mb
+                if quota_mb is not None:
+                    attrs["attachment_quota"] = quota_mb
+            self.cache["attachment_max_size"] = max_size_mb
+            if quota_mb is not None:
+                self.cache["attachment_quota"] = quota_mb
+
+        max_size = self.cache["attachment_max_size"]
+        quota = self.cache["attachment_quota"]
+        msg = "Max attachment size: {}\n".format(f"{max_size} MB" if max_size else "no limit")
+        msg += "Quota per server: {}".format(f"{quota} MB" if quota else "no limit")
+        if ctx.guild:
+            msg += "\nUsed by this server: {:.2f} MB".format(self.attachment_store.used(ctx.guild.id) / 1024 / 1024)
+        await ctx.send(box(msg))
+
+    @logset.command(name="downloads")
+    async def set_downloads(self, ctx, per_server: int = None):
+        """
+        Show or set how many attachments are downloaded at once per server
+
+        Also shows the download queue.
+        """
+        if per_server is not None:
+            if per_server <= 0:
+                await ctx.send(error("Must download at least 1 attachment at a time."))
+                return
+
+            async with self.config.attrs() as attrs:
+                attrs["guild_downloads"] = per_server
+            self.cache["guild_downloads"] = per_server
+            # downloads already queued keep the old limit
+            self.guild_download_limits = {}
+
+        store = self.attachment_store
+        msg = f"Downloads per server: {self.cache['guild_downloads']}\n"
+        msg += f"Pending downloads: {len(self.downloads)}/{MAX_PENDING_DOWNLOADS}\n"
+        msg += f"Saved since load: {store.saved}, linked to existing copies: {store.linked}"
+        await ctx.send(box(msg))
+
     @logset.command(name="channel")
     @commands.guild_only()
     async def set_channel(self, ctx, on_off: bool, channel: discord.TextChannel = None):
@@ -3065,6 +2947,167 @@ class ActivityLogger(commands.Cog):
 
             await ctx.send("Log rotation period is %s %s." % (adj, desc))
 
+    @logset.command(name="flush")
+    async def set_flush(self, ctx, size_kb: int = None, interval: float = None):
+        """
+        Show or set how log lines are batched before being written to disk
+
+        Lines are queued per log file and written once `size_kb` kilobytes are queued,
+        or every `interval` seconds, whichever comes first.
+        Set `size_kb` to 0 to write every line as soon as it is logged.
+        """
+        if size_kb is not None:
+            if size_kb < 0 or (interval is not None and interval <= 0):
+                await ctx.send(error("Size must be 0 or more and interval must be greater than 0."))
+                return
+
+            async with self.config.attrs() as attrs:
+                attrs["flush_size"] = size_kb * 1024
+                if interval is not None:
+                    attrs["flush_interval"] = interval
+            self.cache["flush_size"] = size_kb * 1024
+            if interval is not None:
+                self.cache["flush_interval"] = interval
+
+            for handle in self.handles.values():
+                handle.flush_size = self.cache["flush_size"]
+
+        await ctx.send(
+            "Log lines are written every {} KB or {} seconds.".format(
+                self.cache["flush_size"] // 1024, self.cache["flush_interval"]
+            )
+        )
+
+    @logset.command(name="fsync")
+    async def set_fsync(self, ctx, on_off: bool = None):
+        """
+        Set whether to fsync log files every time queued lines are written
+
+        Safer if the machine loses power, but slower on busy bots.
+        """
+        if on_off is not None:
+            async with self.config.attrs() as attrs:
+                attrs["fsync"] = on_off
+            self.cache["fsync"] = on_off
+
+            for handle in self.handles.values():
+                handle.fsync = on_off
+
+        if self.cache["fsync"]:
+            await ctx.send("Log files are fsynced on every write.")
+        else:
+            await ctx.send("Log files are not fsynced.")
+
+    @logset.command(name="statsinterval")
+    async def set_stats_interval(self, ctx, seconds: int = None):
+        """
+        Show or set how often member message stats are saved
+
+        Stats are counted in memory and saved in batches, this is the most that will be lost if the bot crashes.
+        """
+        if seconds is not None:
+            if seconds <= 0:
+                await ctx.send(error("Interval must be greater than 0."))
+                return
+
+            async with self.config.attrs() as attrs:
+                attrs["stats_interval"] = seconds
+            self.cache["stats_interval"] = seconds
+
+        await ctx.send(
+            "Member stats are saved every {} seconds, {} members have unsaved stats.".format(
+                self.cache["stats_interval"], len(self.member_stats)
+            )
+        )
+
+    @logset.command(name="workers")
+    async def set_workers(self, ctx, workers: int = None):
+        """
+        Show or set how many processes parse log files in parallel
+
+        Used for graphs and logs that span more than one log file. Keep this below the number of CPU cores so the bot stays responsive.
+        Set to 0 to parse everything in a single thread.
+        """
+        if workers is not None:
+            if workers < 0 or workers > (os.cpu_count() or 1):
+                await ctx.send(error(f"Workers must be between 0 and {os.cpu_count() or 1}."))
+                return
+
+            async with self.config.attrs() as attrs:
+                attrs["workers"] = workers
+            self.cache["workers"] = workers
+
+            # restart the pool with the new size next time it is used
+            if self.pool:
+                self.pool.shutdown(wait=False)
+                self.pool = None
+
+        if self.cache["workers"]:
+            await ctx.send(f"Log files are parsed by up to {self.cache['workers']} processes.")
+        else:
+            await ctx.send("Log files are parsed in a single thread.")
+
+    @logset.command(name="replies")
+    async def set_replies(self, ctx, fetch: bool = None):
+        """
+        Show or set whether replied to messages can be fetched from discord
+
+        Replies are first resolved from messages the bot already has, turn fetching off to skip the api under heavy load.
+        Replies that can't be resolved are logged as normal messages.
+        """
+        if fetch is not None:
+            async with self.config.attrs() as attrs:
+                attrs["fetch_replies"] = fetch
+            self.cache["fetch_replies"] = fetch
+
+        stats = self.reply_stats
+        total = sum(stats.values())
+        msg = "Fetching replied to messages is {}.\n".format("enabled" if self.cache["fetch_replies"] else "disabled")
+        msg += f"Replies logged: {total}\n"
+        for source in ("resolved", "bot cache", "recent", "fetched", "miss"):
+            msg += f"{source}: {stats[source]}\n"
+        await ctx.send(box(msg))
+
+    @logset.command(name="handles")
+    async def set_handles(self, ctx, capacity: int = None):
+        """
+        Show or set how many log files can be kept open at once
+
+        When more are needed, the least recently written one is closed.
+        If evictions keep going up, raise this, keeping it under the OS open file limit.
+        """
+        if capacity is not None:
+            if capacity <= 0:
+                await ctx.send(error("Must keep at least 1 log file open."))
+                return
+
+            async with self.config.attrs() as attrs:
+                attrs["max_handles"] = capacity
+            self.cache["max_handles"] = capacity
+            self.handles.resize(capacity)
+
+        pool = self.handles
+        msg = f"Open handles: {len(pool)}/{pool.capacity}\n"
+        msg += f"Hit rate: {pool.hit_rate:.2%} ({pool.hits} hits, {pool.misses} misses)\n"
+        msg += f"Evictions: {pool.evictions}\n"
+        msg += f"Reopened after file was deleted: {pool.stale}"
+        await ctx.send(box(msg))
+
+    @logset.command(name="writestats")
+    async def write_stats_cmd(self, ctx):
+        """
+        Show log write queue statistics
+        """
+        stats = self.write_stats
+        queued = sum(handle.queued_bytes for handle in self.handles.values())
+        queued_lines = sum(len(handle.queue) for handle in self.handles.values())
+
+        msg = f"Lines logged: {stats.lines}\n"
+        msg += f"Queued: {queued_lines} lines, {queued} bytes\n"
+        msg += f"Flushes: {stats.flushes}, {stats.flushed_bytes} bytes written\n"
+        msg += f"Flush latency: {stats.avg_flush_time * 1000:.2f} ms avg, {stats.max_flush_time * 1000:.2f} ms max"
+        await ctx.send(box(msg))
+
     @staticmethod
     def format_rotation_string(timestamp, rotation_code, filename=None):
         kwargs = dict(hour=0, minute=0, second=0, microsecond=0)
@@ -3129,37 +3172,24 @@ class ActivityLogger(commands.Cog):
 
     def gethandle(self, path, mode="a"):
         """Manages logfile handles, culling stale ones and creating folders"""
-        if path in self.handles:
-            if os.path.exists(path):
-                return self.handles[path]
-            else:  # file was deleted?
-                try:  # try to close, no guarantees tho
-                    self.handles[path].close()
-                except Exception:
-                    pass
-
-                del self.handles[path]
-                return self.gethandle(path, mode)
-        else:
-            # Clean up excess handles before creating a new one
-            if len(self.handles) >= 256:
-                chrono = sorted(self.handles.items(), key=lambda x: x[1].time)
-                oldest_path, oldest_handle = chrono[0]
-                oldest_handle.close()
-                del self.handles[oldest_path]
-
-            dirname, _ = os.path.split(path)
-
-            try:
-                if not os.path.exists(dirname):
-                    os.makedirs(dirname)
+        handle = self.handles.get(path)
+        if handle is not None:
+            return handle
 
-                handle = LogHandle(path, mode=mode)
-            except Exception:
-                raise
+        dirname, _ = os.path.split(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
 
-            self.handles[path] = handle
-            return handle
+        handle = LogHandle(
+            path,
+            mode=mode,
+            flush_size=self.cache["flush_size"],
+            fsync=self.cache["fsync"],
+            stats=self.write_stats,
+        )
+        # evicts the least recently used handle if the pool is full
+        self.handles.add(path, handle)
+        return handle
 
     def should_log(self, location):
         if not self.cache:
@@ -3211,16 +3241,109 @@ class ActivityLogger(commands.Cog):
         filename = str(aid) + "_" + aname
 
         if len(filename) > 255:
-            target_len = 255 - len(aid) - 4
+            target_len = 255 - len(str(aid)) - 4
             part_a = target_len // 2
             part_b = target_len - part_a
-            filename = aid + "_" + aname[:part_a] + "..." + aname[-part_b:]
+            filename = str(aid) + "_" + aname[:part_a] + "..." + aname[-part_b:]
             truncated = True
         else:
             truncated = False
 
         return aid, url, path, filename, truncated
 
+    def queue_download(self, message, attachment, path: str, filename: str) -> str:
+        """
+        Queue an attachment to be downloaded in the background
+
+        Returns the status to log with the message, the download itself logs only if it fails.
+        """
+        key = message.guild.id if message.guild else "direct"
+        max_size = self.cache.get("attachment_max_size", 0)
+        quota = self.cache.get("attachment_quota", 0)
+
+        if max_size and attachment.size > max_size * 1024 * 1024:
+            return "too large, not saved"
+        if quota and self.attachment_store.used(key) + attachment.size > quota * 1024 * 1024:
+            return "quota reached, not saved"
+        if len(self.downloads) >= MAX_PENDING_DOWNLOADS:
+            return "download queue full, not saved"
+
+        task = asyncio.create_task(self.download_attachment(message, attachment, path, filename, key))
+        self.downloads.add(task)
+        task.add_done_callback(self.downloads.discard)
+        return "pending"
+
+    async def download_attachment(self, message, attachment, path: str, filename: str, key):
+        """
+        Download an attachment, hardlinking it if the same file was already saved
+        """
+        limit = self.guild_download_limits.get(key)
+        if limit is None:
+            limit = self.guild_download_limits[key] = asyncio.Semaphore(self.cache.get("guild_downloads", 2))
+
+        dl_path = os.path.join(path, filename)
+        async with limit, self.download_limit:
+            if os.path.exists(dl_path):
+                return
+
+            try:
+                data = await attachment.read()
+                os.makedirs(path, exist_ok=True)
+                await self.loop.run_in_executor(
+                    None, functools.partial(self.attachment_store.store, data, dl_path, key)
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Failed to save attachment {dl_path}: {e}")
+                await self.log(message.channel, f"Attachment download failed: {filename} ({e})", force=True)
+
+    def remember_message(self, message):
+        """
+        Keep a logged message around so replies to it don't have to be fetched
+        """
+        self.recent_messages[message.id] = message
+        if len(self.recent_messages) > RECENT_MESSAGES:
+            self.recent_messages.popitem(last=False)
+
+    async def resolve_reply(self, message):
+        """
+        Find the message a reply is replying to, trying the cheapest places first:
+        the reference itself, the bot's message cache, recently logged messages, and then the api.
+        """
+        ref = message.reference
+        if isinstance(ref.resolved, discord.Message):
+            self.reply_stats["resolved"] += 1
+            return ref.resolved
+
+        ref_message = self.bot._connection._get_message(ref.message_id)
+        if ref_message:
+            self.reply_stats["bot cache"] += 1
+            return ref_message
+
+        ref_message = self.recent_messages.get(ref.message_id)
+        if ref_message:
+            self.reply_stats["recent"] += 1
+            return ref_message
+
+        ref_channel = message.guild.get_channel(ref.channel_id)
+        now = time.monotonic()
+        # only allow REPLY_FETCH_RATE fetches in the last period
+        rate_limited = len(self.reply_fetches) == REPLY_FETCH_RATE and now - self.reply_fetches[0] < REPLY_FETCH_PERIOD
+        if ref_channel is None or not self.cache.get("fetch_replies", True) or rate_limited:
+            self.reply_stats["miss"] += 1
+            return None
+
+        self.reply_fetches.append(now)
+        try:
+            ref_message = await ref_channel.fetch_message(ref.message_id)
+        except discord.HTTPException:
+            self.reply_stats["miss"] += 1
+            return None
+
+        self.reply_stats["fetched"] += 1
+        return ref_message
+
     async def log(self, location, text, timestamp=None, force=False, subfolder=None, mode="a"):
         if not timestamp:
             timestamp = datetime.utcnow()
@@ -3260,28 +3383,28 @@ class ActivityLogger(commands.Cog):
     async def message_handler(self, message, *args, force_attachments=None, **kwargs):
         dl_attachment = self.should_download(message)
         attachments = []
+        reply_to = None
 
         if force_attachments is not None:
             dl_attachment = force_attachments
 
         if message.attachments and dl_attachment:
             for a in message.attachments:
-                attachments += [self.process_attachment(message, a)]
+                aid, url, path, filename, truncated = self.process_attachment(message, a)
+                # downloads run in the background, the log line only says whether one was queued
+                status = self.queue_download(message, a, path, filename)
+                attachments.append(f"{filename}{' (filename truncated)' if truncated else ''} ({status})")
 
-            entry = DOWNLOAD_TEMPLATE.format(
-                message, [a[3] + " (filename truncated)" if a[4] else a[3] for a in attachments]
-            )
+            entry = DOWNLOAD_TEMPLATE.format(message, attachments)
 
         elif message.attachments:
             urls = ",".join(a.url for a in message.attachments)
             entry = ATTACHMENT_TEMPLATE.format(message, urls)
         else:
-            if message.reference:
-                ref_channel = message.guild.get_channel(message.reference.channel_id)
-                ref_message = None
-                if ref_channel:
-                    ref_message = await ref_channel.fetch_message(message.reference.message_id)
+            if message.reference and message.guild:
+                ref_message = await self.resolve_reply(message)
                 if ref_message:
+                    reply_to = ref_message.author.id
                     entry = REPLY_TEMPLATE.format(message, ref_message)
                 else:
                     entry = MESSAGE_TEMPLATE.format(message)
@@ -3290,33 +3413,21 @@ class ActivityLogger(commands.Cog):
 
         # don't calculate bot stats and make sure this isnt dm message
         if message.author.id != self.bot.user.id and isinstance(message.author, discord.Member):
-            is_bot_msg = False
-            async with self.config.member(message.author).stats() as stats:
-                stats["total_msg"] += 1
-                if len(message.content) > 0:
-                    for prefix in self.cache[message.guild.id]["prefixes"]:
-                        if prefix == message.content[: len(prefix)]:
-                            stats["bot_cmd"] += 1
-                            is_bot_msg = True
-                            break
-                    if not is_bot_msg:
-                        stats["avg_len"] += len(message.content.split(" "))
-
-        if message.attachments and dl_attachment:
-            for i, data in enumerate(attachments):
-                aid, url, path, filename, truncated = data
-                if not os.path.exists(path):
-                    os.mkdir(path)
-
-                dl_path = os.path.join(path, filename)
-                if not os.path.exists(dl_path):
-                    try:
-                        await message.attachments[i].save(dl_path)
-                    except:
-                        entry += f" (file: {filename} failed to save)"
+            self.count_message(message)
+
+        if isinstance(message.author, discord.Member) and self.should_log(message.channel):
+            (await self.get_graph(message.guild)).add_message(
+                message.channel.id,
+                message.author.id,
+                calendar.timegm(message.created_at.timetuple()),
+                reply_to=reply_to,
+            )
 
         await self.log(message.channel, entry, message.created_at, *args, **kwargs)
 
+        if message.guild and self.should_log(message.channel):
+            self.remember_message(message)
+
     # Listeners
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -3593,6 +3704,7 @@ class ActivityLogger(commands.Cog):
         if await self.bot.cog_disabled_in_guild(self, member.guild):
             return
         if not self.should_log(member.guild):
+            self.member_stats.pop((member.guild.id, member.id), None)
             await self.config.member(member).clear()
             return
 
@@ -3615,6 +3727,7 @@ class ActivityLogger(commands.Cog):
         if self.bot.get_cog("Welcome"):
             await asyncio.sleep(1)
 
+        self.member_stats.pop((member.guild.id, member.id), None)
         await self.config.member(member).clear()
         await self.log(member.guild, entry)
 
@@ -3884,6 +3997,8 @@ class ActivityLogger(commands.Cog):
                         stats["vc_time_sec"] += time.time() - stats["last_vc_time"]
                         stats["last_vc_time"] = None
 
+                (await self.get_graph(member.guild)).voice_leave(before.channel.id, member.id, int(time.time()))
+
                 if after.channel:
                     msg += " moving to {1.channel}"
 
@@ -3895,6 +4010,8 @@ class ActivityLogger(commands.Cog):
                 async with self.config.member(member).stats() as stats:
                     stats["last_vc_time"] = time.time()
 
+                (await self.get_graph(member.guild)).voice_join(after.channel.id, member.id, int(time.time()))
+
                 if before.channel:
                     msg += ", moved from {1.channel}"
 
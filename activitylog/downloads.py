@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import os
+import json
+import hashlib
+import threading
+
+
+class AttachmentStore:
+    """
+    Keeps track of downloaded attachments by content hash, so the same file
+    posted again (in any channel) is hardlinked to the first copy instead of saved twice.
+
+    Also tracks how many bytes each guild has stored, for quotas. Hardlinked repeats don't count.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # {sha256 hex digest: path of the first saved copy}
+        self.hashes = {}
+        # {guild id or "direct": bytes stored}
+        self.usage = {}
+        self.saved = 0
+        self.linked = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> "AttachmentStore":
+        store = cls(path)
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return store
+
+        store.hashes = data.get("hashes", {})
+        store.usage = data.get("usage", {})
+        return store
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        with self.lock:
+            data = json.dumps({"hashes": self.hashes, "usage": self.usage})
+            self.dirty = False
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def used(self, key) -> int:
+        return self.usage.get(str(key), 0)
+
+    def store(self, data: bytes, dl_path: str, key) -> bool:
+        """
+        save downloaded attachment data to dl_path, returns True if it was hardlinked to an existing copy
+
+        runs in the executor, so it can be called from several threads at once.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            existing = self.hashes.get(digest)
+
+        if existing and existing != dl_path and os.path.exists(existing):
+            try:
+                os.link(existing, dl_path)
+                with self.lock:
+                    self.linked += 1
+                return True
+            except OSError:  # different filesystem, or links not supported
+                pass
+
+        tmp_path = dl_path + ".part"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, dl_path)
+
+        with self.lock:
+            self.hashes[digest] = dl_path
+            self.usage[str(key)] = self.usage.get(str(key), 0) + len(data)
+            self.saved += 1
+            self.dirty = True
+
+        return False
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import re
+import os
+import calendar
+from datetime import datetime as dt
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+from .utils import iter_log_range, log_file_key, parse_line_time, scan_index
+
+# matches both "(id:1234)" and "(id 1234)" styles used in the log templates
+ID_RE = re.compile(r"\(id[: ](\d+)\)")
+# rotated log files look like 20180701--P1M_1234.log
+ROTATION_RE = re.compile(r"^(\d{8})--P(1D|7D|1M|1Y)_")
+ROTATION_PERIODS = {
+    "1D": relativedelta(days=1),
+    "7D": relativedelta(weeks=1),
+    "1M": relativedelta(months=1),
+    "1Y": relativedelta(years=1),
+}
+
+EVENTS_EXT = ".events.npy"
+
+# event kinds
+OTHER = 0
+MESSAGE = 1
+REPLY = 2
+ATTACHMENT = 3
+EDIT = 4
+DELETE = 5
+VOICE_JOIN = 6
+VOICE_LEAVE = 7
+MEMBER_JOIN = 8
+MEMBER_LEAVE = 9
+
+MESSAGE_KINDS = (MESSAGE, REPLY, ATTACHMENT)
+
+# one row per log line, channel is 0 for guild logs.
+# length is the number of words in messages, 0 for everything else
+EVENT_DTYPE = np.dtype(
+    [("ts", "<i8"), ("channel", "<u8"), ("author", "<u8"), ("target", "<u8"), ("kind", "u1"), ("length", "<u4")]
+)
+
+
+def parse_event(line: str, channel: int, last_ts: int = 0) -> tuple:
+    """
+    turn a raw log line into an event row
+
+    the author is the first id on the line and the target the second, ids past those can come from message content.
+    """
+    ts = parse_line_time(line, last_ts)
+    ids = ID_RE.findall(line)
+    author = int(ids[0]) if ids else 0
+    target = int(ids[1]) if len(ids) > 1 else 0
+    length = 0
+
+    if "Voice channel join:" in line:
+        kind = VOICE_JOIN
+    elif "Voice channel leave:" in line:
+        kind = VOICE_LEAVE
+    elif "Member join:" in line:
+        kind = MEMBER_JOIN
+    elif "Member leave:" in line:
+        kind = MEMBER_LEAVE
+    elif "edited message from" in line and "to read:" in line:
+        kind = EDIT
+    elif " deleted message from " in line:
+        kind = DELETE
+    elif "(id:" in line:
+        head, _, content = line.partition("):")
+        if "replied to" in head:
+            kind = REPLY
+            content = content.partition("[with]:")[2] or content
+        elif "(attachment url(s):" in content or "(attachment(s) " in content:
+            kind = ATTACHMENT
+        else:
+            kind = MESSAGE
+        length = len(content.strip().split(" "))
+    else:
+        kind = OTHER
+
+    return (ts, channel, author, target, kind, length)
+
+
+def parse_events(
+    path: str,
+    end_time: dt = None,
+    start: dt = None,
+    user_id: int = None,
+    persist: bool = True,
+    index: np.ndarray = None,
+) -> np.ndarray:
+    """parse the lines of a log file in range into an event array"""
+    key = log_file_key(path)
+    channel = int(key) if key.isdigit() else 0
+
+    rows = []
+    last_ts = 0
+    for line in iter_log_range(path, end_time, start=start, user_id=user_id, persist=persist, index=index):
+        row = parse_event(line, channel, last_ts)
+        last_ts = row[0]
+        rows.append(row)
+
+    events = np.array(rows, dtype=EVENT_DTYPE)
+    if user_id is not None:
+        # lines mentioning the user anywhere were read, keep the same events a compacted file would give
+        events = events[involves(events, user_id)]
+    return events
+
+
+def involves(events: np.ndarray, user_id: int) -> np.ndarray:
+    """mask of events authored by or targeting a user"""
+    return (events["author"] == user_id) | (events["target"] == user_id)
+
+
+def is_closed(path: str, now: dt = None) -> bool:
+    """whether a log file belongs to a rotation period that has ended, and so won't be written to again"""
+    match = ROTATION_RE.match(os.path.basename(path))
+    if not match:
+        return False
+
+    period_start = dt.strptime(match.group(1), "%Y%m%d")
+    return period_start + ROTATION_PERIODS[match.group(2)] <= (now or dt.utcnow())
+
+
+def has_events_cache(path: str) -> bool:
+    """whether a log file has an up to date compacted copy"""
+    try:
+        return os.path.getmtime(path + EVENTS_EXT) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+
+def compact_log(path: str):
+    """parse a whole log file once and save the events next to it"""
+    events = parse_events(path)
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, events)
+    os.replace(tmp_path, path + EVENTS_EXT)
+
+
+def read_event_array(
+    log: str, end_time: dt = None, start: dt = None, user_id: int = None, persist: bool = True
+) -> np.ndarray:
+    """get events in range from a single log file, loading its compacted copy if there is one"""
+    lo = calendar.timegm(end_time.timetuple()) if end_time else None
+    hi = calendar.timegm(start.timetuple()) if start else None
+
+    # nothing in a file last written before the cutoff can be in range, don't even open it
+    if lo is not None and os.path.getmtime(log) < lo:
+        return np.empty(0, dtype=EVENT_DTYPE)
+
+    if not has_events_cache(log):
+        return parse_events(log, end_time, start=start, user_id=user_id, persist=persist)
+
+    events = np.load(log + EVENTS_EXT, mmap_mode="r")
+    mask = np.ones(len(events), dtype=bool)
+    if lo is not None:
+        mask &= events["ts"] >= lo
+    if hi is not None:
+        mask &= events["ts"] <= hi
+    if user_id is not None:
+        mask &= involves(events, user_id)
+
+    return np.asarray(events[mask])
+
+
+def pool_read_event_array(log: str, end_time: dt = None, start: dt = None, user_id: int = None) -> tuple:
+    """
+    read_event_array for a worker process, which must not write to the sidecar index.
+
+    returns (events, index tail), the tail is None or what utils.save_index_tail needs to save
+    the records scanned here from the bot's process.
+    """
+    lo = calendar.timegm(end_time.timetuple()) if end_time else None
+    if has_events_cache(log) or (lo is not None and os.path.getmtime(log) < lo):
+        return read_event_array(log, end_time, start, user_id), None
+
+    index, tail, indexed, replace = scan_index(log)
+    events = parse_events(log, end_time, start=start, user_id=user_id, index=np.concatenate((index, tail)))
+    return events, (tail, indexed, replace)
+
+
+def events_frame(arrays: list) -> pd.DataFrame:
+    """merge event arrays into a single dataframe with a time column"""
+    if arrays:
+        events = pd.DataFrame(np.concatenate(arrays))
+    else:
+        events = pd.DataFrame(np.empty(0, dtype=EVENT_DTYPE))
+
+    events["time"] = pd.to_datetime(events["ts"], unit="s")
+    return events
+
+
+def read_events(log_files: list, end_time: dt = None, start: dt = None, user_id: int = None) -> pd.DataFrame:
+    """
+    get events from log files as a dataframe, compacted files are loaded as is and the rest are parsed.
+
+    if user_id is given, only events authored by or targeting that user are returned.
+    """
+    return events_frame([read_event_array(log, end_time, start, user_id) for log in sorted(log_files)])
+
+
+def only_messages(events: pd.DataFrame) -> pd.DataFrame:
+    """events that are messages sent, including replies and attachments"""
+    return events[events["kind"].isin(MESSAGE_KINDS)]
+
+
+def bucket_index(times: list, events: pd.DataFrame) -> np.ndarray:
+    """index of the split each event falls in, -1 for events before the first split"""
+    edges = np.array(times, dtype="datetime64[ns]")
+    return np.searchsorted(edges, events["time"].to_numpy(), side="right") - 1
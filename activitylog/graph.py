@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import os
+import collections
+
+import numpy as np
+import pandas as pd
+
+from .utils import parse_line_time
+
+# messages further apart than this in seconds aren't counted as interacting
+CORR_MSG_DELTA = 15 * 60
+# voice joins older than this in seconds are assumed to have missed their leave
+VOICE_TIME_LIMIT = 24 * 60 * 60
+# how many previous messages in a channel count towards interactions
+MESSAGE_WINDOW = 5
+
+LAYERS = ("text", "voice")
+
+
+class InteractionGraph:
+    """
+    Weighted, directed interaction graph between members of a guild.
+
+    Edges are kept sparse as {(source id, target id): weight} per layer and saved
+    as coordinate (COO) arrays, so only pairs of members who actually interacted take space.
+    Messages and voice channel joins/leaves are fed in as they happen.
+    """
+
+    def __init__(self, path: str, corr_weights: dict):
+        self.path = path
+        self.corr_weights = corr_weights
+        self.edges = {layer: collections.defaultdict(float) for layer in LAYERS}
+        self.dirty = False
+
+        # recent (author id, timestamp) per text channel, closest last
+        self.windows = collections.defaultdict(lambda: collections.deque(maxlen=MESSAGE_WINDOW))
+        # {user id: join timestamp} per voice channel
+        self.joined_at = collections.defaultdict(dict)
+
+    @classmethod
+    def load(cls, path: str, corr_weights: dict) -> "InteractionGraph":
+        graph = cls(path, corr_weights)
+        if not os.path.exists(path):
+            return graph
+
+        with np.load(path) as data:
+            for layer in LAYERS:
+                pairs = zip(data[f"{layer}_src"].tolist(), data[f"{layer}_dst"].tolist())
+                graph.edges[layer].update(zip(pairs, data[f"{layer}_weight"].tolist()))
+
+        return graph
+
+    def snapshot(self) -> dict:
+        """
+        copy of the edges if anything changed since the last snapshot, otherwise None
+
+        the copy can be written with write_edges off the event loop while the graph keeps changing.
+        """
+        if not self.dirty:
+            return None
+
+        self.dirty = False
+        return {layer: dict(edges) for layer, edges in self.edges.items()}
+
+    def add(self, layer: str, source: int, target: int, weight: float):
+        if weight:
+            self.edges[layer][(source, target)] += weight
+            self.dirty = True
+
+    def add_message(self, channel_id: int, author_id: int, ts: int, reply_to: int = None):
+        """
+        count a message in a text channel, replies are weighted between the two members,
+        otherwise the author is linked to the authors of the messages just before it.
+
+        author_id is None for lines that aren't from a known user, they still take up a spot in the window.
+        """
+        window = self.windows[channel_id]
+        previous = list(window)
+        window.append((author_id, ts))
+        if author_id is None:
+            return
+
+        if reply_to is not None and reply_to != author_id:
+            self.add("text", author_id, reply_to, self.corr_weights["reply"])
+            self.add("text", reply_to, author_id, self.corr_weights["reply"])
+            return
+
+        weights = self.corr_weights["messages"]
+        for j, (other_id, prev_ts) in enumerate(previous):
+            if other_id is None or other_id == author_id or ts - prev_ts > CORR_MSG_DELTA:
+                continue
+
+            try:
+                self.add("text", author_id, other_id, weights[j - len(previous)])
+            except IndexError:
+                pass
+
+    def voice_join(self, channel_id: int, user_id: int, ts: int):
+        joined_at = self.joined_at[channel_id]
+        # drop anyone whose leave was missed
+        for other_id, join_ts in list(joined_at.items()):
+            if ts - join_ts > VOICE_TIME_LIMIT:
+                del joined_at[other_id]
+
+        joined_at[user_id] = ts
+
+    def voice_leave(self, channel_id: int, user_id: int, ts: int):
+        """add time spent together to everyone still in the voice channel"""
+        joined_at = self.joined_at[channel_id]
+        if user_id not in joined_at:
+            return
+
+        minutes = (ts - joined_at.pop(user_id)) // 60
+        weight = self.corr_weights["vc_per_minute"] * minutes
+        # joined_at no longer has the leaving user, so this is more than 2 people in vc
+        if len(joined_at) > 1:
+            weight *= self.corr_weights["vc_people_multiplier"] / (len(joined_at) - 1)
+
+        for other_id in joined_at.keys():
+            self.add("voice", user_id, other_id, weight)
+            self.add("voice", other_id, user_id, weight)
+
+    def matrix(self, layer: str, member_ids: list, focus: int = None) -> np.ndarray:
+        """
+        dense adjacency matrix between the given members, in order
+
+        if focus is given, only edges to or from that member are included.
+        """
+        index = {member_id: i for i, member_id in enumerate(member_ids)}
+        matrix = np.zeros((len(member_ids), len(member_ids)))
+        for (source, target), weight in self.edges[layer].items():
+            if focus is not None and focus not in (source, target):
+                continue
+            i = index.get(source)
+            j = index.get(target)
+            if i is not None and j is not None:
+                matrix[i, j] += weight
+
+        return matrix
+
+    def frame(self, layer: str, members: list, focus: int = None) -> pd.DataFrame:
+        """adjacency matrix between members as a dataframe labelled with member names"""
+        names = [m.name for m in members]
+        return pd.DataFrame(data=self.matrix(layer, [m.id for m in members], focus), index=names, columns=names)
+
+    def neighbours(self, member_id: int) -> set:
+        """ids of everyone who has an edge with the member in any layer"""
+        ids = set()
+        for edges in self.edges.values():
+            for source, target in edges.keys():
+                if source == member_id:
+                    ids.add(target)
+                elif target == member_id:
+                    ids.add(source)
+
+        return ids
+
+
+def write_edges(path: str, edges: dict):
+    """write a snapshot of a graph's edges to disk as coordinate arrays"""
+    arrays = {}
+    for layer, layer_edges in edges.items():
+        pairs = np.array(list(layer_edges.keys()), dtype=np.uint64).reshape(-1, 2)
+        arrays[f"{layer}_src"] = pairs[:, 0]
+        arrays[f"{layer}_dst"] = pairs[:, 1]
+        arrays[f"{layer}_weight"] = np.fromiter(layer_edges.values(), dtype=np.float64, count=len(layer_edges))
+
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def correlate_text(lines, graph: InteractionGraph, channel_id: int):
+    """feed a text channel's log lines into the graph"""
+    for line in lines:
+        # skip things like message edits
+        if "edited message from" in line and "to read:" in line:
+            continue
+        elif " deleted message from " in line:
+            continue
+
+        parts = line.split("(id:")
+        try:
+            author_id = int(parts[1].split(")")[0])
+        except (IndexError, ValueError):
+            author_id = None
+
+        ts = parse_line_time(line, None)
+        if ts is None:
+            continue
+
+        reply_to = None
+        if author_id is not None and len(parts) > 2 and "replied to" in parts[1].split("):")[0]:
+            try:
+                reply_to = int(parts[2].split("):")[0])
+            except ValueError:
+                pass
+
+        graph.add_message(channel_id, author_id, ts, reply_to=reply_to)
+
+
+def correlate_voice(lines, graph: InteractionGraph, channel_id: int):
+    """feed a voice channel's log lines into the graph"""
+    for line in lines:
+        try:
+            user_id = int(line.split("(id")[-1].split(")")[0].strip().strip(":"))
+        except ValueError:
+            continue
+
+        ts = parse_line_time(line, None)
+        if ts is None:
+            continue
+
+        if "Voice channel join:" in line:
+            graph.voice_join(channel_id, user_id, ts)
+        elif "Voice channel leave:" in line:
+            graph.voice_leave(channel_id, user_id, ts)
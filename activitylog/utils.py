@@ -5,7 +5,16 @@ import re
 from datetime import datetime as dt
 from typing import Optional
 import os
+import site
 import asyncio
+import calendar
+import collections
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 import pytz
 from dateutil import parser
@@ -26,6 +35,17 @@ TIME_RE_STRING = r"\s?".join(
 
 TIME_RE = re.compile(TIME_RE_STRING, re.I)
 
+# any discord id on a line, in "(id:1234)" and "(id 1234)" template fields as well as mentions in message content
+ID_RE = re.compile(rb"\d{15,21}")
+
+# one record per log line: timestamp (epoch seconds), byte offset of the line
+# and a bitmask of every id mentioned in it, see id_bits
+INDEX_DTYPE = np.dtype([("ts", "<i8"), ("offset", "<u8"), ("ids", "<u8")])
+INDEX_EXT = ".idx"
+
+_index_locks = {}
+_index_locks_lock = threading.Lock()
+
 
 def gen_tzinfos():
     for zone in pytz.common_timezones:
@@ -91,12 +111,307 @@ def get_all_names(guild_files, user):
     return set(names)
 
 
+def index_lock(path):
+    """lock shared by the writer and readers of a log file's index"""
+    with _index_locks_lock:
+        lock = _index_locks.get(path)
+        if lock is None:
+            lock = _index_locks[path] = threading.Lock()
+        return lock
+
+
+def parse_line_time(line: bytes, default: int = 0) -> int:
+    """
+    parse the "YYYY-MM-DD HH:MM:SS" prefix of a log line into epoch seconds.
+
+    slicing is a lot faster than strptime, and this runs for every line indexed.
+    """
+    try:
+        return calendar.timegm(
+            (int(line[0:4]), int(line[5:7]), int(line[8:10]), int(line[11:13]), int(line[14:16]), int(line[17:19]))
+        )
+    except ValueError:
+        return default
+
+
+def id_bits(user_id: int) -> int:
+    """
+    two bits out of 64 for an id, a line's mask is these or'd together for every id on it.
+
+    a line can only mention the id if both its bits are set, lines that pass are still
+    checked for the id itself since other ids can set the same bits.
+    """
+    h = (user_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    return (1 << (h >> 58)) | (1 << ((h >> 52) & 63))
+
+
+def index_record(line: bytes, offset: int, last_ts: int = 0):
+    """build the index record for a single log line"""
+    mask = 0
+    for user_id in ID_RE.findall(line):
+        mask |= id_bits(int(user_id))
+    return (parse_line_time(line, last_ts), offset, mask)
+
+
+def scan_log(path: str, offset: int = 0, last_ts: int = 0) -> np.ndarray:
+    """index every complete line in the log file starting at offset"""
+    records = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # still being written, will be picked up next time
+                break
+            record = index_record(line, offset, last_ts)
+            last_ts = record[0]
+            records.append(record)
+            offset += len(line)
+
+    return np.array(records, dtype=INDEX_DTYPE)
+
+
+def read_index(path: str) -> np.ndarray:
+    """read the sidecar index of a log file as is, may not cover the whole file"""
+    try:
+        with open(path + INDEX_EXT, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return np.empty(0, dtype=INDEX_DTYPE)
+
+    # drop a partially written record, if any
+    data = data[: len(data) - len(data) % INDEX_DTYPE.itemsize]
+    return np.frombuffer(data, dtype=INDEX_DTYPE)
+
+
+def _resume_point(path: str, index: np.ndarray):
+    """returns offset and timestamp to continue indexing from, or None if the index is stale"""
+    if not len(index):
+        return 0, 0
+
+    last = index[-1]
+    with open(path, "rb") as f:
+        f.seek(int(last["offset"]))
+        line = f.readline()
+
+    if not line.endswith(b"\n"):
+        # log file was truncated or replaced under the index
+        return None
+
+    return int(last["offset"]) + len(line), int(last["ts"])
+
+
+def scan_index(path: str) -> tuple:
+    """
+    read the sidecar index of a log file and scan any lines past its end.
+
+    returns (index, tail, indexed, replace): the usable part of the sidecar, the records scanned after it,
+    how many records the sidecar had and whether it was stale, the last three are what save_index_tail needs.
+    """
+    index = read_index(path)
+    indexed = len(index)
+    resume = _resume_point(path, index)
+    replace = resume is None
+    if replace:
+        index = np.empty(0, dtype=INDEX_DTYPE)
+        resume = (0, 0)
+
+    return index, scan_log(path, *resume), indexed, replace
+
+
+def save_index_tail(path: str, tail: np.ndarray, indexed: int, replace: bool = False):
+    """
+    add records scanned past the end of the sidecar index to it, or replace it if it was stale.
+
+    only the bot's process writes to sidecar indexes, worker processes send their scanned records back here.
+    """
+    if not len(tail) and not replace:
+        return
+
+    with index_lock(path):
+        # only write if the log's handle didn't touch the index while we were scanning
+        if len(read_index(path)) == indexed:
+            with open(path + INDEX_EXT, "wb" if replace or not indexed else "ab") as f:
+                f.write(tail.tobytes())
+
+
+def load_index(path: str, persist: bool = True) -> np.ndarray:
+    """
+    get the full index for a log file.
+
+    any lines past the end of the sidecar index are scanned and, if persist is true,
+    appended to it so the next query does not have to scan them again.
+    """
+    index, tail, indexed, replace = scan_index(path)
+    if not len(tail) and not replace:
+        return index
+
+    if persist:
+        save_index_tail(path, tail, indexed, replace)
+
+    return np.concatenate((index, tail))
+
+
+def select_range(index: np.ndarray, end_time: dt = None, start: dt = None) -> np.ndarray:
+    """index records of the lines between end_time and start (both optional, naive UTC)"""
+    if not len(index):
+        return index
+
+    # timestamps are mostly ordered, but edits are logged at edit time, so search on the running max
+    key = np.maximum.accumulate(index["ts"])
+    lo = np.searchsorted(key, calendar.timegm(end_time.timetuple()), side="left") if end_time else 0
+    hi = np.searchsorted(key, calendar.timegm(start.timetuple()), side="right") if start else len(index)
+    return index[lo:hi]
+
+
+def _user_lines(f, selected: np.ndarray, user_id: int):
+    """(offset, line) of the selected lines in an open log file that mention user_id"""
+    bits = np.uint64(id_bits(user_id))
+    needle = str(user_id).encode()
+    for offset in selected[(selected["ids"] & bits) == bits]["offset"]:
+        f.seek(int(offset))
+        line = f.readline()
+        if needle in line:
+            yield int(offset), line
+
+
+def iter_log_range(
+    path: str,
+    end_time: dt = None,
+    start: dt = None,
+    user_id: int = None,
+    persist: bool = True,
+    index: np.ndarray = None,
+):
+    """
+    yields the lines of a log file between end_time and start (both optional, naive UTC),
+    optionally only the ones mentioning user_id.
+
+    uses the sidecar index (or the full index, if given) to seek straight to matching lines,
+    and only holds one line at a time.
+    """
+    if index is None:
+        index = load_index(path, persist=persist)
+    selected = select_range(index, end_time, start)
+    if not len(selected):
+        return
+
+    with open(path, "rb") as f:
+        if user_id is None:
+            f.seek(int(selected[0]["offset"]))
+            for _ in range(len(selected)):
+                yield f.readline().decode("utf-8", "replace")
+        else:
+            for _, line in _user_lines(f, selected, user_id):
+                yield line.decode("utf-8", "replace")
+
+
+def log_offsets(path: str, end_time: dt = None, start: dt = None, user_id: int = None) -> tuple:
+    """
+    offsets of the lines iter_log_range would yield, this is what worker processes send back instead of the lines.
+
+    returns (offsets, tail, indexed, replace), pass the last three to save_index_tail in the bot's process.
+    """
+    index, tail, indexed, replace = scan_index(path)
+    selected = select_range(np.concatenate((index, tail)), end_time, start)
+    if user_id is None or not len(selected):
+        offsets = np.array(selected["offset"])
+    else:
+        with open(path, "rb") as f:
+            offsets = np.fromiter((offset for offset, _ in _user_lines(f, selected, user_id)), dtype="<u8")
+
+    return offsets, tail, indexed, replace
+
+
+def iter_log_offsets(path: str, offsets: np.ndarray):
+    """yields the lines of a log file starting at each offset, one line at a time"""
+    with open(path, "rb") as f:
+        for offset in offsets:
+            offset = int(offset)
+            if offset != f.tell():
+                f.seek(offset)
+            yield f.readline().decode("utf-8", "replace")
+
+
+def process_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    process pool for parsing log files.
+
+    workers are spawned instead of forked, a fork copies the bot with its running threads and any locks
+    they hold at the time. spawned workers import this cog fresh, so its parent directory goes on their path.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=site.addsitedir,
+        initargs=(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),),
+    )
+
+
+def log_file_key(path: str) -> str:
+    """channel id (or "guild") a log file belongs to, with the rotation prefix removed"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    return name.split("_")[-1]
+
+
+class WriteStats:
+    """counters for log writes, shared between all handles"""
+
+    def __init__(self):
+        self.lines = 0
+        self.flushes = 0
+        self.flushed_bytes = 0
+        self.flush_time = 0.0
+        self.max_flush_time = 0.0
+
+    def record_flush(self, nbytes: int, elapsed: float):
+        self.flushes += 1
+        self.flushed_bytes += nbytes
+        self.flush_time += elapsed
+        self.max_flush_time = max(self.max_flush_time, elapsed)
+
+    @property
+    def avg_flush_time(self) -> float:
+        return self.flush_time / self.flushes if self.flushes else 0.0
+
+
 class LogHandle:
-    """basic wrapper for logfile handles, used to keep track of stale handles"""
+    """
+    basic wrapper for logfile handles, used to keep track of stale handles
+
+    lines are queued and written out in one go once flush_size bytes are queued,
+    or whenever flush is called, optionally fsyncing after each write.
+    """
 
-    def __init__(self, path, time=None, mode="a", buf=1):
+    def __init__(self, path, time=None, mode="a", buf=-1, flush_size=0, fsync=False, stats=None):
+        self.path = path
         self.handle = open(path, mode, buf, errors="backslashreplace")
         self.lock = asyncio.Lock()
+        self.flush_size = flush_size
+        self.fsync = fsync
+        self.stats = stats or WriteStats()
+
+        # lines and index records waiting to be written
+        self.queue = []
+        self.records = []
+        self.queued_bytes = 0
+
+        with index_lock(path):
+            index = read_index(path)
+            resume = _resume_point(path, index)
+            if resume is None or "w" in mode:
+                index = np.empty(0, dtype=INDEX_DTYPE)
+                resume = (0, 0)
+                open(path + INDEX_EXT, "wb").close()
+
+            # catch the index up with anything written before it existed
+            tail = scan_log(path, *resume)
+            self.index = open(path + INDEX_EXT, "ab", 0)
+            self.index.write(tail.tobytes())
+            if len(tail):
+                index = tail
+
+        self.offset = os.path.getsize(path)
+        self.last_ts = int(index[-1]["ts"]) if len(index) else 0
 
         if time:
             self.time = time
@@ -108,8 +423,143 @@ class LogHandle:
             self._write(value)
 
     def close(self):
+        self.flush()
         self.handle.close()
+        self.index.close()
+
+    def flush(self):
+        """write out everything queued"""
+        if not self.queue:
+            return
+
+        start = time.perf_counter()
+        with index_lock(self.path):
+            self.handle.write("".join(self.queue))
+            self.handle.flush()
+            if self.fsync:
+                os.fsync(self.handle.fileno())
+            # index goes after the lines it points to, so readers never see records past the end of the log
+            self.index.write(np.array(self.records, dtype=INDEX_DTYPE).tobytes())
+
+        self.stats.record_flush(self.queued_bytes, time.perf_counter() - start)
+        self.queue = []
+        self.records = []
+        self.queued_bytes = 0
 
     def _write(self, value):
         self.time = dt.utcnow()
-        self.handle.write(value)
+        data = value.encode(self.handle.encoding, "backslashreplace")
+        record = index_record(data, self.offset, self.last_ts)
+
+        self.queue.append(value)
+        self.records.append(record)
+        self.queued_bytes += len(data)
+        self.stats.lines += 1
+
+        self.last_ts = record[0]
+        self.offset += len(data)
+
+        if self.queued_bytes >= self.flush_size:
+            self.flush()
+
+
+class HandlePool:
+    """
+    LRU pool of open log handles, the least recently written one is closed once capacity is reached.
+
+    instead of checking if a log was deleted on every write, each handle's file is stat'ed
+    at most every stat_interval seconds and compared to the inode it was opened with.
+    """
+
+    def __init__(self, capacity: int = 256, stat_interval: float = 30):
+        self.capacity = capacity
+        self.stat_interval = stat_interval
+        self.handles = collections.OrderedDict()
+        # path: (inode, last checked)
+        self.inodes = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+
+    def __len__(self):
+        return len(self.handles)
+
+    def __contains__(self, path):
+        return path in self.handles
+
+    def values(self):
+        return self.handles.values()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, path: str) -> Optional[LogHandle]:
+        """get the open handle for a path, or None if it isn't open or its file was deleted"""
+        handle = self.handles.get(path)
+        if handle is None:
+            self.misses += 1
+            return None
+
+        inode, checked = self.inodes[path]
+        now = time.monotonic()
+        if now - checked >= self.stat_interval:
+            try:
+                current = os.stat(path).st_ino
+            except OSError:
+                current = None
+
+            if current != inode:  # file was deleted or replaced
+                self.stale += 1
+                self.misses += 1
+                self.remove(path, stale=True)
+                return None
+
+            self.inodes[path] = (inode, now)
+
+        self.handles.move_to_end(path)
+        self.hits += 1
+        return handle
+
+    def add(self, path: str, handle: LogHandle):
+        while len(self.handles) >= self.capacity:
+            self.evictions += 1
+            self.remove(next(iter(self.handles)))
+
+        self.handles[path] = handle
+        self.inodes[path] = (os.fstat(handle.handle.fileno()).st_ino, time.monotonic())
+
+    def remove(self, path: str, stale: bool = False):
+        handle = self.handles.pop(path)
+        del self.inodes[path]
+        if stale and handle.queue:
+            # closing would flush the queue into the deleted file, write it to a new one at the path instead
+            queue = handle.queue
+            handle.queue, handle.records, handle.queued_bytes = [], [], 0
+            handle.stats.lines -= len(queue)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                replacement = LogHandle(path, flush_size=handle.flush_size, fsync=handle.fsync, stats=handle.stats)
+                for value in queue:
+                    replacement._write(value)
+                replacement.close()
+            except Exception:
+                pass
+
+        try:  # try to close, no guarantees tho
+            handle.close()
+        except Exception:
+            pass
+
+    def resize(self, capacity: int):
+        self.capacity = capacity
+        while len(self.handles) > capacity:
+            self.evictions += 1
+            self.remove(next(iter(self.handles)))
+
+    def close(self):
+        for path in list(self.handles):
+            self.remove(path)
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import os
+import time
+from types import SimpleNamespace
+
+import torch
+from aitextgen import aitextgen
+from transformers import GPT2TokenizerFast
+
+# pytorch is the full precision model, quantized is it with int8 weights, onnx is an onnx runtime export
+BACKENDS = ("pytorch", "quantized", "onnx")
+
+# fixed prompts for benchmarking, so runs are comparable
+BENCHMARK_PROMPTS = (
+    "hey how is everyone doing today",
+    "did anyone see the game last night?\nyeah it was crazy",
+    "what should we play tonight",
+    "i just got back from work and im so tired\nsame here honestly\nanyone want to get food",
+    "whats your favorite movie",
+)
+# tokens generated after each benchmark prompt
+BENCHMARK_TOKENS = 50
+
+
+class BackendError(Exception):
+    pass
+
+
+def conv1d_to_linear(module: torch.nn.Module):
+    """
+    replace gpt2's Conv1D layers with the equivalent Linear layers, in place
+
+    dynamic quantization only knows about Linear, Conv1D is the same thing with its weight transposed.
+    """
+    for name, child in module.named_children():
+        if type(child).__name__ == "Conv1D":
+            linear = torch.nn.Linear(child.weight.shape[0], child.weight.shape[1])
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            conv1d_to_linear(child)
+
+
+def load_backend(backend: str, root: str, use_gpu: bool = False):
+    """
+    load the model in the data directory with a backend, blocking
+
+    returns an object with the huggingface model as .model and its tokenizer as .tokenizer,
+    for the pytorch backend this is the aitextgen instance so it can also be trained.
+    """
+    if backend == "pytorch":
+        return aitextgen(model_folder=root, use_gpu=use_gpu)
+
+    if backend == "quantized":
+        # int8 weights only run on cpu
+        model = aitextgen(model_folder=root, use_gpu=False)
+        conv1d_to_linear(model.model)
+        model.model = torch.quantization.quantize_dynamic(model.model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    if backend == "onnx":
+        try:
+            from optimum.onnxruntime import ORTModelForCausalLM
+        except ImportError:
+            raise BackendError("The onnx backend needs `optimum[onnxruntime]` installed.")
+
+        onnx_path = os.path.join(root, "onnx")
+        if not os.path.isdir(onnx_path):
+            # export once, later loads use the saved export
+            ORTModelForCausalLM.from_pretrained(root, export=True).save_pretrained(onnx_path)
+
+        # same tokenizer aitextgen would use, a custom one if the model was trained with it
+        tokenizer_file = os.path.join(root, "aitextgen.tokenizer.json")
+        if os.path.isfile(tokenizer_file):
+            tokenizer = GPT2TokenizerFast(tokenizer_file=tokenizer_file)
+        else:
+            tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
+
+        return SimpleNamespace(model=ORTModelForCausalLM.from_pretrained(onnx_path), tokenizer=tokenizer)
+
+    raise BackendError(f"Unknown backend `{backend}`, use one of: {', '.join(BACKENDS)}.")
+
+
+def benchmark(model, prompts=BENCHMARK_PROMPTS, tokens: int = BENCHMARK_TOKENS) -> tuple:
+    """
+    generate a fixed number of tokens after each prompt one at a time, blocking
+
+    returns (tokens generated, seconds taken)
+    """
+    tokenizer = model.tokenizer
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    generated = 0
+    start = time.perf_counter()
+    for prompt in prompts:
+        inputs = tokenizer(prompt + "\n", return_tensors="pt")
+        inputs = {k: v.to(model.model.device) for k, v in inputs.items()}
+        length = inputs["input_ids"].shape[1]
+        with torch.no_grad():
+            output = model.model.generate(
+                **inputs,
+                max_length=length + tokens,
+                min_length=length + tokens,
+                do_sample=False,
+                pad_token_id=pad_token_id,
+            )
+        generated += output.shape[1] - length
+
+    return generated, time.perf_counter() - start
@@ -4,11 +4,19 @@ from redbot.core.data_manager import cog_data_path
 
 from aitextgen import aitextgen
 
+from .worker import InferenceWorker
+from .backends import load_backend, benchmark, BackendError, BACKENDS
+from .latency import LatencyTracker, STAGES, PERCENTILES, WINDOW
+
 from typing import Literal
 from datetime import datetime, timedelta
 import asyncio, os, time, random
+import collections
 import functools
 
+# most messages of history kept per channel, a history setting of 0 (all messages) keeps this many
+MAX_HISTORY = 100
+
 
 class Chatbot(commands.Cog):
     """
@@ -28,22 +36,34 @@ class Chatbot(commands.Cog):
             "dead_revive_time": 3000,
         }
         default_channel = {"autoreply": False, "randomness": 0.25, "timeout": 1500}
-        default_global = {"use_gpu": False, "autoboot": False, "total_response_time": 0, "num_responses": 0}
+        default_global = {
+            "use_gpu": False,
+            "autoboot": False,
+            "backend": "pytorch",
+            "total_response_time": 0,
+            "num_responses": 0,
+        }
 
         self.config.register_guild(**default_guild)
         self.config.register_channel(**default_channel)
         self.config.register_global(**default_global)
-        # TODO add settings cache
+        # guild id/channel id -> settings, dropped whenever a setting is changed
+        self.guild_cache = {}
+        self.channel_cache = {}
 
         self.model = None
+        # runs all generation for the model, off the event loop
+        self.worker = None
         # maps channel -> datetime of last message for autoreply channels
         self.talking_channels = {}
-        # maps channel -> last history number of messages objects
+        # maps channel id -> deque of the last history number of (message id, clean content, created at)
         self.history = {}
         # when generating for a channel, ignore new messages
-        self.channel_lock = []
+        self.channel_lock = set()
         # stat tracking
         self.stats = {"total_response_time": 0, "num_responses": 0}
+        # rolling per guild percentiles of each response stage, snapshotted to latency.json
+        self.latency = LatencyTracker()
         self.special_tokens = {
             "end_convo": "<end_convo>",
             "start_convo": "<start_convo>",
@@ -58,7 +78,16 @@ class Chatbot(commands.Cog):
         config_path = os.path.join(root, "config.json")
         if os.path.isfile(model_path) and os.path.isfile(config_path):
             use_gpu = await self.config.use_gpu()
-            self.model = aitextgen(model_folder=root, use_gpu=use_gpu)
+            backend = await self.config.backend()
+            try:
+                model = await self.loop.run_in_executor(
+                    None, functools.partial(load_backend, backend, root, use_gpu=use_gpu)
+                )
+            except BackendError as e:
+                await self.bot.send_to_owners(error(f"Could not load the `chatbot` model: {e}"))
+                return
+
+            self.set_model(model)
         else:
             await self.bot.send_to_owners(
                 error(
@@ -66,6 +95,75 @@ class Chatbot(commands.Cog):
                 )
             )
 
+    async def guild_settings(self, guild: discord.Guild) -> dict:
+        settings = self.guild_cache.get(guild.id)
+        if settings is None:
+            settings = self.guild_cache[guild.id] = await self.config.guild(guild).all()
+
+        return settings
+
+    async def channel_settings(self, channel: discord.TextChannel) -> dict:
+        settings = self.channel_cache.get(channel.id)
+        if settings is None:
+            settings = self.channel_cache[channel.id] = await self.config.channel(channel).all()
+
+        return settings
+
+    def get_history(self, channel: discord.TextChannel, history_len: int) -> collections.deque:
+        """channel's message history, resized if the history setting changed"""
+        maxlen = min(history_len, MAX_HISTORY) if history_len > 0 else MAX_HISTORY
+        history = self.history.get(channel.id)
+        if history is None or history.maxlen != maxlen:
+            history = self.history[channel.id] = collections.deque(history or (), maxlen=maxlen)
+
+        return history
+
+    def set_model(self, model):
+        """use a new model, starting a new inference worker for it"""
+        if self.worker is not None:
+            self.worker.stop()
+
+        self.model = model
+        self.worker = InferenceWorker(model)
+
+    async def revive_channel(self, guild: discord.Guild, channel: discord.TextChannel, dead_time: int):
+        """send a message in a dead channel if nothing has been said in dead_time seconds"""
+        last_msg = None
+        async for msg in channel.history(limit=1):
+            last_msg = msg
+
+        if last_msg is None:
+            return
+
+        now = datetime.utcnow()
+        if (now - last_msg.created_at).total_seconds() < dead_time:
+            return
+
+        start = time.time()
+        settings = await self.guild_settings(guild)
+        context = ""
+        for _, content, _ in self.history.get(channel.id, ()):
+            context += content + "\n"
+
+        timings = {}
+        output = await self.get_ai_response(context, settings["max_len"], settings["temp"], timings=timings)
+        self.stats["total_response_time"] += time.time() - start
+        self.stats["num_responses"] += 1
+        send_start = time.time()
+        try:
+            await channel.send(output)
+        except:
+            return
+
+        self.record_latency(guild, start, send_start, timings)
+
+    def record_latency(self, guild: discord.Guild, start: float, send_start: float, timings: dict):
+        """add a sent response's stage timings to the guild's latency histograms"""
+        now = time.time()
+        timings["send"] = now - send_start
+        timings["total"] = now - start
+        self.latency.record_all(guild.id, timings)
+
     async def init(self):
         if await self.config.autoboot():
             await self.load_model()
@@ -78,51 +176,38 @@ class Chatbot(commands.Cog):
                 await asyncio.sleep(60)
                 continue
 
+            # revive every dead channel at once so their prompts are batched together
+            revives = []
             for guild in self.bot.guilds:
                 if await self.bot.cog_disabled_in_guild(self, guild):
                     continue
-                dead = await self.config.guild(guild).dead_channels()
-                dead_time = await self.config.guild(guild).dead_revive_time()
-                for id in dead:
+                settings = await self.guild_settings(guild)
+                dead_time = settings["dead_revive_time"]
+                for id in settings["dead_channels"]:
                     channel = guild.get_channel(id)
                     if not channel:
                         continue
 
-                    last_msg = None
-                    async for msg in channel.history(limit=1):
-                        last_msg = msg
+                    revives.append(self.revive_channel(guild, channel, dead_time))
 
-                    if last_msg is None:
-                        continue
-
-                    now = datetime.utcnow()
-                    if (now - last_msg.created_at).total_seconds() < dead_time:
-                        continue
-
-                    start = time.time()
-                    max_len = await self.config.guild(guild).max_len()
-                    temp = await self.config.guild(guild).temp()
-                    context = ""
-                    if channel in self.history:
-                        for msg in self.history[channel]:
-                            context += msg.clean_content.strip() + "\n"
-
-                    output = self.get_ai_response(context, max_len, temp)
-                    self.stats["total_response_time"] += time.time() - start
-                    self.stats["num_responses"] += 1
-                    try:
-                        await channel.send(output)
-                    except:
-                        pass
+            await asyncio.gather(*revives, return_exceptions=True)
 
             # save stats off
             await self.config.total_response_time.set(self.stats["total_response_time"])
             await self.config.num_responses.set(self.stats["num_responses"])
+            await self.loop.run_in_executor(
+                None,
+                self.latency.save,
+                os.path.join(cog_data_path(cog_instance=self), "latency.json"),
+                self.latency.snapshot(),
+            )
             await asyncio.sleep(60)
 
     def cog_unload(self):
         if self.init_task:
             self.init_task.cancel()
+        if self.worker is not None:
+            self.worker.stop()
 
     async def timed_wait(self, message: discord.Message):
         """
@@ -147,7 +232,18 @@ class Chatbot(commands.Cog):
             return await ctx.maybe_send_embed("I haven't responded to anyone yet!")
 
         avg_response = self.stats["total_response_time"] / self.stats["num_responses"]
-        await ctx.maybe_send_embed(f"**Average response time:** {avg_response:.2f} seconds")
+        msg = f"**Average response time:** {avg_response:.2f} seconds"
+
+        percentiles = self.latency.percentiles(ctx.guild.id) if ctx.guild else {}
+        samples = percentiles.get("total", (0, {}))[0]
+        if samples:
+            table = f"{'':<10}" + "".join(f"{'p' + str(p):>10}" for p in PERCENTILES) + "\n"
+            for stage in STAGES:
+                results = percentiles[stage][1]
+                table += f"{stage:<10}" + "".join(f"{results.get(p, 0):>9.2f}s" for p in PERCENTILES) + "\n"
+            msg += f"\n\n**Last {WINDOW // 60} minutes in this server** ({samples} responses):\n{box(table)}"
+
+        await ctx.maybe_send_embed(msg)
 
     @commands.group(name="ai")
     @commands.guild_only()
@@ -169,6 +265,63 @@ class Chatbot(commands.Cog):
         await self.config.use_gpu.set(use_gpu)
         await ctx.tick()
 
+    @ai.command(name="backend")
+    @checks.is_owner()
+    async def ai_backend(self, ctx, backend: str = None):
+        """
+        Set how the model is run, reloads the model if it is loaded
+
+        `pytorch`: full precision model, the only one that can be trained.
+        `quantized`: same model with int8 weights, faster on CPU and uses less memory, always runs on CPU.
+        `onnx`: ONNX Runtime export of the model, saved to the cog's data directory the first time. Needs `optimum[onnxruntime]` installed.
+        """
+        if backend is None:
+            await ctx.send(f"Current backend is `{await self.config.backend()}`.")
+            return
+
+        backend = backend.lower()
+        if backend not in BACKENDS:
+            await ctx.send(error(f"Backend must be one of: {humanize_list(BACKENDS)}"))
+            return
+
+        await self.config.backend.set(backend)
+        if self.model is not None:
+            async with ctx.typing():
+                await self.load_model()
+
+        await ctx.tick()
+
+    @ai.command(name="benchmark")
+    @checks.is_owner()
+    async def ai_benchmark(self, ctx, *backends: str):
+        """
+        Compare generation speed of backends on a fixed set of prompts
+
+        Benchmarks all backends if none are given. Each backend is loaded separately, so this needs memory for one more model.
+        """
+        backends = [b.lower() for b in backends] or list(BACKENDS)
+        root = str(cog_data_path(cog_instance=self))
+        use_gpu = await self.config.use_gpu()
+
+        msg = f"{'Backend':<12}{'Tokens':>8}{'Seconds':>10}{'Tokens/sec':>12}\n"
+        async with ctx.typing():
+            for backend in backends:
+                try:
+                    model = await self.loop.run_in_executor(
+                        None, functools.partial(load_backend, backend, root, use_gpu=use_gpu)
+                    )
+                    tokens, seconds = await self.loop.run_in_executor(None, benchmark, model)
+                except Exception as e:
+                    msg += f"{backend:<12}failed: {e}\n"
+                    continue
+                finally:
+                    model = None
+
+                rate = f"{tokens / seconds:.1f}" if seconds else "-"
+                msg += f"{backend:<12}{tokens:>8}{seconds:>10.2f}{rate:>12}\n"
+
+        await ctx.send(box(msg))
+
     @ai.command(name="boot")
     @checks.is_owner()
     async def ai_boot(self, ctx, lets_boot: bool):
@@ -250,6 +403,7 @@ class Chatbot(commands.Cog):
         Set the time for chat to be dead to revive it in seconds
         """
         await self.config.guild(ctx.guild).dead_revive_time.set(time)
+        self.guild_cache.pop(ctx.guild.id, None)
         await ctx.tick()
 
     @ai_channel_revive.command("add")
@@ -261,6 +415,7 @@ class Chatbot(commands.Cog):
             if channel.id not in dead:
                 dead.append(channel.id)
 
+        self.guild_cache.pop(ctx.guild.id, None)
         await ctx.tick()
 
     @ai_channel_revive.command("del")
@@ -274,6 +429,7 @@ class Chatbot(commands.Cog):
             except:
                 pass
 
+        self.guild_cache.pop(ctx.guild.id, None)
         await ctx.tick()
 
     @ai_channel_revive.command("list")
@@ -296,6 +452,7 @@ class Chatbot(commands.Cog):
         Turn on autoreply in channel
         """
         await self.config.channel(channel).autoreply.set(on_off)
+        self.channel_cache.pop(channel.id, None)
         await ctx.tick()
 
     @ai_channel.command(name="random")
@@ -308,6 +465,7 @@ class Chatbot(commands.Cog):
         Setting it to 1 will mean it always reply to each message
         """
         await self.config.channel(channel).randomness.set(randomness)
+        self.channel_cache.pop(channel.id, None)
         await ctx.tick()
 
     @ai_channel.command(name="timeout")
@@ -318,6 +476,7 @@ class Chatbot(commands.Cog):
         Occurs once no new messages are sent for this time period in the channel.
         """
         await self.config.channel(channel).timeout.set(timeout)
+        self.channel_cache.pop(channel.id, None)
         await ctx.tick()
 
     @ai.group(name="model")
@@ -332,7 +491,7 @@ class Chatbot(commands.Cog):
         """
         View model settings
         """
-        settings = await self.config.guild(ctx.guild).all()
+        settings = await self.guild_settings(ctx.guild)
 
         msg = f"Temperature: {settings['temp']}\nHistory # Messages: {settings['history']}\n Max Output Lines: {settings['max_len']}\nMax History Time: {settings['max_time']} seconds"
         embed = discord.Embed(colour=ctx.guild.me.colour, description=msg, title=f"Settings for {ctx.guild}")
@@ -347,6 +506,7 @@ class Chatbot(commands.Cog):
         Mess with this between 0 and 1 to see what works best.
         """
         await self.config.guild(ctx.guild).temp.set(temp)
+        self.guild_cache.pop(ctx.guild.id, None)
         await ctx.tick()
 
     @ai_model.command(name="history")
@@ -355,8 +515,14 @@ class Chatbot(commands.Cog):
         Change history length of model
 
         History is the number of messages to consider as context when generating output, lower history is less context.
+        0 uses every message kept, up to 100.
         """
+        if not 0 <= history <= MAX_HISTORY:
+            await ctx.send(error(f"History must be between 0 and {MAX_HISTORY} messages."))
+            return
+
         await self.config.guild(ctx.guild).history.set(history)
+        self.guild_cache.pop(ctx.guild.id, None)
         await ctx.tick()
 
     @ai_model.command(name="time")
@@ -368,6 +534,7 @@ class Chatbot(commands.Cog):
         Messages outside of this time won't be considered in generation
         """
         await self.config.guild(ctx.guild).max_time.set(history_time)
+        self.guild_cache.pop(ctx.guild.id, None)
         await ctx.tick()
 
     @ai_model.command(name="lines")
@@ -378,6 +545,7 @@ class Chatbot(commands.Cog):
         It's good to keep to relatively small.
         """
         await self.config.guild(ctx.guild).max_len.set(lines)
+        self.guild_cache.pop(ctx.guild.id, None)
         await ctx.tick()
 
     @ai.command(
@@ -479,8 +647,12 @@ class Chatbot(commands.Cog):
         **WARNING** this will overwrite the current model if loaded!
         **WARNING** this will use a lot of resources! Make sure you have a lot of memory and a GPU, set the gpu option before training!
         """
+        if await self.config.backend() != "pytorch":
+            await ctx.send(error("Only the `pytorch` backend can be trained, change it with `[p]ai backend pytorch`."))
+            return
+
         if self.model is None:
-            self.model = aitextgen(tf_gpt2="124M", to_gpu=(await self.config.use_gpu()))
+            self.set_model(aitextgen(tf_gpt2="124M", to_gpu=(await self.config.use_gpu())))
 
         await ctx.send(info("Starting training, see console for training output."))
         # finetune
@@ -517,67 +689,30 @@ class Chatbot(commands.Cog):
 
         return processed_input
 
-    def get_ai_response(self, message: str, max_len: int, temp: float):
+    async def get_ai_response(self, message: str, max_len: int, temp: float, timings: dict = None) -> str:
         """
         Get a response from the model up to max length
 
+        Prompts are queued on the inference worker and batched with other channels' prompts.
+
         Args:
             message (str): The message to use for generation
             max_len (int): Maximum number of lines to generate
             temp (float): Model generation temperature
+            timings (dict): If given, filled with seconds spent waiting in the queue, tokenizing and generating
         """
-        numtokens = len(self.model.tokenizer(message)["input_ids"])
-        if numtokens >= 1000:
-            while numtokens >= 1000:
-                message = " ".join(message.split(" ")[20:]).strip()  # pretty arbitrary
-                numtokens = len(self.model.tokenizer(message)["input_ids"])
-
-        output = ""
-        i = 0  # in case of inf loop, two tries to generate a non-empty messages TODO: make configurable
-        while output == "" and i < 2:
-            text = self.model.generate(
-                max_length=numtokens + 70 + 5 * max_len,
-                prompt=message + "\n",
-                temperature=temp,
-                return_as_list=True,
-            )[0]
-            text = (
-                text[len(message) :]
-                .replace(self.special_tokens["end_convo"], "")
-                .replace(self.special_tokens["start_convo"], "")
-                .strip()
-            )  # remove the input text from the output text
-
-            j = 0
-            while output == "" and j < 100:  # TODO configure this too?
-                for i in range(
-                    0, random.randint(1, max_len)
-                ):  # include a random amount of lines up to maxlines in the response
-                    try:
-                        output += text.splitlines()[i + 1] + "\n"
-                    except:
-                        continue
-
-                output = output.strip()
-                j += 1
-
-            i += 1
-
-        if output == "":
-            # fill with default message if still empty
-            output = "🤔"
-
-        return output
+        return await self.worker.generate(message, max_len, temp, timings=timings)
 
     @commands.Cog.listener()
     async def on_message_delete(self, message: discord.Message):
         if await self.bot.cog_disabled_in_guild(self, message.guild):
             return
-        if message.channel in self.history:
-            try:
-                self.history[message.channel].remove(message)
-            except:
-                pass
+        history = self.history.get(message.channel.id)
+        if history:
+            for entry in history:
+                if entry[0] == message.id:
+                    history.remove(entry)
+                    break
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
@@ -595,30 +730,31 @@ class Chatbot(commands.Cog):
         if len(message.content) < 1 or guild is None or ctx.prefix is not None or author.bot:  # or author == guild.me
             return
 
-        if not channel in self.history:
-            self.history[channel] = []
-
-        self.history[channel].append(message)
+        settings = await self.guild_settings(guild)
+        # old messages fall off the end of the deque
+        self.get_history(channel, settings["history"]).append(
+            (message.id, message.clean_content.strip(), message.created_at)
+        )
 
-        if channel in self.channel_lock:
+        if channel.id in self.channel_lock:
             return
 
         ref_message = ref.resolved if ref else None
         ref_message = await channel.fetch_message(ref.message_id) if ref_message is not None else ref_message
-        autoreply = await self.config.channel(channel).autoreply()
+        channel_settings = await self.channel_settings(channel)
+        autoreply = channel_settings["autoreply"]
         ran_chat = False
         # if bot wasnt mentioned, replied too, or talking in a channel
         if not (
             guild.me in message.mentions
             or (
                 self.talking_channels.get(channel, None) is not None
-                and (datetime.utcnow() - self.talking_channels[channel]).total_seconds()
-                < (await self.config.channel(channel).timeout())
+                and (datetime.utcnow() - self.talking_channels[channel]).total_seconds() < channel_settings["timeout"]
             )
             or (ref_message is not None and ref_message.author == guild.me)
         ):
             # if not any of that, see if this is a auto channel and check random
-            if not autoreply or random.random() > (await self.config.channel(channel).randomness()):
+            if not autoreply or random.random() > channel_settings["randomness"]:
                 try:
                     del self.talking_channels[channel]
                 except:
@@ -631,36 +767,30 @@ class Chatbot(commands.Cog):
             self.talking_channels[channel] = message.created_at
 
         start = time.time()
-        self.channel_lock.append(channel)
-        async with channel.typing():
-            history_len = await self.config.guild(guild).history()
-            max_time = await self.config.guild(guild).max_time()
-            max_len = await self.config.guild(guild).max_len()
-            temp = await self.config.guild(guild).temp()
-
-            context = ""
-            # remove old messages
-            self.history[channel] = self.history[channel][-1 * history_len :]
-            for msg in self.history[channel]:
-                if (datetime.utcnow() - msg.created_at).total_seconds() < max_time:
-                    context += msg.clean_content.strip() + "\n"
-
-            # probably-stupid way of making every line but the last have a newline after it
-            context = context.rstrip(context[-1]).strip()
-
-            context = self.process_input(context)
-            if not context:
-                return
-
-            response = await self.loop.run_in_executor(None, self.get_ai_response, context, max_len, temp)
-            self.stats["total_response_time"] += time.time() - start
-            self.stats["num_responses"] += 1
-            try:
-                self.channel_lock.remove(channel)
-            except ValueError:
-                pass
-
-            return await message.reply(response, mention_author=False)
+        self.channel_lock.add(channel.id)
+        try:
+            async with channel.typing():
+                context = ""
+                now = datetime.utcnow()
+                for _, content, created_at in self.history[channel.id]:
+                    if (now - created_at).total_seconds() < settings["max_time"]:
+                        context += content + "\n"
+
+                context = self.process_input(context.strip())
+                if not context:
+                    return
+
+                timings = {}
+                response = await self.get_ai_response(context, settings["max_len"], settings["temp"], timings=timings)
+                self.stats["total_response_time"] += time.time() - start
+                self.stats["num_responses"] += 1
+        finally:
+            self.channel_lock.discard(channel.id)
+
+        send_start = time.time()
+        reply = await message.reply(response, mention_author=False)
+        self.record_latency(guild, start, send_start, timings)
+        return reply
 
     async def red_delete_data_for_user(
         self,
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import os
+import json
+import math
+import time
+import bisect
+import collections
+
+# stages of a response, total is from the message being seen to the reply being sent
+STAGES = ("queue", "tokenize", "generate", "send", "total")
+PERCENTILES = (50, 95, 99)
+
+# bucket bounds grow by this much each bucket, so percentiles are at most 20% over
+BUCKET_GROWTH = 1.2
+MIN_LATENCY = 0.001
+MAX_LATENCY = 1000
+BOUNDS = [MIN_LATENCY * BUCKET_GROWTH**i for i in range(int(math.log(MAX_LATENCY / MIN_LATENCY, BUCKET_GROWTH)) + 2)]
+
+# percentiles cover the last WINDOW seconds, in SLICES steps
+WINDOW = 60 * 60
+SLICES = 12
+
+
+class RollingHistogram:
+    """
+    Latency histogram over a rolling window.
+
+    The window is split into slices, each with its own bucket counts. Old slices
+    are dropped as time moves on, instead of keeping every latency recorded.
+    """
+
+    def __init__(self, window: int = WINDOW, slices: int = SLICES):
+        self.slice_len = window / slices
+        self.slices = slices
+        # (slice number, bucket counts), oldest first
+        self.counts = collections.deque()
+
+    def current(self) -> list:
+        now = int(time.time() // self.slice_len)
+        while self.counts and self.counts[0][0] <= now - self.slices:
+            self.counts.popleft()
+
+        if not self.counts or self.counts[-1][0] != now:
+            self.counts.append((now, [0] * (len(BOUNDS) + 1)))
+
+        return self.counts[-1][1]
+
+    def record(self, seconds: float):
+        self.current()[bisect.bisect_left(BOUNDS, seconds)] += 1
+
+    def merged(self) -> list:
+        self.current()
+        return [sum(column) for column in zip(*(counts for _, counts in self.counts))]
+
+    def percentiles(self, percentiles=PERCENTILES) -> tuple:
+        """
+        (number of samples, {percentile: seconds}) over the window,
+        each percentile is the upper bound of the bucket it falls in
+        """
+        counts = self.merged()
+        total = sum(counts)
+        if not total:
+            return 0, {}
+
+        results = {}
+        seen = 0
+        targets = iter(sorted(percentiles))
+        target = next(targets)
+        for i, count in enumerate(counts):
+            seen += count
+            while target is not None and seen >= total * target / 100:
+                results[target] = BOUNDS[min(i, len(BOUNDS) - 1)]
+                target = next(targets, None)
+            if target is None:
+                break
+
+        return total, results
+
+
+class LatencyTracker:
+    """Rolling latency histograms of each response stage, per guild"""
+
+    def __init__(self):
+        # guild id: {stage: RollingHistogram}
+        self.guilds = {}
+
+    def record(self, guild_id: int, stage: str, seconds: float):
+        stages = self.guilds.get(guild_id)
+        if stages is None:
+            stages = self.guilds[guild_id] = {s: RollingHistogram() for s in STAGES}
+
+        stages[stage].record(seconds)
+
+    def record_all(self, guild_id: int, timings: dict):
+        for stage, seconds in timings.items():
+            self.record(guild_id, stage, seconds)
+
+    def percentiles(self, guild_id: int) -> dict:
+        """{stage: (samples, {percentile: seconds})} for a guild, empty if it has no responses"""
+        stages = self.guilds.get(guild_id, {})
+        return {stage: histogram.percentiles() for stage, histogram in stages.items()}
+
+    def snapshot(self) -> dict:
+        """percentiles of every guild, in a json serializable form"""
+        return {
+            "time": int(time.time()),
+            "window": WINDOW,
+            "guilds": {
+                str(guild_id): {
+                    stage: {"samples": samples, **{f"p{p}": seconds for p, seconds in results.items()}}
+                    for stage, (samples, results) in self.percentiles(guild_id).items()
+                }
+                for guild_id in self.guilds.keys()
+            },
+        }
+
+    @staticmethod
+    def save(path: str, snapshot: dict):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(tmp_path, path)
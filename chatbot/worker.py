@@ -0,0 +1,230 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+# most prompts generated together in one batch
+MAX_BATCH = 8
+# how long to wait for more prompts to batch with the first one, in seconds
+BATCH_WAIT = 0.05
+# prompts are cut down to under this many tokens, gpt2's context is 1024
+MAX_PROMPT_TOKENS = 1000
+
+SPECIAL_TOKENS = ("<end_convo>", "<start_convo>")
+
+
+class Request:
+    __slots__ = ("prompt", "max_len", "temp", "future", "queued", "timings")
+
+    def __init__(self, prompt: str, max_len: int, temp: float, future: asyncio.Future, timings: dict = None):
+        self.prompt = prompt
+        self.max_len = max_len
+        self.temp = temp
+        self.future = future
+        self.queued = time.perf_counter()
+        self.timings = timings
+
+
+class InferenceWorker:
+    """
+    Owns the aitextgen model and runs every generation on its own thread.
+
+    Prompts are queued from any channel, prompts that come in at about the same time
+    are padded and generated together in one batch instead of one after another.
+    """
+
+    def __init__(self, model, max_batch: int = MAX_BATCH, batch_wait: float = BATCH_WAIT):
+        self.model = model
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.queue = asyncio.Queue()
+        # one thread, the model is never used from two threads at once
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chatbot")
+        self.batches = 0
+        self.generated = 0
+        # requests taken off the queue and not answered yet
+        self.current = []
+        self.task = asyncio.create_task(self.run())
+
+        # batches are left padded so every prompt's generated text starts at the same position
+        tokenizer = self.model.tokenizer
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+
+    def stop(self):
+        """stop the worker, everything still waiting on a response is cancelled"""
+        self.task.cancel()
+        # run cancels its current batch when it stops, but it may not have started yet
+        for request in self.current:
+            request.future.cancel()
+        self.current = []
+        while not self.queue.empty():
+            request = self.queue.get_nowait()
+            request.future.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def generate(self, prompt: str, max_len: int, temp: float, timings: dict = None) -> str:
+        """
+        Get a response from the model up to max length
+
+        Args:
+            prompt (str): The message to use for generation
+            max_len (int): Maximum number of lines to generate
+            temp (float): Model generation temperature
+            timings (dict): If given, filled with seconds spent waiting in the queue, tokenizing and generating
+        """
+        future = asyncio.get_running_loop().create_future()
+        if self.task.done():
+            # stopped, nothing would ever answer
+            future.cancel()
+        await self.queue.put(Request(prompt, max_len, temp, future, timings))
+        return await future
+
+    async def next_batch(self) -> list:
+        """wait for a prompt, then collect any others that come in within batch_wait"""
+        loop = asyncio.get_running_loop()
+        # kept on the worker as it's collected, so stopping partway through still cancels it
+        batch = self.current = [await self.queue.get()]
+        deadline = loop.time() + self.batch_wait
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def run(self):
+        try:
+            await self._run()
+        finally:
+            # stopped partway through a batch, don't leave anyone waiting forever
+            for request in self.current:
+                request.future.cancel()
+            self.current = []
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.current = []
+            batch = [request for request in await self.next_batch() if not request.future.done()]
+
+            # temperature is per generate call, so only prompts with the same temperature batch together
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.temp, []).append(request)
+
+            for temp, requests in groups.items():
+                started = time.perf_counter()
+                try:
+                    outputs, timings = await loop.run_in_executor(
+                        self.executor,
+                        self.respond,
+                        [r.prompt for r in requests],
+                        [r.max_len for r in requests],
+                        temp,
+                    )
+                except Exception as e:
+                    for request in requests:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    continue
+
+                for request, output in zip(requests, outputs):
+                    # the whole batch's tokenizing and generating time counts for each request in it
+                    if request.timings is not None:
+                        request.timings.update(timings, queue=started - request.queued)
+                    if not request.future.done():
+                        request.future.set_result(output)
+
+    def truncate(self, prompt: str) -> str:
+        """drop words from the start of the prompt until it fits in the model's context"""
+        numtokens = len(self.model.tokenizer(prompt)["input_ids"])
+        while numtokens >= MAX_PROMPT_TOKENS:
+            prompt = " ".join(prompt.split(" ")[20:]).strip()  # pretty arbitrary
+            numtokens = len(self.model.tokenizer(prompt)["input_ids"])
+
+        return prompt
+
+    def generate_batch(self, prompts: list, max_len: int, temp: float, timings: dict) -> list:
+        """
+        generate text following each prompt in one padded batch, returns only the generated text
+
+        seconds spent are added to timings["tokenize"] and timings["generate"].
+        """
+        start = time.perf_counter()
+        tokenizer = self.model.tokenizer
+        inputs = tokenizer([prompt + "\n" for prompt in prompts], return_tensors="pt", padding=True)
+        inputs = {k: v.to(self.model.model.device) for k, v in inputs.items()}
+        length = inputs["input_ids"].shape[1]
+        generate_start = time.perf_counter()
+        timings["tokenize"] += generate_start - start
+
+        with torch.no_grad():
+            outputs = self.model.model.generate(
+                **inputs,
+                max_length=length + 70 + 5 * max_len,
+                temperature=temp,
+                do_sample=True,
+                pad_token_id=tokenizer.pad_token_id,
+            )
+
+        self.batches += 1
+        self.generated += len(prompts)
+        texts = [tokenizer.decode(output[length:], skip_special_tokens=True) for output in outputs]
+        timings["generate"] += time.perf_counter() - generate_start
+        return texts
+
+    @staticmethod
+    def pick_lines(text: str, max_len: int) -> str:
+        """include a random amount of lines up to max_len from generated text in the response"""
+        for token in SPECIAL_TOKENS:
+            text = text.replace(token, "")
+        lines = text.strip().splitlines()
+
+        output = ""
+        j = 0
+        while output == "" and j < 100:  # TODO configure this too?
+            for i in range(0, random.randint(1, max_len)):
+                try:
+                    output += lines[i + 1] + "\n"
+                except IndexError:
+                    continue
+
+            output = output.strip()
+            j += 1
+
+        return output
+
+    def respond(self, prompts: list, max_lens: list, temp: float) -> tuple:
+        """generate responses for a batch of prompts, runs on the worker thread, returns (responses, timings)"""
+        start = time.perf_counter()
+        prompts = [self.truncate(prompt) for prompt in prompts]
+        timings = {"tokenize": time.perf_counter() - start, "generate": 0.0}
+        outputs = [""] * len(prompts)
+        # two tries to generate a non-empty message for each prompt, in case of inf loop TODO: make configurable
+        for _ in range(2):
+            todo = [i for i, output in enumerate(outputs) if output == ""]
+            if not todo:
+                break
+
+            texts = self.generate_batch([prompts[i] for i in todo], max(max_lens[i] for i in todo), temp, timings)
+            for i, text in zip(todo, texts):
+                outputs[i] = self.pick_lines(text, max_lens[i])
+
+        # fill with default message if still empty
+        return [output or "🤔" for output in outputs], timings
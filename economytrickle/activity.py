@@ -1,86 +1,108 @@
 # This probably seems like overkill
 # It is for the current form, it isn't with future features in mind.
 import contextlib
-from datetime import datetime
-from typing import List, Callable, Union, Optional, Dict, Iterator
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Callable, Optional, Dict, Iterator
 
 import discord
 
-MessagePredicate = Callable[[discord.Message], bool]
+ChannelPredicate = Callable[[int], bool]
+
+# activity that didn't happen in a channel, passes every channel check
+NO_CHANNEL = 0
+# most channels remembered per member, the oldest is dropped past this
+MAX_CHANNELS = 32
+
+
+def timestamp(when: datetime) -> float:
+    """epoch seconds of a datetime, naive ones are utc like discord.py's"""
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
 
 
 class RecentActivityRecord:
+    """
+    When a member was last active in each channel, oldest first.
+
+    Only the latest activity per channel is kept, that's all that's needed to tell if
+    they were active after some time, so this doesn't grow with how much they talk.
+    """
 
-    __slots__ = ("activities", "messages")
+    __slots__ = ("times", "channels")
 
     def __init__(self):
-        self.activities: List[datetime] = []
-        self.messages: List[discord.Message] = []
+        self.times = array("d")
+        self.channels = array("Q")
 
-    def add_activity(self, when: datetime):
-        self.activities.append(when)
+    def _add(self, when: float, channel_id: int):
+        with contextlib.suppress(ValueError):
+            i = self.channels.index(channel_id)
+            del self.channels[i]
+            del self.times[i]
 
-    def add_message(self, message: discord.Message):
-        self.messages.append(message)
+        if len(self.channels) >= MAX_CHANNELS:
+            del self.channels[0]
+            del self.times[0]
 
-    def __len__(self):
-        return len(self.activities) + len(self.messages)
+        self.times.append(when)
+        self.channels.append(channel_id)
 
-    def _filter(
-        self,
-        *,
-        after: Optional[datetime] = None,
-        message_check: Optional[MessagePredicate] = None,
-    ) -> List[Union[datetime, discord.Message]]:
+    def add_activity(self, when: datetime):
+        self._add(timestamp(when), NO_CHANNEL)
 
-        ret: List[Union[datetime, discord.Message]] = []
+    def add_message(self, message: discord.Message):
+        self._add(timestamp(message.created_at), message.channel.id)
 
-        for a in self.activities:
-            if after and a <= after:
-                continue
-            ret.append(a)
+    @property
+    def last_active(self) -> float:
+        return self.times[-1] if self.times else 0.0
 
-        for m in self.messages:
-            if after and m.created_at <= after:
-                continue
+    def __len__(self):
+        return len(self.times)
 
-            if message_check and not message_check(m):
+    def _matching(self, *, after: Optional[datetime] = None, channel_check: Optional[ChannelPredicate] = None):
+        after = timestamp(after) if after else None
+        # newest first, so this can stop at the first one that's too old
+        for i in range(len(self.times) - 1, -1, -1):
+            if after is not None and self.times[i] <= after:
+                return
+            channel_id = self.channels[i]
+            if channel_check and channel_id != NO_CHANNEL and not channel_check(channel_id):
                 continue
+            yield channel_id
 
-            ret.append(m)
-
-        return ret
+    def has_activity(
+        self, *, after: Optional[datetime] = None, channel_check: Optional[ChannelPredicate] = None
+    ) -> bool:
+        return next(self._matching(after=after, channel_check=channel_check), None) is not None
 
     def conditional_count(
         self,
         *,
         after: Optional[datetime] = None,
-        message_check: Optional[MessagePredicate] = None,
+        channel_check: Optional[ChannelPredicate] = None,
     ) -> int:
+        """number of channels active in"""
+        return sum(1 for _ in self._matching(after=after, channel_check=channel_check))
 
-        ret = len(self._filter(after=after, message_check=message_check))
-
-        return ret
-
-    def conditional_remove(
-        self,
-        *,
-        before: Optional[datetime] = None,
-        message_check: Optional[MessagePredicate] = None,
-    ):
-        if before:
-            self.activities = [a for a in self.activities if a > before]
-
-            if message_check:
-                self.messages = [m for m in self.messages if m.created_at > before and message_check(m)]
-            else:
-                self.messages = [m for m in self.messages if m.created_at > before]
+    def conditional_remove(self, *, before: Optional[datetime] = None):
+        if not before:
+            return
 
-        elif message_check:
-            self.messages = [m for m in self.messages if message_check(m)]
+        before = timestamp(before)
+        # times are in order, so everything up to the first newer one goes
+        i = 0
+        while i < len(self.times) and self.times[i] <= before:
+            i += 1
+        del self.times[:i]
+        del self.channels[:i]
 
 
-RecordDict = Dict[discord.Guild, Dict[discord.Member, RecentActivityRecord]]
+# guild id: {member id: record}, least recently active member first
+RecordDict = Dict[int, "OrderedDict[int, RecentActivityRecord]"]
 
 
 class RecordHandler:
@@ -100,28 +122,54 @@ class RecordHandler:
         except AttributeError:
             return
 
-        if guild not in self.records:
-            self.records[guild] = {}
+        records = self.records.get(guild.id)
+        if records is None:
+            records = self.records[guild.id] = OrderedDict()
 
-        if member not in self.records[guild]:
-            self.records[guild][member] = RecentActivityRecord()
+        record = records.get(member.id)
+        if record is None:
+            record = records[member.id] = RecentActivityRecord()
+        else:
+            records.move_to_end(member.id)
 
-        self.records[guild][member].add_message(message)
+        record.add_message(message)
 
     def get_active_for_guild(
         self,
         *,
         guild: discord.Guild,
         after: datetime,
-        message_check: Optional[MessagePredicate] = None,
+        channel_check: Optional[ChannelPredicate] = None,
     ) -> Iterator[discord.Member]:
 
-        with contextlib.suppress(KeyError):
-            for member, rec in self.records[guild].items():
-                if rec.conditional_count(after=after, message_check=message_check):
-                    yield member
+        records = self.records.get(guild.id)
+        if not records:
+            return
+
+        after_ts = timestamp(after)
+        # most recently active first, everyone past the first quiet member was quiet too
+        for member_id in reversed(records):
+            record = records[member_id]
+            if record.last_active <= after_ts:
+                break
+            if not record.has_activity(after=after, channel_check=channel_check):
+                continue
+            member = guild.get_member(member_id)
+            if member is not None:
+                yield member
 
     def clear_before(self, *, guild: discord.Guild, before: datetime):
-        with contextlib.suppress(KeyError):
-            for rec in self.records[guild].values():
-                rec.conditional_remove(before=before)
+        records = self.records.get(guild.id)
+        if not records:
+            return
+
+        before_ts = timestamp(before)
+        # members with nothing newer are dropped entirely, the rest just lose their old activity
+        while records:
+            member_id, record = next(iter(records.items()))
+            if record.last_active > before_ts:
+                break
+            del records[member_id]
+
+        for record in records.values():
+            record.conditional_remove(before=before)
@@ -1,7 +1,8 @@
 # pylint: disable=not-async-context-manager
 import asyncio
 import contextlib
-from typing import no_type_check, Union
+import math
+from typing import no_type_check, Union, Dict
 from datetime import datetime, timedelta
 from collections import defaultdict
 import random
@@ -16,6 +17,29 @@ from typing import Literal
 from .activity import RecordHandler
 from .converters import configable_guild_defaults, settings_converter
 
+# most bank deposits running at once when paying out a guild
+DEPOSIT_CONCURRENCY = 8
+
+
+def level_for_xp(xp: float, base: int, increase: int) -> int:
+    """
+    level reached with xp, where level n costs base + (n - 1) * increase more xp
+
+    l levels cost l * base + increase * l * (l - 1) / 2 in total, so this solves that for l
+    instead of walking up one level at a time.
+    """
+    if not increase:
+        return int(xp // base) if base else 0
+
+    b = base - increase / 2
+    level = max(int((math.sqrt(max(b * b + 2 * increase * xp, 0)) - b) / increase), 0)
+    # float rounding can be off by one either way
+    while level and level * base + increase * level * (level - 1) // 2 > xp:
+        level -= 1
+    while (level + 1) * base + increase * (level + 1) * level // 2 <= xp:
+        level += 1
+    return level
+
 
 class EconomyTrickle(commands.Cog):
     """
@@ -79,8 +103,8 @@ class EconomyTrickle(commands.Cog):
         voice_mem = await self.config.guild(guild).min_voice_members()
         if data["mode"] == "blacklist":
 
-            def mpred(m: discord.Message):
-                return m.channel.id not in data["blacklist"]
+            def mpred(channel_id: int):
+                return channel_id not in data["blacklist"]
 
             def vpred(mem: discord.Member):
                 with contextlib.suppress(AttributeError):
@@ -92,8 +116,8 @@ class EconomyTrickle(commands.Cog):
 
         else:
 
-            def mpred(m: discord.Message):
-                return m.channel.id in data["whitelist"]
+            def mpred(channel_id: int):
+                return channel_id in data["whitelist"]
 
             def vpred(mem: discord.Member):
                 with contextlib.suppress(AttributeError):
@@ -103,77 +127,75 @@ class EconomyTrickle(commands.Cog):
                         and not mem.bot
                     )
 
-        has_active_message = set(self.recordhandler.get_active_for_guild(guild=guild, after=after, message_check=mpred))
+        has_active_message = set(self.recordhandler.get_active_for_guild(guild=guild, after=after, channel_check=mpred))
 
         is_active_voice = {m for m in guild.members if vpred(m)}
         is_active = has_active_message | is_active_voice
 
-        # take exp away from inactive users
-        for member in guild.members:
-            if member in is_active:
-                continue
-
-            # loose exp per interval
-            xp = max(data["xp_per_interval"] * data["decay_rate"], 1)
-            xp = await self.config.member(member).xp() - xp
-            xp = max(xp, 0)
-            await self.config.member(member).xp.set(xp)
-
-            # update level on these users
-            level, next_needed = 0, data["level_xp_base"]
-
-            while xp >= next_needed:
-                level += 1
-                xp -= next_needed
-                next_needed += data["xp_lv_increase"]
-
-            if data["maximum_level"] is not None:
-                level = min(data["maximum_level"], level)
-
-            await self.config.member(member).level.set(level)
-
-        for member in is_active:
-            # failed for this member, skip
-            if data["fail_rate"] > random.random():
-                continue
-            # xp processing first
-            xp = data["xp_per_interval"]
-            if member in has_active_message:
-                xp += data["extra_message_xp"]
-            if member in is_active_voice:
-                xp += data["extra_voice_xp"]
-
-            xp = xp + await self.config.member(member).xp()
-            await self.config.member(member).xp.set(xp)
-
-            # level up: new mode in future.
-            level, next_needed = 0, data["level_xp_base"]
-
-            while xp >= next_needed:
-                level += 1
-                xp -= next_needed
-                next_needed += data["xp_lv_increase"]
-
-            if data["maximum_level"] is not None:
-                level = min(data["maximum_level"], level)
-
-            await self.config.member(member).level.set(level)
+        # loose exp per interval
+        decay = max(data["xp_per_interval"] * data["decay_rate"], 1)
+        to_give = {}
+
+        group = self.config._get_base_group(self.config.MEMBER, str(guild.id))
+        async with group.get_lock():
+            members = await group()
+
+            for member in guild.members:
+                key = str(member.id)
+                entry = members.get(key, {})
+                xp = entry.get("xp", 0)
+
+                if member in is_active:
+                    # failed for this member, skip
+                    if data["fail_rate"] > random.random():
+                        continue
+                    xp += data["xp_per_interval"]
+                    if member in has_active_message:
+                        xp += data["extra_message_xp"]
+                    if member in is_active_voice:
+                        xp += data["extra_voice_xp"]
+                elif not xp and key not in members:
+                    # nothing to take away, don't store defaults for every quiet member
+                    continue
+                else:
+                    # take exp away from inactive users
+                    xp = max(xp - decay, 0)
+
+                # level up: new mode in future.
+                level = level_for_xp(xp, data["level_xp_base"], data["xp_lv_increase"])
+                if data["maximum_level"] is not None:
+                    level = min(data["maximum_level"], level)
+
+                members[key] = {**entry, "xp": xp, "level": level}
+
+                if member in is_active:
+                    # give economy
+                    bonus = data["bonus_per_level"] * level
+                    if data["maximum_bonus"] is not None:
+                        bonus = min(data["maximum_bonus"], bonus)
+                    to_give[member] = data["econ_per_interval"] + bonus
+
+            await group.set(members)
+
+        await self.deposit_many(to_give)
+
+        # cleanup old activity
+        self.recordhandler.clear_before(guild=guild, before=after)
 
-            # give economy
+    async def deposit_many(self, amounts: Dict[discord.Member, int]):
+        """
+        deposit credits to many members with bank.deposit_credits, a few at a time
 
-            to_give = data["econ_per_interval"]
-            bonus = data["bonus_per_level"] * level
-            if data["maximum_bonus"] is not None:
-                bonus = min(data["maximum_bonus"], bonus)
+        members it would put over the max balance get nothing.
+        """
+        limit = asyncio.Semaphore(DEPOSIT_CONCURRENCY)
 
-            to_give += bonus
-            try:
-                await bank.deposit_credits(member, to_give)
-            except bank.errors.BalanceTooHigh:
-                pass
+        async def deposit(member: discord.Member, amount: int):
+            async with limit:
+                with contextlib.suppress(bank.errors.BalanceTooHigh):
+                    await bank.deposit_credits(member, amount)
 
-        # cleanup old message objects
-        self.recordhandler.clear_before(guild=guild, before=after)
+        await asyncio.gather(*(deposit(member, amount) for member, amount in amounts.items()))
 
     # Commands go here
 
@@ -1,11 +1,29 @@
 from redbot.core.utils.chat_formatting import *
 from redbot.core import Config, checks, commands
+from redbot.core.data_manager import cog_data_path
 from redbot.core.utils.menus import start_adding_reactions
 from redbot.core.utils.predicates import ReactionPredicate
 from typing import Literal, List
 import discord
-import random
 import asyncio
+import functools
+import glob
+import os
+import shutil
+import site
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .model import MarkovModel
+from .storage import ModelStore, ModelCache, COMPACT_SIZE
+from .training import train_files, read_progress
+
+# how often to save new training data, in seconds
+SAVE_INTERVAL = 60
+# how often to update the progress message while bulk training, in seconds
+TRAIN_PROGRESS_INTERVAL = 5
 
 
 class Markov(commands.Cog):
@@ -15,42 +33,224 @@ class Markov(commands.Cog):
         self.bot = bot
         self.config = Config.get_conf(self, identifier=5989735216541313, force_registration=True)
 
+        # models used to be saved in config, now only read to move them to the model store
         default_guild = {
             "model": {},
             "prefixes": [],
             "max_len": 200,
             "member_model": False,
             "blacklist": [],
+            "order": 1,
         }
         default_member = {"model": {}}
+        self.config.register_global(memory_budget=256)
         self.config.register_guild(**default_guild)
         self.config.register_member(**default_member)
         self.cache = {}
-        self.mem_cache = {}
+        self.store = ModelStore(str(cog_data_path(cog_instance=self) / "models"))
+        # models are loaded when first used, and dropped when unused for a while once over the memory budget
+        self.models = ModelCache(256 * 1024 * 1024)
+        self.loading = {}
+        # messages trained on but not saved yet, by (guild id, "channel" or "member", channel or member id)
+        self.pending = {}
+        # futures for shards whose pending messages are being written to disk
+        self.saving = {}
+        # events for shards being compacted in the executor, set when the compaction is done
+        self.compacting = {}
+        # size of each shard's delta log after its last save
+        self.log_sizes = {}
+        # messages trained live while a guild is bulk training, replayed on top of the trained models
+        self.training = {}
+        self.pool = None
         self.init_task = asyncio.create_task(self.init())
 
     def cog_unload(self):
         self.init_task.cancel()
-        # save all the models before full unload/shutdown
-        for guild in self.bot.guilds:
-            asyncio.create_task(self.config.guild(guild).model.set(self.cache[guild.id]["model"]))
-            for member in guild.members:
-                asyncio.create_task(self.config.member(member).model.set(self.mem_cache[guild.id][member.id]["model"]))
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+        # wait for running compactions, they drop the old log when done so these go to the new one
+        for done in self.compacting.values():
+            done.wait()
+        # save new training data before full unload/shutdown, compacting can wait for next load
+        for (guild_id, kind, shard_id), messages in self.pending.items():
+            self.store.append(guild_id, kind, shard_id, messages)
+        self.pending = {}
+
+    async def get_model(self, guild_id: int, kind: str, shard_id: int) -> MarkovModel:
+        """get a channel or member model, loading it from disk if it isn't loaded"""
+        key = (guild_id, kind, shard_id)
+        model = self.models.get(key)
+        if model is not None:
+            return model
+
+        # if someone else is already loading it, wait for them instead of loading it twice
+        loading = self.loading.get(key)
+        if loading is None:
+            loading = self.loading[key] = asyncio.ensure_future(self.load_model(key))
+
+        return await loading
+
+    async def load_model(self, key: tuple) -> MarkovModel:
+        try:
+            # messages being saved are out of pending but maybe not on disk yet
+            while key in self.saving:
+                await asyncio.wait([self.saving[key]])
+
+            order = self.cache[key[0]]["order"]
+            model = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.store.load, *key, order=order)
+            )
+            # messages that haven't been saved yet aren't on disk
+            for words in self.pending.get(key, []):
+                model.train(words)
+
+            self.models.put(key, model)
+            return model
+        finally:
+            del self.loading[key]
+
+    def train(self, guild_id: int, kind: str, shard_id: int, words: list):
+        """
+        train a shard on a message and mark it as changed
+
+        only a loaded model is trained, shards that aren't loaded get the message from pending when they are.
+        """
+        key = (guild_id, kind, shard_id)
+        model = self.models.peek(key)
+        if model is not None:
+            model.train(words)
+            self.models.update(key)
+        self.pending.setdefault(key, []).append(words)
+        if guild_id in self.training:
+            self.training[guild_id].setdefault((kind, shard_id), []).append(words)
+
+    def clear_shard(self, guild_id: int, kind: str, shard_id: int):
+        """delete a model, loaded and saved"""
+        model = self.models.pop((guild_id, kind, shard_id))
+        if model is not None:
+            model.clear()
+        self.pending.pop((guild_id, kind, shard_id), None)
+        self.log_sizes.pop((guild_id, kind, shard_id), None)
+        self.store.delete(guild_id, kind, shard_id)
+
+    def clear_shards(self, guild_id: int, kind: str):
+        """delete every model of a kind in a guild"""
+        for key in list(self.models.models.keys()) + list(self.pending.keys()):
+            if key[:2] == (guild_id, kind):
+                self.clear_shard(*key)
+        self.store.delete(guild_id, kind)
+
+    async def swap_model(self, guild_id: int, kind: str, shard_id: int, snapshot_path: str):
+        """replace a shard with a bulk trained snapshot, plus the messages trained live since training started"""
+        key = (guild_id, kind, shard_id)
+        # a load that finishes after the swap would put the old model back, a save would write to the old log
+        while key in self.loading or key in self.saving:
+            await asyncio.wait([self.loading.get(key) or self.saving[key]])
+
+        # no awaits from here, so nothing trains or saves the shard halfway through
+        live = self.training[guild_id].pop((kind, shard_id), None)
+        self.store.replace(guild_id, kind, shard_id, snapshot_path)
+        # older pending messages are in the logs the snapshot was trained from
+        self.pending.pop(key, None)
+        self.log_sizes[key] = self.store.append(guild_id, kind, shard_id, live) if live else 0
+        # loaded again from the new snapshot when next used
+        self.models.pop(key)
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        if self.pool is None:
+            # spawned, not forked from the bot with its threads and their held locks,
+            # with this cog's parent directory on its path so it can import it fresh
+            self.pool = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=site.addsitedir,
+                initargs=(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),),
+            )
+        return self.pool
+
+    def compact_shard(self, key: tuple, data: dict, done: threading.Event):
+        """compact a shard in the executor, setting done once it's finished either way"""
+        try:
+            self.store.compact(*key, data)
+        finally:
+            done.set()
+
+    async def save_models(self):
+        """
+        write out new training data for every shard that changed,
+        compacting shards whose delta log has grown past COMPACT_SIZE
+        """
+        loop = asyncio.get_running_loop()
+        for key in list(self.pending.keys()):
+            # a load reading the shard right now would miss what's appended, it's saved next time instead
+            if key in self.loading:
+                continue
+
+            model = self.models.peek(key)
+            messages = self.pending.pop(key, None)
+            if not messages:
+                continue
+
+            saving = self.saving[key] = loop.create_future()
+            try:
+                # compacting needs the whole model, if it isn't loaded it can wait until it is
+                if model is not None and self.log_sizes.get(key, 0) >= COMPACT_SIZE:
+                    # snapshot has to be taken here, before anything else trains the model
+                    data = model.to_dict()
+                    done = self.compacting[key] = threading.Event()
+                    try:
+                        await loop.run_in_executor(None, self.compact_shard, key, data, done)
+                    finally:
+                        del self.compacting[key]
+                    self.log_sizes[key] = 0
+                else:
+                    self.log_sizes[key] = await loop.run_in_executor(
+                        None, functools.partial(self.store.append, *key, messages)
+                    )
+            except Exception:
+                # try again next time, in front of anything trained since
+                self.pending[key] = messages + self.pending.get(key, [])
+                raise
+            finally:
+                del self.saving[key]
+                saving.set_result(None)
+
+    async def migrate_config_models(self):
+        """move models saved in config by older versions into the model store"""
+        loop = asyncio.get_running_loop()
+        for guild_id, guild_data in self.cache.items():
+            for channel_id, model in guild_data["model"].items():
+                data = MarkovModel.from_dict(model).to_dict()
+                await loop.run_in_executor(
+                    None, functools.partial(self.store.compact, guild_id, "channel", int(channel_id), data)
+                )
+
+            if guild_data["model"]:
+                await self.config.guild_from_id(guild_id).model.clear()
+
+        for guild_id, members in (await self.config.all_members()).items():
+            for member_id, member_data in members.items():
+                if not member_data["model"]:
+                    continue
+
+                data = MarkovModel.from_dict(member_data["model"]).to_dict()
+                await loop.run_in_executor(
+                    None, functools.partial(self.store.compact, guild_id, "member", member_id, data)
+                )
+                await self.config.member_from_ids(guild_id, member_id).model.clear()
 
     async def init(self):
         await self.bot.wait_until_ready()
-        # caches all the models, uses more ram but bot
-        # slows down once file gets big otherwise
         self.cache = await self.config.all_guilds()
-        self.mem_cache = await self.config.all_members()
+        self.models.budget = await self.config.memory_budget() * 1024 * 1024
+        await self.migrate_config_models()
+        # models are loaded from the model store when used
+        for data in self.cache.values():
+            del data["model"]
 
-        while True:  # save model every 10 minutes
-            await asyncio.sleep(600)
-            for guild in self.bot.guilds:
-                await self.config.guild(guild).model.set(self.cache[guild.id]["model"])
-                if self.cache[guild.id]["member_model"]:
-                    for member in guild.members:
-                        await self.config.member(member).model.set(self.mem_cache[guild.id][member.id]["model"])
+        while True:  # save new training data every minute
+            await asyncio.sleep(SAVE_INTERVAL)
+            await self.save_models()
 
     @commands.group()
     @checks.admin_or_permissions(administrator=True)
@@ -74,11 +274,34 @@ class Markov(commands.Cog):
         self.cache[ctx.guild.id]["member_model"] = toggle
         await self.config.guild(ctx.guild).member_model.set(toggle)
 
-        if toggle:
-            self.mem_cache = await self.config.all_members()
-
         await ctx.tick()
 
+    @markovset.command(name="memory")
+    @checks.is_owner()
+    async def markovset_memory(self, ctx, budget_mb: int = None):
+        """
+        Set roughly how much memory loaded models can use, across all servers
+
+        Models are loaded when used, the least recently used ones are unloaded once over this.
+        """
+        if budget_mb is not None:
+            if budget_mb <= 0:
+                await ctx.send(error("Memory budget must be greater than 0."))
+                return
+
+            await self.config.memory_budget.set(budget_mb)
+            self.models.budget = budget_mb * 1024 * 1024
+            self.models.evict()
+
+        models = self.models
+        await ctx.send(
+            box(
+                f"Memory budget: {models.budget // 1024 // 1024} MB\n"
+                f"Loaded models: {len(models)}, using about {models.total / 1024 / 1024:.1f} MB\n"
+                f"Unloaded to stay under budget: {models.evictions}"
+            )
+        )
+
     @markovset.command(name="blacklist")
     async def markovset_blacklist(self, ctx, *channels: discord.TextChannel):
         """
@@ -118,20 +341,9 @@ class Markov(commands.Cog):
     async def markovset_clear(self, ctx, *, clear: Union[discord.TextChannel, discord.Member]):
         """Clear data for a specific channel or member"""
         if isinstance(clear, discord.TextChannel):
-            async with self.config.guild(ctx.guild).model() as model:
-                del self.cache[ctx.guild.id]["model"][str(clear.id)]
-                try:  # possible that channel is cached but not saved yet
-                    del model[str(clear.id)]
-                except:
-                    pass
+            self.clear_shard(ctx.guild.id, "channel", clear.id)
         elif isinstance(clear, discord.Member):
-            async with self.config.member(clear).model() as model:
-                try:
-                    self.mem_cache[ctx.guild.id][clear.id]["model"].clear()
-                except:
-                    # memember models may not be used, other issues, just ignore
-                    pass
-                model.clear()
+            self.clear_shard(ctx.guild.id, "member", clear.id)
 
         await ctx.tick()
 
@@ -141,12 +353,132 @@ class Markov(commands.Cog):
 
         if yesno:
             await self.config.clear_all_members(guild=ctx.guild)
-            del self.mem_cache[ctx.guild.id]
+            self.clear_shards(ctx.guild.id, "member")
         else:
             return await ctx.send("Please type `yes` after the command to clear all data.", delete_after=15)
 
         await ctx.tick()
 
+    @markovset.command(name="train")
+    @checks.is_owner()
+    async def markovset_train(self, ctx, channel: discord.TextChannel = None):
+        """
+        Train models from the ActivityLog cog's saved channel logs
+
+        Trains every text channel in the server, or only the given channel.
+        Member models are trained too if they are enabled.
+        Attach a text file with one message per line to train the channel (or this channel) from that instead.
+
+        **This replaces the trained models**, messages from before the logs start are lost.
+        ActivityLog saves messages with mentions shown as `@name`, so models trained from its logs
+        say `@name` where live training on new messages keeps the raw mention.
+        """
+        guild = ctx.guild
+        if guild.id in self.training:
+            await ctx.send(error("This server is already training."))
+            return
+
+        root = os.path.join(self.store.root, os.pardir, "training", str(guild.id))
+        shutil.rmtree(root, ignore_errors=True)
+        os.makedirs(root)
+
+        dump = bool(ctx.message.attachments)
+        if dump:
+            channel = channel or ctx.channel
+            path = os.path.join(root, "dump.txt")
+            await ctx.message.attachments[0].save(path)
+            files = [(channel.id, path)]
+        else:
+            log_path = cog_data_path(raw_name="ActivityLogger") / str(guild.id)
+            channels = [channel] if channel is not None else guild.text_channels
+            channel_ids = {c.id for c in channels}
+            files = []
+            # rotated logs are named {date}--{period}_{channel id}.log
+            for path in sorted(glob.glob(os.path.join(glob.escape(str(log_path)), "*.log"))):
+                channel_id = os.path.basename(path)[: -len(".log")].split("_")[-1]
+                if channel_id.isdigit() and int(channel_id) in channel_ids:
+                    files.append((int(channel_id), path))
+
+        if not files:
+            shutil.rmtree(root, ignore_errors=True)
+            await ctx.send(error("No ActivityLog logs found for this server."))
+            return
+
+        settings = self.cache[guild.id]
+        member_channels = []
+        if settings["member_model"] and not dump:
+            member_channels = [c.id for c in guild.text_channels if c.id not in settings["blacklist"]]
+
+        self.training[guild.id] = {}
+        msg = await ctx.send(f"Training from {len(files)} file(s)...")
+        task = asyncio.get_running_loop().run_in_executor(
+            self.get_pool(),
+            functools.partial(
+                train_files,
+                files,
+                root,
+                settings["order"],
+                int(time.time()),
+                settings["prefixes"],
+                [self.bot.user.id],
+                member_channels,
+                dump=dump,
+            ),
+        )
+        try:
+            while True:
+                try:
+                    result = await asyncio.wait_for(asyncio.shield(task), timeout=TRAIN_PROGRESS_INTERVAL)
+                    break
+                except asyncio.TimeoutError:
+                    progress = read_progress(os.path.join(root, "progress.json"))
+                    if progress:
+                        percent = progress["done"] / max(progress["total"], 1) * 100
+                        await msg.edit(content=f"Training... {percent:.0f}%, {progress['messages']} messages")
+
+            for kind, shard_id in result["shards"]:
+                await self.swap_model(guild.id, kind, shard_id, os.path.join(root, f"{kind}_{shard_id}.json"))
+        except Exception as e:
+            await msg.edit(content=error(f"Training failed: {e}"))
+            return
+        finally:
+            self.training.pop(guild.id, None)
+            shutil.rmtree(root, ignore_errors=True)
+
+        await msg.edit(content=f"Trained {len(result['shards'])} model(s) on {result['messages']} messages.")
+
+    @markovset.command(name="order")
+    async def markovset_order(self, ctx, order: int = None, yesno: bool = False):
+        """
+        Set how many words markov looks back on to pick the next word
+
+        1 is the classic markov chain, higher orders make more sensible but less varied text and need a lot more data.
+        **Changing this clears all channel and member models in the server**, add `yes` after the order to confirm.
+        """
+        if order is None:
+            await ctx.send(f"Current order is `{self.cache[ctx.guild.id]['order']}`.")
+            return
+
+        if ctx.guild.id in self.training:
+            await ctx.send(error("Can't change the order while this server is training."))
+            return
+
+        if not 1 <= order <= 5:
+            await ctx.send(error("Order must be between 1 and 5."))
+            return
+
+        if not yesno:
+            return await ctx.send(
+                "Changing the order clears all models in this server, please type `yes` after the order to confirm.",
+                delete_after=15,
+            )
+
+        self.clear_shards(ctx.guild.id, "channel")
+        self.clear_shards(ctx.guild.id, "member")
+        self.cache[ctx.guild.id]["order"] = order
+        await self.config.guild(ctx.guild).order.set(order)
+        await ctx.tick()
+
     @markovset.command(name="prefix")
     async def markovset_prefixes(self, ctx, *, prefixes: str = None):
         """Set prefixes for bots in your server
@@ -198,13 +530,7 @@ class Markov(commands.Cog):
         Clear your model data from the guild
         """
         if yesno:
-            async with self.config.member(ctx.author).model() as model:
-                try:
-                    self.mem_cache[ctx.guild.id][ctx.author.id]["model"].clear()
-                except:
-                    # memember models may not be used, other issues, just ignore
-                    pass
-                model.clear()
+            self.clear_shard(ctx.guild.id, "member", ctx.author.id)
         else:
             return await ctx.send("Please type `yes` after the command to clear all your data.", delete_after=15)
 
@@ -231,10 +557,7 @@ class Markov(commands.Cog):
         member_model = self.cache[ctx.guild.id]["member_model"]
         if member_model:
             if isinstance(member, discord.Member):
-                if member.id not in self.mem_cache[ctx.guild.id]:
-                    self.mem_cache[ctx.guild.id][member.id] = {}
-                    self.mem_cache[ctx.guild.id][member.id]["model"] = {}
-                model = self.mem_cache[ctx.guild.id][member.id]["model"]
+                model = await self.get_model(ctx.guild.id, "member", member.id)
             elif isinstance(num_text, discord.Member):
                 # move member over to starting text first, if its exists
                 if member is not None:
@@ -245,27 +568,22 @@ class Markov(commands.Cog):
 
                 member = num_text
                 num_text = None
-                if member.id not in self.mem_cache[ctx.guild.id]:
-                    self.mem_cache[ctx.guild.id][member.id] = {}
-                    self.mem_cache[ctx.guild.id][member.id]["model"] = {}
-                model = self.mem_cache[ctx.guild.id][member.id]["model"]
+                model = await self.get_model(ctx.guild.id, "member", member.id)
             else:
                 member_model = False
-                model = self.cache[ctx.guild.id]["model"]
         else:
             member_model = False
-            model = self.cache[ctx.guild.id]["model"]
+
+        if not member_model:
+            model = await self.get_model(ctx.guild.id, "channel", ctx.channel.id)
 
         if member_model and not model:
             await ctx.send(error("This member has no data."), delete_after=30)
             return
-        elif not member_model and str(ctx.channel.id) not in model:
+        elif not member_model and not model:
             await ctx.send(error("This channel has no data."), delete_after=30)
             return
 
-        if not member_model:
-            model = model[str(ctx.channel.id)]
-
         # if num_text is valid
         try:
             num = int(num_text)
@@ -283,14 +601,12 @@ class Markov(commands.Cog):
             starting_text = f"{member} {starting_text if starting_text is not None else ''}"
 
         starting_text = starting_text.split(" ") if starting_text else None
-        last_word = starting_text[-1] if starting_text else None
 
         if not starting_text:
-            markov_text = [random.choice(list(model.keys()))]
-        elif last_word not in model or not model[last_word]:
-            markov_text = starting_text + [random.choice(list(model.keys()))]
+            markov_text = model.random_state()
         else:
-            markov_text = starting_text + [random.choice(model[last_word])]
+            choice = model.next_word(starting_text)
+            markov_text = starting_text + ([choice] if choice is not None else model.random_state())
 
         max_len = self.cache[ctx.guild.id]["max_len"]
 
@@ -311,18 +627,17 @@ class Markov(commands.Cog):
             if "!" in markov_text[-1]:
                 break
 
-            # make sure word is in the model and there is data for the word
-            if markov_text[-1] in model and model[markov_text[-1]]:
-                choice = random.choice(model[markov_text[-1]])
-                num_chars += len(choice)
-                markov_text.append(choice)
-            else:
-                choice = random.choice(list(model.keys()))
-                num_chars += len(choice)
-                markov_text.append(choice)
+            # start over from a random state if there is no data for the last words
+            choice = model.next_word(markov_text)
+            if choice is None:
+                choices = model.random_state()
                 tries += 1
+            else:
+                choices = [choice]
 
-            num_words += 1
+            num_chars += sum(len(choice) for choice in choices)
+            markov_text.extend(choices)
+            num_words += len(choices)
 
         markov_text = " ".join(markov_text)
         if num_chars > max_len:
@@ -356,32 +671,10 @@ class Markov(commands.Cog):
                 return
 
         content = content.split(" ")
-        model = self.cache[guild.id]["model"]
-
-        if self.cache[guild.id]["member_model"]:
-            blacklist = self.cache[guild.id]["blacklist"]
-            if message.author.id not in self.mem_cache[guild.id]:
-                self.mem_cache[guild.id][message.author.id] = {}
-                self.mem_cache[guild.id][message.author.id]["model"] = {}
-            mem_model = self.mem_cache[guild.id][message.author.id]["model"]
+        self.train(guild.id, "channel", message.channel.id, content)
 
-        try:
-            model[str(message.channel.id)]
-        except KeyError:
-            model[str(message.channel.id)] = {}
-
-        for i in range(len(content) - 1):
-            if content[i] not in model[str(message.channel.id)]:
-                model[str(message.channel.id)][content[i]] = list()
-            if self.cache[guild.id]["member_model"] and message.channel.id not in blacklist:
-                if content[i] not in mem_model:
-                    mem_model[content[i]] = list()
-                mem_model[content[i]].append(content[i + 1])
-
-            model[str(message.channel.id)][content[i]].append(content[i + 1])
-
-        self.cache[guild.id]["model"] = model
-        self.mem_cache[guild.id][message.author.id]["model"] = mem_model
+        if self.cache[guild.id]["member_model"] and message.channel.id not in self.cache[guild.id]["blacklist"]:
+            self.train(guild.id, "member", message.author.id, content)
 
     async def red_delete_data_for_user(
         self,
@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import random
+import bisect
+from typing import Optional
+
+# rough memory use in bytes of each part of a model, used to keep loaded models under a budget
+TOKEN_BYTES = 120
+STATE_BYTES = 250
+STATE_TOKEN_BYTES = 8
+TRANSITION_BYTES = 110
+
+
+class State:
+    """
+    Counts of the words seen after a state.
+
+    Sampling is weighted by count, which gives the same distribution as picking
+    from a list with every occurrence in it, without storing the repeats.
+    """
+
+    __slots__ = ("counts", "_keys", "_cum")
+
+    def __init__(self):
+        # next token id: times seen
+        self.counts = {}
+        # cumulative counts for sampling, rebuilt after the counts change
+        self._keys = None
+        self._cum = None
+
+    def add(self, token: int, count: int = 1) -> bool:
+        """count a next token, returns True if it hadn't followed this state before"""
+        new = token not in self.counts
+        self.counts[token] = self.counts.get(token, 0) + count
+        self._keys = None
+        return new
+
+    def sample(self) -> int:
+        if self._keys is None:
+            self._keys = list(self.counts.keys())
+            self._cum = []
+            total = 0
+            for count in self.counts.values():
+                total += count
+                self._cum.append(total)
+
+        return self._keys[bisect.bisect_right(self._cum, random.randrange(self._cum[-1]))]
+
+
+class MarkovModel:
+    """
+    Word level markov chain of a configurable order.
+
+    Words are interned to integer ids. Each state, the last `order` words, keeps a count
+    per next word instead of a list of every next word seen.
+    """
+
+    def __init__(self, order: int = 1):
+        self.order = order
+        # token id: word, and the reverse
+        self.tokens = []
+        self.ids = {}
+        # state: State, states are a token id for order 1 and a tuple of token ids otherwise
+        self.states = {}
+        # every state in a list, so a random one can be picked without copying the keys
+        self.state_keys = []
+        # how many (state, next token) pairs there are, and the total length of all words
+        self.transitions = 0
+        self.chars = 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def clear(self):
+        self.tokens.clear()
+        self.ids.clear()
+        self.states.clear()
+        self.state_keys.clear()
+        self.transitions = 0
+        self.chars = 0
+
+    def memory(self) -> int:
+        """estimate of how many bytes the model takes in memory"""
+        return (
+            len(self.tokens) * TOKEN_BYTES
+            + self.chars
+            + len(self.states) * (STATE_BYTES + STATE_TOKEN_BYTES * self.order)
+            + self.transitions * TRANSITION_BYTES
+        )
+
+    def intern(self, word: str) -> int:
+        token = self.ids.get(word)
+        if token is None:
+            token = self.ids[word] = len(self.tokens)
+            self.tokens.append(word)
+            self.chars += len(word)
+
+        return token
+
+    def state_key(self, tokens: list):
+        return tokens[0] if self.order == 1 else tuple(tokens)
+
+    def add_transition(self, key, token: int, count: int = 1):
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = State()
+            self.state_keys.append(key)
+
+        if state.add(token, count):
+            self.transitions += 1
+
+    def train(self, words: list):
+        """add every run of `order` words and the word after it"""
+        if len(words) <= self.order:
+            return
+
+        tokens = [self.intern(word) for word in words]
+        for i in range(len(tokens) - self.order):
+            self.add_transition(self.state_key(tokens[i : i + self.order]), tokens[i + self.order])
+
+    def next_word(self, words: list) -> Optional[str]:
+        """pick a word to follow the last words, or None if they have never been followed by anything"""
+        if len(words) < self.order:
+            return None
+
+        tokens = [self.ids.get(word) for word in words[-self.order :]]
+        state = self.states.get(self.state_key(tokens))
+        if state is None:
+            return None
+
+        return self.tokens[state.sample()]
+
+    def random_state(self) -> list:
+        """pick the words of any state that has been followed by something"""
+        key = self.state_keys[random.randrange(len(self.state_keys))]
+        tokens = (key,) if self.order == 1 else key
+        return [self.tokens[token] for token in tokens]
+
+    def to_dict(self) -> dict:
+        """json serializable form of the model"""
+        return {
+            "order": self.order,
+            "tokens": self.tokens,
+            "states": {
+                str(key) if self.order == 1 else ",".join(map(str, key)): [
+                    list(state.counts.keys()),
+                    list(state.counts.values()),
+                ]
+                for key, state in self.states.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MarkovModel":
+        """
+        load a model saved with to_dict, or an old style model of {word: [every next word]}
+        """
+        if "tokens" not in data or not isinstance(data.get("states"), dict):
+            model = cls()
+            for word, next_words in data.items():
+                for next_word in next_words:
+                    model.add_transition(model.intern(word), model.intern(next_word))
+
+            return model
+
+        model = cls(data.get("order", 1))
+        model.tokens = list(data["tokens"])
+        model.ids = {word: token for token, word in enumerate(model.tokens)}
+        model.chars = sum(len(word) for word in model.tokens)
+        for key, (next_tokens, counts) in data["states"].items():
+            key = int(key) if model.order == 1 else tuple(int(token) for token in key.split(","))
+            state = model.states[key] = State()
+            state.counts = dict(zip(next_tokens, counts))
+            model.transitions += len(state.counts)
+
+        model.state_keys = list(model.states.keys())
+        return model
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import os
+import json
+import glob
+import collections
+from typing import Optional
+
+from .model import MarkovModel
+
+# compact a shard once its delta log is bigger than this many bytes
+COMPACT_SIZE = 1024 * 1024
+
+
+class ModelStore:
+    """
+    Markov models saved on disk, one shard per channel or member model.
+
+    Each shard is a snapshot of the model plus an append-only log of the messages
+    trained on since. Saving only appends new messages to the logs of shards that changed,
+    and a shard is compacted into a new snapshot once its log gets big.
+
+    Snapshots and logs are numbered by generation (channel_1234.3.json, channel_1234.3.log),
+    only the newest snapshot and the log of the same generation are loaded,
+    so a crash while compacting never trains a message twice.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        # newest generation of each shard by (guild id, kind, shard id), only looked up on disk the first time
+        self.generations = {}
+
+    def shard_path(self, guild_id: int, kind: str, shard_id: int) -> str:
+        return os.path.join(self.root, str(guild_id), f"{kind}_{shard_id}")
+
+    def generation(self, guild_id: int, kind: str, shard_id: int) -> int:
+        """newest snapshot generation of a shard, 0 if it has never been compacted"""
+        key = (guild_id, kind, shard_id)
+        generation = self.generations.get(key)
+        if generation is None:
+            generation = self.generations[key] = self.find_generation(self.shard_path(*key))
+
+        return generation
+
+    @staticmethod
+    def find_generation(path: str) -> int:
+        """newest snapshot generation of a shard on disk"""
+        generations = [0]
+        for snapshot in glob.glob(f"{glob.escape(path)}.*.json"):
+            generation = snapshot[len(path) + 1 : -len(".json")]
+            if generation.isdigit():
+                generations.append(int(generation))
+
+        return max(generations)
+
+    def shards(self, guild_id: int, kind: str) -> list:
+        """ids of the shards of a kind saved for a guild"""
+        ids = set()
+        for path in glob.glob(os.path.join(glob.escape(os.path.join(self.root, str(guild_id))), f"{kind}_*")):
+            shard_id = os.path.basename(path)[len(kind) + 1 :].split(".")[0]
+            if shard_id.isdigit():
+                ids.add(int(shard_id))
+
+        return sorted(ids)
+
+    def load(self, guild_id: int, kind: str, shard_id: int, order: int = 1) -> MarkovModel:
+        """load a shard's snapshot and replay its log, order is only used if there is no snapshot"""
+        path = self.shard_path(guild_id, kind, shard_id)
+        generation = self.generation(guild_id, kind, shard_id)
+
+        model = MarkovModel(order)
+        if generation:
+            with open(f"{path}.{generation}.json", "r") as f:
+                model = MarkovModel.from_dict(json.load(f))
+
+        try:
+            with open(f"{path}.{generation}.log", "r") as f:
+                for line in f:
+                    try:
+                        model.train(json.loads(line))
+                    except ValueError:  # partially written last line
+                        continue
+        except OSError:
+            pass
+
+        return model
+
+    def append(self, guild_id: int, kind: str, shard_id: int, messages: list) -> int:
+        """append trained messages to a shard's log, returns the log's size"""
+        path = self.shard_path(guild_id, kind, shard_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.{self.generation(guild_id, kind, shard_id)}.log", "a") as f:
+            f.write("".join(json.dumps(words) + "\n" for words in messages))
+            return f.tell()
+
+    def compact(self, guild_id: int, kind: str, shard_id: int, data: dict):
+        """
+        write a new snapshot from the model's to_dict and drop the older generations it covers
+
+        data should be taken while nothing else is training the model, the rest can run in the executor.
+        """
+        path = self.shard_path(guild_id, kind, shard_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        self.replace(guild_id, kind, shard_id, tmp_path)
+
+    def replace(self, guild_id: int, kind: str, shard_id: int, snapshot_path: str):
+        """swap in a snapshot file written elsewhere as the shard's newest generation, dropping everything older"""
+        path = self.shard_path(guild_id, kind, shard_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        old = self.generation(guild_id, kind, shard_id)
+        os.replace(snapshot_path, f"{path}.{old + 1}.json")
+        self.generations[(guild_id, kind, shard_id)] = old + 1
+
+        for ext in ("json", "log"):
+            for old_path in glob.glob(f"{glob.escape(path)}.*.{ext}"):
+                if old_path != f"{path}.{old + 1}.{ext}":
+                    os.remove(old_path)
+
+    def delete(self, guild_id: int, kind: str, shard_id: int = None):
+        """delete a shard, or every shard of a kind in the guild if no id is given"""
+        if shard_id is None:
+            pattern = os.path.join(glob.escape(os.path.join(self.root, str(guild_id))), f"{kind}_*")
+            for key in [key for key in self.generations if key[:2] == (guild_id, kind)]:
+                del self.generations[key]
+        else:
+            pattern = glob.escape(self.shard_path(guild_id, kind, shard_id)) + ".*"
+            self.generations.pop((guild_id, kind, shard_id), None)
+
+        for path in glob.glob(pattern):
+            os.remove(path)
+
+
+class ModelCache:
+    """
+    LRU of loaded models, keyed by (guild id, kind, shard id).
+
+    Models are only estimates of their size, the least recently used ones are dropped
+    once the loaded models go over the memory budget. At least one model is always kept.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.models = collections.OrderedDict()
+        # memory estimate of each model when it was last used
+        self.sizes = {}
+        self.total = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.models
+
+    def __len__(self):
+        return len(self.models)
+
+    def get(self, key) -> Optional[MarkovModel]:
+        model = self.models.get(key)
+        if model is not None:
+            self.models.move_to_end(key)
+            self.update(key)
+
+        return model
+
+    def peek(self, key) -> Optional[MarkovModel]:
+        """get a model without marking it as used"""
+        return self.models.get(key)
+
+    def put(self, key, model: MarkovModel):
+        self.pop(key)
+        self.models[key] = model
+        self.update(key)
+
+    def pop(self, key) -> Optional[MarkovModel]:
+        model = self.models.pop(key, None)
+        if model is not None:
+            self.total -= self.sizes.pop(key)
+
+        return model
+
+    def update(self, key):
+        """refresh a model's size, models grow as they are trained, then evict if over budget"""
+        size = self.models[key].memory()
+        self.total += size - self.sizes.get(key, 0)
+        self.sizes[key] = size
+        self.evict()
+
+    def evict(self):
+        while self.total > self.budget and len(self.models) > 1:
+            self.pop(next(iter(self.models)))
+            self.evictions += 1
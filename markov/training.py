@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import os
+import json
+import calendar
+from typing import Optional
+
+from .model import MarkovModel
+
+# write progress every this many lines read
+PROGRESS_LINES = 20000
+
+# suffixes activitylog adds to messages with attachments or stickers
+MESSAGE_SUFFIXES = (" (attachment url(s): ", " (sticker url(s): ", " (attachment(s) saved to ")
+
+
+def parse_line_time(line: str) -> Optional[int]:
+    """epoch seconds of an activitylog line's "YYYY-MM-DD HH:MM:SS" prefix"""
+    try:
+        return calendar.timegm(
+            (int(line[0:4]), int(line[5:7]), int(line[8:10]), int(line[11:13]), int(line[14:16]), int(line[17:19]))
+        )
+    except ValueError:
+        return None
+
+
+def parse_message(line: str) -> Optional[tuple]:
+    """
+    (author id, message content) of a message line in an activitylog channel log,
+    None for anything else like edits, deletes and voice channel events
+    """
+    start = line.find("(id:")
+    if start == -1:
+        return None
+
+    end = line.find(")", start)
+    author_id = line[start + 4 : end]
+    if not author_id.isdigit():
+        return None
+
+    rest = line[end + 1 :]
+    if rest.startswith(": "):
+        content = rest[2:]
+    elif rest.startswith(" replied to ") and " [with]: " in rest:
+        content = rest.split(" [with]: ", 1)[1]
+    else:
+        return None
+
+    for suffix in MESSAGE_SUFFIXES:
+        i = content.rfind(suffix)
+        if i != -1 and content.endswith(")"):
+            content = content[:i]
+            break
+
+    # activitylog escapes newlines to keep one message per line
+    return int(author_id), content.replace("\\n", "\n")
+
+
+def write_progress(path: str, done: int, total: int, messages: int):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"done": done, "total": total, "messages": messages}, f)
+    os.replace(tmp_path, path)
+
+
+def read_progress(path: str) -> Optional[dict]:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def train_files(
+    files: list,
+    out_path: str,
+    order: int,
+    cutoff: int,
+    prefixes: list,
+    ignore_ids: list,
+    member_channels: list,
+    dump: bool = False,
+) -> dict:
+    """
+    build models from channel logs in one pass, runs in a separate process.
+
+    files is a list of (channel id, path), each message line is trained into its channel's model,
+    and into its author's model if the channel is in member_channels. Lines logged at or after
+    cutoff are skipped, those were trained live. If dump is True the files are plain text with
+    one message per line instead of activitylog logs, and only channel models are built.
+
+    Models are written to out_path as {kind}_{id}.json snapshots, progress to out_path/progress.json.
+    Returns how many messages were trained and which (kind, id) shards were written.
+    """
+    total = sum(os.path.getsize(path) for _, path in files)
+    progress_path = os.path.join(out_path, "progress.json")
+    member_channels = set(member_channels)
+    ignore_ids = set(ignore_ids)
+    models = {}
+    done = 0
+    messages = 0
+    lines = 0
+
+    def get_model(key):
+        model = models.get(key)
+        if model is None:
+            model = models[key] = MarkovModel(order)
+        return model
+
+    for channel_id, path in files:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                done += len(line)
+                lines += 1
+                if lines % PROGRESS_LINES == 0:
+                    write_progress(progress_path, done, total, messages)
+
+                line = line.rstrip("\n")
+                if dump:
+                    author_id, content = None, line
+                else:
+                    ts = parse_line_time(line)
+                    if ts is None or ts >= cutoff:
+                        continue
+
+                    message = parse_message(line)
+                    if message is None:
+                        continue
+                    author_id, content = message
+
+                if not content or author_id in ignore_ids:
+                    continue
+                if any(content.startswith(prefix) for prefix in prefixes):
+                    continue
+
+                # same tokenizer as live training, but activitylog logs clean_content so mentions are @name
+                # here and raw <@id> mentions in live training
+                words = content.split(" ")
+                get_model(("channel", channel_id)).train(words)
+                if author_id is not None and channel_id in member_channels:
+                    get_model(("member", author_id)).train(words)
+                messages += 1
+
+    shards = []
+    for (kind, shard_id), model in models.items():
+        if not model:
+            continue
+
+        with open(os.path.join(out_path, f"{kind}_{shard_id}.json"), "w") as f:
+            json.dump(model.to_dict(), f)
+        shards.append((kind, shard_id))
+
+    write_progress(progress_path, total, total, messages)
+    return {"messages": messages, "shards": shards}